@@ -1,17 +1,81 @@
 import time
 import os
+import hmac
+import itertools
+from functools import partial
+from datetime import datetime
 import MySQLdb
-from flask import Flask, request, g, Response
-from utils import (
-    Json, build_image_info, build_range_query, build_keyword_query,
-    build_search_query_from_dic, set_params
-)
+from flask import Flask, request, g, Response, stream_with_context
 from dotenv import load_dotenv, find_dotenv
+# before the modules below read their settings
 load_dotenv(find_dotenv())
+from utils import (
+    Json, dumps, build_image_info, build_range_query, parse_query_dic,
+    build_search_query_from_dic, build_images_query, build_count_query,
+    build_ids_query, build_window_query, build_relevance_query, like_pattern,
+    ESTIMATE_COUNT_QUERY, set_params,
+    parse_params, parse_projection, select_columns, project_image_info, build_columns
+)
+import utils
+import search_index
+import related
+import snapshot
+import count_cache
+import pagination
+import planner
+import term_stats
+import ngram
+import invalidation
+import response_cache
+from pool import ConnectionPool, PoolTimeout
+from response_cache import cache_response
+from coalesce import coalesce
+import metrics
+from metrics import span
 app = Flask(__name__)
+metrics.init_app(app)
+
+# 'mysql' (fulltext search) or 'memory' (in-process bigram index)
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'mysql')
+BATCH_MAX_IDS = int(os.environ.get('BATCH_MAX_IDS', 300))
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+# bearer token for POST /images and PATCH /image/<id>, empty to disable
+WRITE_API_TOKEN = os.environ.get('WRITE_API_TOKEN', '')
+# comma-separated host[:port] of read replicas, which take the reads
+# that may go there; DB_USER, DB_PASSWD and DB_NAME are shared
+DB_REPLICAS = [
+    x.strip() for x in os.environ.get('DB_REPLICAS', '').split(',')
+    if x.strip()
+]
+PRIMARY = 'primary'
+# seconds after a write during which reads stay on the primary, since a
+# replica that has not applied it yet would serve, and get cached, the
+# old rows; longer than the replicas usually lag
+REPLICA_WRITE_DELAY = float(os.environ.get('REPLICA_WRITE_DELAY', 5))
+ORDERS = ('id', 'relevance')
+# order=relevance ranks this many of the best matches. MySQL still rates
+# every match, so a broad keyword takes longer than the same search by
+# id, which stops at the first page
+RELEVANCE_LIMIT = int(os.environ.get('RELEVANCE_LIMIT', 1000))
+# how many of the matches MySQL rates highest get the full score; the
+# rest are ranked out
+RELEVANCE_CANDIDATES = max(
+    int(os.environ.get('RELEVANCE_CANDIDATES', 5000)), RELEVANCE_LIMIT + 1)
+# weight of the MATCH score next to the share of keyword bigrams found
+RELEVANCE_MATCH_WEIGHT = float(os.environ.get('RELEVANCE_MATCH_WEIGHT', 0.1))
+# how often a worker checks that ngram.py filled UNIGRAM_TABLE up to
+# the last row
+UNIGRAM_CHECK_INTERVAL = int(os.environ.get('UNIGRAM_CHECK_INTERVAL', 60))
 
+if WRITE_API_TOKEN and not invalidation.available():
+    # the other workers would keep serving what an edit replaced
+    app.logger.error(
+        'write api disabled: no uWSGI cache or INVALIDATION_PATH to tell '
+        'the other workers about writes')
+    WRITE_API_TOKEN = ''
 
-def connect_db():
+
+def connect_db(target=PRIMARY):
     kwargs = dict(
         user=os.environ['DB_USER'],
         passwd=os.environ['DB_PASSWD'],
@@ -21,6 +85,11 @@ def connect_db():
         use_unicode=True,
         charset='utf8mb4',
     )
+    if target != PRIMARY:
+        host, _, port = target.partition(':')
+        kwargs['host'] = host
+        if port:
+            kwargs['port'] = int(port)
 
     if app.testing:
         kwargs['db'] = os.environ['TEST_DB_NAME']
@@ -28,10 +97,177 @@ def connect_db():
     return MySQLdb.connect(**kwargs)
 
 
-def db():
+_pools = {}
+_pools_pid = None
+
+
+def get_pool(target=PRIMARY):
+    global _pools, _pools_pid
+    # connections must not be shared with the uWSGI master or siblings,
+    # so a forked worker builds its own pools
+    if _pools_pid != os.getpid():
+        _pools = {}
+        _pools_pid = os.getpid()
+    pool = _pools.get(target)
+    if pool is None:
+        pool = _pools[target] = ConnectionPool(partial(connect_db, target))
+    return pool
+
+
+_rotation = itertools.count()
+# the highest id each replica is known to have; ids only grow, so a
+# replica is asked again only for an id above it
+_replica_heads = {}
+
+
+def read_target():
+    if not DB_REPLICAS:
+        return PRIMARY
+    return DB_REPLICAS[next(_rotation) % len(DB_REPLICAS)]
+
+
+def checkout_replica(min_id):
+    # a replica connection that has every id up to min_id, or None to
+    # read from the primary instead
+    if time.time() - invalidation.written_at() < REPLICA_WRITE_DELAY:
+        return None
+    target = read_target()
+    if target == PRIMARY:
+        return None
+    pool = get_pool(target)
+    try:
+        conn = pool.checkout()
+    except (MySQLdb.Error, PoolTimeout):
+        app.logger.exception('replica %s is unavailable', target)
+        return None
+    if min_id is not None and min_id > _replica_heads.get(target, 0):
+        try:
+            head = head_id(conn.cursor(metrics.TimedDictCursor))
+        except MySQLdb.Error:
+            pool.discard(conn)
+            app.logger.exception('replica %s is unavailable', target)
+            return None
+        _replica_heads[target] = max(_replica_heads.get(target, 0), head)
+        if head < min_id:
+            # lagging behind the page asked for
+            pool.checkin(conn)
+            return None
+    return target, conn
+
+
+def db(read=False, min_id=None):
+    # read=True lets the request go to a replica; the first such call
+    # picks it for the rest of the request
+    if read and 'replica' not in g:
+        g.replica = checkout_replica(min_id)
+    if read and g.replica is not None:
+        return g.replica[1].cursor(metrics.TimedDictCursor)
     if not hasattr(g, 'db_conn'):
-        g.db_conn = connect_db()
-    return g.db_conn.cursor(MySQLdb.cursors.DictCursor)
+        g.db_conn = get_pool().checkout()
+    return g.db_conn.cursor(metrics.TimedDictCursor)
+
+
+def current_target():
+    # where the reads of this request go
+    replica = g.get('replica')
+    return replica[0] if replica is not None else PRIMARY
+
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        get_pool().checkin(conn)
+    replica = g.pop('replica', None)
+    if replica is not None:
+        target, conn = replica
+        get_pool(target).checkin(conn)
+
+
+def preload():
+    # run once before the workers are forked, so that a recycled worker
+    # starts with what the master built; the connection used here is
+    # closed again because it must not be shared with the workers
+    term_stats.get_stats()
+    related.get_index()
+    snapshot.get_snapshot()
+    invalidation.changed()
+    for _reversed in (False, True):
+        for max_id, since_id in ((None, None), (1, None), (None, 1), (1, 1)):
+            range_query, _ = build_range_query(max_id, since_id)
+            build_images_query(range_query, _reversed)
+            if range_query:
+                build_count_query(None, range_query)
+    if SEARCH_BACKEND == 'memory':
+        try:
+            conn = connect_db(read_target())
+            try:
+                search_index.get_index(
+                    conn.cursor(MySQLdb.cursors.DictCursor))
+            finally:
+                conn.close()
+        except MySQLdb.Error:
+            # each worker builds the index on its first search instead
+            app.logger.exception('could not preload the search index')
+
+
+def warm_worker():
+    try:
+        for target in [PRIMARY] + DB_REPLICAS:
+            get_pool(target).fill()
+    except MySQLdb.Error:
+        # the first request opens one instead
+        app.logger.exception('could not open database connections')
+    if ngram.UNIGRAM_TABLE:
+        check_unigrams()
+
+
+def check_unigrams(signum=None):
+    # rows inserted without the API have no unigrams until ngram.py
+    # fills them, and the table is only searched while it covers every
+    # row; runs between requests and only reads
+    pool = get_pool()
+    try:
+        conn = pool.checkout()
+    except (MySQLdb.Error, PoolTimeout):
+        app.logger.exception('could not check %s', ngram.UNIGRAM_TABLE)
+        return
+    try:
+        filled = ngram.unigrams_filled(conn.cursor())
+    except MySQLdb.Error:
+        pool.discard(conn)
+        app.logger.exception('could not check %s', ngram.UNIGRAM_TABLE)
+        return
+    pool.checkin(conn)
+    utils.unigram_ready = bool(filled)
+
+
+try:
+    from uwsgidecorators import postfork, timer
+except ImportError:
+    pass
+else:
+    # with lazy-apps = false the master imports this module before forking
+    preload()
+    postfork(warm_worker)
+    if ngram.UNIGRAM_TABLE:
+        timer(UNIGRAM_CHECK_INTERVAL, target='workers')(check_unigrams)
+
+
+@app.before_request
+def sync_caches():
+    if invalidation.changed():
+        # the response cache clears a shared store by itself, but not
+        # what this worker keeps
+        response_cache.cache.clear()
+        drop_caches()
+        search_index.reset()
+
+
+def drop_caches():
+    count_cache.cache.invalidate()
+    pagination.windows.invalidate()
+    snapshot.refresh()
 
 
 @app.route('/ping')
@@ -40,142 +276,700 @@ def ping():
 
 
 @app.route('/image/<int:image_id>')
+@cache_response
 def get_image(image_id):
     image_id = int(image_id)
-    query = '''
-    SELECT
-        i.id AS id
-      , i.filename AS filename
-      , i.created_at AS created_at
-      , ii.id AS image_info_id
-      , ii.comment AS comment
-      , ii.source AS source
-    FROM images i
-    LEFT JOIN image_info ii
-    ON i.id = ii.image_id
-    WHERE i.id = %s
-    '''
-    app.logger.debug(f'Query: {query}' % image_id)
-    c = db()
-    c.execute(query, (image_id,))
-    result = c.fetchone()
+    try:
+        fields, fmt = parse_projection(request.args)
+    except ValueError as e:
+        return Json({'ok': False, 'message': str(e)}, 400)
+    snap = snapshot.get_snapshot()
+    if snap is not None and image_id <= snap.max_id:
+        result = snap.get(image_id)
+    else:
+        query = build_ids_query(1, columns=select_columns(fields))
+        app.logger.debug('Query: %s', query)
+        c = db(read=True, min_id=image_id)
+        c.execute(query, (image_id,))
+        result = c.fetchone()
     if result is None:
         return Json({'ok': False, 'message': 'image_not_found'}, 404)
-    return Json({'ok': True, 'data': build_image_info(result)})
+    g.cacheable = True
+    if fmt == 'columns':
+        return Json({'ok': True, **render([result], fields, fmt)})
+    with span('rows'):
+        data = project_image_info(result, fields)
+    return Json({'ok': True, 'data': data})
+
+
+@app.route('/image/<int:image_id>/related')
+def get_related_images(image_id):
+    try:
+        count, _, _ = parse_params(request.args)
+        fields, fmt = parse_projection(request.args)
+    except ValueError as e:
+        return Json({'ok': False, 'message': str(e)}, 400)
+    index = related.get_index()
+    if index is None:
+        return Json({
+            'ok': False,
+            'message': 'related index is not available'
+        }, 503)
+
+    t_s = time.time()
+    c = db(read=True, min_id=image_id)
+    # the signature comes from the current comment, so an image edited
+    # or added since the index was built is looked up as it is now
+    c.execute(build_ids_query(1, columns=select_columns(frozenset(
+        ('id', 'comment')))), (image_id,))
+    target = c.fetchone()
+    if target is None:
+        return Json({'ok': False, 'message': 'image_not_found'}, 404)
+    bigrams = search_index.tokenize(target['comment'] or '')
+    with span('related'):
+        ranked = index.related(
+            related.signature(bigrams, index.hashes), count,
+            exclude=image_id)
+    result = []
+    if ranked:
+        # the signatures only estimate the overlap; the rows shown are
+        # ordered by the exact one of their current comments
+        query = build_ids_query(len(ranked), columns=select_columns(
+            fields | {'comment'} if fields is not None else fields))
+        app.logger.debug('Query: %s', query)
+        c.execute(query, [x for x, _ in ranked])
+        with span('related'):
+            result = sorted(
+                ((related.jaccard(bigrams, search_index.tokenize(
+                    info['comment'] or '')), info)
+                 for info in c.fetchall()),
+                key=lambda x: (-x[0], -x[1]['id']))
+    t_e = time.time()
+    return Json({
+        'ok': True,
+        'elapsed_time': t_e - t_s,
+        'similarity': [score for score, _ in result],
+        **render([info for _, info in result], fields, fmt)
+    })
+
+
+@app.route('/images', methods=['POST'])
+def create_image():
+    error = check_write_token()
+    if error is not None:
+        return error
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or \
+            not isinstance(body.get('filename'), str) or not body['filename']:
+        return Json({'ok': False, 'message': 'filename is required'}, 400)
+    try:
+        info = parse_image_info(body)
+        created_at = datetime.fromisoformat(body['created_at']) \
+            if 'created_at' in body else datetime.now()
+    except (TypeError, ValueError) as e:
+        return Json({'ok': False, 'message': str(e) or 'invalid body'}, 400)
+
+    c = db()
+    try:
+        c.execute(
+            'INSERT INTO images (filename, created_at) VALUES (%s, %s)',
+            (body['filename'], created_at))
+        image_id = c.lastrowid
+        if info:
+            save_image_info(c, image_id, info)
+        g.db_conn.commit()
+    except MySQLdb.Error:
+        g.db_conn.rollback()
+        raise
+    # a new id changes neither cached pages nor cached counts, which only
+    # cover ids up to the head they were made at
+    return Json({'ok': True, 'data': fetch_image_info(c, image_id)}, 201)
+
+
+@app.route('/image/<int:image_id>', methods=['PATCH'])
+def update_image(image_id):
+    error = check_write_token()
+    if error is not None:
+        return error
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return Json({'ok': False, 'message': 'invalid body'}, 400)
+    try:
+        info = parse_image_info(body)
+    except ValueError as e:
+        return Json({'ok': False, 'message': str(e)}, 400)
+
+    c = db()
+    c.execute('SELECT id FROM images WHERE id = %s FOR UPDATE', (image_id,))
+    if c.fetchone() is None:
+        return Json({'ok': False, 'message': 'image_not_found'}, 404)
+    if info:
+        try:
+            comment = save_image_info(c, image_id, info)
+            g.db_conn.commit()
+        except MySQLdb.Error:
+            g.db_conn.rollback()
+            raise
+        response_cache.cache.invalidate()
+        snapshot.invalidate()
+        if 'comment' in info:
+            drop_caches()
+            search_index.update(image_id, comment)
+        # the other workers drop what they cached, /image/<id> included
+        invalidation.bump()
+    return Json({'ok': True, 'data': fetch_image_info(c, image_id)})
+
+
+def check_write_token():
+    if not WRITE_API_TOKEN:
+        return Json({'ok': False, 'message': 'write api is disabled'}, 403)
+    header = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(header, f'Bearer {WRITE_API_TOKEN}'):
+        return Json({'ok': False, 'message': 'unauthorized'}, 401)
+    return None
+
+
+def parse_image_info(body):
+    info = {}
+    for key in ('comment', 'source'):
+        if key in body:
+            if body[key] is not None and not isinstance(body[key], str):
+                raise ValueError(f'{key} must be a string or null')
+            info[key] = body[key]
+    return info
+
+
+def save_image_info(c, image_id, info):
+    # comment_ngram and the unigrams of the row change in the same
+    # transaction as the comment; returns the comment now stored
+    c.execute(
+        'SELECT id, comment, source FROM image_info WHERE image_id = %s '
+        'FOR UPDATE',
+        (image_id,))
+    row = c.fetchone()
+    comment = info.get('comment', row['comment'] if row else None)
+    source = info.get('source', row['source'] if row else None)
+    comment_ngram = ngram.ngram(comment) if comment is not None else None
+    if row is None:
+        c.execute(
+            'INSERT INTO image_info (image_id, comment, comment_ngram, source) '
+            'VALUES (%s, %s, %s, %s)',
+            (image_id, comment, comment_ngram, source))
+    else:
+        c.execute(
+            'UPDATE image_info SET comment = %s, comment_ngram = %s, '
+            'source = %s WHERE id = %s',
+            (comment, comment_ngram, source, row['id']))
+    if ngram.UNIGRAM_TABLE and 'comment' in info and \
+            ngram.table_exists(c, ngram.UNIGRAM_TABLE):
+        ngram.update_unigrams(
+            c, [{'image_id': image_id, 'comment': comment or ''}])
+    return comment
+
+
+def fetch_image_info(c, image_id):
+    c.execute(build_ids_query(1), (image_id,))
+    return build_image_info(c.fetchone())
+
+
+@app.route('/images/batch')
+def get_images_batch():
+    try:
+        ids = [int(x) for x in request.args.get('ids', '').split(',')]
+    except ValueError:
+        return Json({
+            'ok': False,
+            'message': 'invalid ids parameter'
+        }, 400)
+
+    if len(ids) > BATCH_MAX_IDS:
+        return Json({
+            'ok': False,
+            'message': f'ids must not contain more than {BATCH_MAX_IDS} ids'
+        }, 400)
+
+    unique_ids = list(set(ids))
+    with span('build'):
+        query = build_ids_query(len(unique_ids))
+    app.logger.debug('Query: %s', query)
+    c = db(read=True, min_id=max(unique_ids))
+    c.execute(query, unique_ids)
+    result = c.fetchall()
+    with span('rows'):
+        found = {info['id']: build_image_info(info) for info in result}
+    return Json({
+        'ok': True,
+        'data': [found.get(image_id) for image_id in ids],
+        'not_found': [image_id for image_id in ids if image_id not in found],
+    })
+
+
+@app.route('/images/export')
+def export_images():
+    try:
+        since_id = int(request.args.get('since_id', 0))
+    except ValueError:
+        return Json({
+            'ok': False,
+            'message': 'invalid since_id parameter'
+        }, 400)
+
+    query_dic = parse_query_dic(request.args)
+    where, params = 'i.id > %s', [since_id]
+    if query_dic is not None:
+        keyword_query, params = build_search_query_from_dic(query_dic)
+        where = f'{keyword_query} AND {where}'
+        params.append(since_id)
+
+    # every row, oldest first, so since_id=<last id received> resumes
+    query = build_images_query(where, True, limit=False)
+    app.logger.debug('Query: %s', query)
+
+    def generate():
+        # rows past the head of a lagging replica come with the next resume
+        pool = get_pool(read_target())
+        conn = pool.checkout()
+        # a server-side cursor keeps only one batch in memory
+        c = conn.cursor(MySQLdb.cursors.SSDictCursor)
+        finished = False
+        try:
+            c.execute(query, params)
+            while True:
+                rows = c.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                yield ''.join(
+                    dumps(build_image_info(info)) + '\n' for info in rows)
+            finished = True
+        finally:
+            if finished:
+                c.close()
+                pool.checkin(conn)
+            else:
+                # closing the cursor would read the rest of the result set
+                pool.discard(conn)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={
+            'Access-Control-Allow-Origin': '*',
+        },
+    )
 
 
 @app.route('/images')
+@cache_response
+@coalesce
 @set_params
 def get_images(count, max_id, since_id):
     _reversed = request.args.get('reversed', '0') == '1'
+    mode = request.args.get('whole_count', 'cached')
+    if mode not in count_cache.MODES:
+        return Json({
+            'ok': False,
+            'message': 'invalid whole_count parameter'
+        }, 400)
+
+    try:
+        max_id, since_id, asc, _reversed, _ = parse_cursor(
+            max_id, since_id, _reversed)
+        fields, fmt = parse_projection(request.args)
+    except ValueError as e:
+        return Json({'ok': False, 'message': str(e)}, 400)
 
-    range_query = build_range_query(max_id, since_id)
-    query = f'''
-    SELECT
-        i.id AS id
-      , i.filename AS filename
-      , i.created_at AS created_at
-      , ii.id AS image_info_id
-      , ii.comment AS comment
-      , ii.source AS source
-    FROM images i
-    LEFT JOIN image_info ii
-    ON i.id = ii.image_id
-    {('WHERE ' + range_query) if range_query else ''}
-    ORDER BY id {'ASC' if _reversed else 'DESC'} LIMIT %s
-    '''
-    app.logger.debug(f'Query: {query}' % count)
     t_s = time.time()
-    c = db()
-    c.execute(query, (count,))
-    result = c.fetchall()
-    if result is None:
-        return Json({'ok': False, 'message': 'invalid parameters'}, 400)
-    query = f'''
-    SELECT
-        COUNT(*) AS cnt
-    FROM images
-    '''
-    app.logger.debug(f'Query: {query}')
-    c.execute(query)
-    count = c.fetchone()['cnt']
+    c = db(read=True, min_id=newest_id(max_id, since_id))
+    result = list_images(
+        c, snapshot.get_snapshot(), count, max_id, since_id, asc,
+        select_columns(fields))
+    head = head_id(c)
+    # ids are append-only, so a page can no longer change once it is full
+    # going upwards or it lies below the newest image
+    if asc:
+        g.cacheable = len(result) == count
+    else:
+        g.cacheable = max_id is not None and max_id <= head
+    next_cursor, prev_cursor = pagination.cursors(
+        [info['id'] for info in result], count, asc, _reversed,
+        since_id=since_id)
+    if asc != _reversed:
+        result = result[::-1]
+    count = whole_count(c, head, None, None, mode)
     t_e = time.time()
     return Json({
         'ok': True,
         'elapsed_time': t_e - t_s,
         'whole_count': count,
-        'data': [build_image_info(info) for info in result]
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+        **render(result, fields, fmt)
     })
 
 
 @app.route('/images/search')
+@coalesce
 @set_params
 def search_images(count, max_id, since_id):
     _reversed = request.args.get('reversed', '0') == '1'
+    mode = request.args.get('whole_count', 'cached')
+    if mode not in count_cache.MODES:
+        return Json({
+            'ok': False,
+            'message': 'invalid whole_count parameter'
+        }, 400)
 
-    keyword = request.args.get("keyword", "").strip()
-    and_keyword = request.args.get("all", "").strip()
-    or_keyword = request.args.get("any", "").strip()
-    not_keyword = request.args.get("ex", "").strip()
-    if keyword:
-        keyword_query = build_keyword_query(keyword)
-    elif and_keyword or or_keyword or not_keyword:
-        query_dic = {
-            "and": and_keyword.split(),
-            "or": or_keyword.split(),
-            "ex": not_keyword.split(),
-        }
-        keyword_query = build_search_query_from_dic(query_dic)
-    else:
+    order = request.args.get('order', 'id')
+    if order not in ORDERS:
+        return Json({
+            'ok': False,
+            'message': 'invalid order parameter'
+        }, 400)
+    if order == 'relevance' and SEARCH_BACKEND == 'memory':
+        return Json({
+            'ok': False,
+            'message': 'order=relevance needs the mysql search backend'
+        }, 400)
+
+    query_dic = parse_query_dic(request.args)
+    if query_dic is None:
         return Json({
             'ok': False,
             'message': 'you must specify a keyword'
         }, 400)
 
-    range_query = build_range_query(max_id, since_id)
-
-    query = f'''
-    SELECT
-        i.id AS id
-      , i.filename AS filename
-      , i.created_at AS created_at
-      , ii.id AS image_info_id
-      , ii.comment AS comment
-      , ii.source AS source
-    FROM images i
-    LEFT JOIN image_info ii
-    ON i.id = ii.image_id
-    WHERE
-        {keyword_query}
-    {('AND ' + range_query) if range_query else ''}
-    ORDER BY id {'ASC' if _reversed else 'DESC'} LIMIT %s
-    '''
-    app.logger.debug(f'Query: {query}')
-    c = db()
+    try:
+        if order == 'relevance':
+            token = request.args.get('cursor')
+            cursor = pagination.decode_ranked(token) if token else None
+        else:
+            max_id, since_id, asc, _reversed, window_id = parse_cursor(
+                max_id, since_id, _reversed)
+        fields, fmt = parse_projection(request.args)
+    except ValueError as e:
+        return Json({'ok': False, 'message': str(e)}, 400)
+
+    with span('plan'):
+        plan = planner.plan(query_dic, term_stats.get_stats())
+    if plan['empty']:
+        return Json({
+            'ok': True,
+            'elapsed_time': 0.0,
+            'whole_count': 0,
+            'next_cursor': None,
+            'prev_cursor': None,
+            **render([], fields, fmt)
+        })
+
+    if order == 'relevance':
+        return search_images_by_relevance(
+            plan, query_dic, cursor, count, max_id, since_id, mode, fields,
+            fmt)
+
+    if SEARCH_BACKEND == 'memory':
+        return search_images_in_memory(
+            plan, count, max_id, since_id, asc, _reversed, fields, fmt)
+
+    verify = planner.needs_verification(plan)
+    # verification reads the comment even if it is not sent
+    columns = select_columns(
+        fields | {'comment'} if verify and fields is not None else fields)
+    with span('build'):
+        join, keyword_query, keyword_params = planner.build_query(
+            plan, exact=not verify)
+        count_join, count_query, count_params = join, keyword_query, \
+            keyword_params
+        if verify:
+            count_join, count_query, count_params = planner.build_query(plan)
+    key = count_cache.normalize(query_dic)
+    c = db(read=True, min_id=newest_id(max_id, since_id))
     t_s = time.time()
-    c.execute(query, (count,))
-    result = c.fetchall()
-    if result is None:
-        return Json({'ok': False, 'message': 'invalid parameters'}, 400)
-    query = f'''
-    SELECT
-        COUNT(*) AS cnt
-    FROM images i
-    LEFT JOIN image_info ii
-    ON
-        i.id = ii.image_id
-    WHERE
-        {keyword_query}
-    '''
-    app.logger.debug(f'Query: {query}')
-    c.execute(query)
-    count = c.fetchone()['cnt']
+    result = []
+    examined = []
+    exhausted = None
+    page_max_id, page_since_id = max_id, since_id
+    while True:
+        need = count - len(result)
+        # after a round with false positives, ask for as many candidates
+        # as the rate of them suggests
+        want = need
+        if result:
+            want = min(
+                max(pagination.WINDOW_SIZE, count),
+                need * len(examined) // len(result) + 1)
+        page, window_id = candidates(
+            c, key, window_id, want, page_max_id, page_since_id, asc,
+            join, keyword_query, keyword_params)
+        if page:
+            query = build_ids_query(len(page), asc, columns=columns)
+            app.logger.debug('Query: %s', query)
+            c.execute(query, page)
+            rows = c.fetchall()
+            examined += page
+            if verify:
+                with span('verify'):
+                    rows = [
+                        info for info in rows
+                        if planner.verify(plan, info['comment'])
+                    ]
+            result += rows
+        if not verify:
+            break
+        # only a verified page can come up short while candidates are left
+        if len(page) < want:
+            exhausted = True
+            break
+        if len(result) >= count:
+            exhausted = False
+            break
+        if asc:
+            page_since_id = page[-1]
+        else:
+            page_max_id = page[-1] - 1
+    if len(result) > count:
+        # the next page starts right after the last row shown
+        result = result[:count]
+        examined = examined[:examined.index(result[-1]['id']) + 1]
+    next_cursor, prev_cursor = pagination.cursors(
+        examined, count, asc, _reversed, window_id, since_id, exhausted)
+    if asc != _reversed:
+        result.reverse()
+    count = whole_count(
+        c, head_id(c), query_dic, count_query, mode, count_join, count_params)
+    t_e = time.time()
+    return Json({
+        'ok': True,
+        'elapsed_time': t_e - t_s,
+        'whole_count': count,
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+        **render(result, fields, fmt)
+    })
+
+
+def list_images(c, snap, count, max_id, since_id, asc, columns):
+    # rows of the page in scan order; only those above the snapshot are
+    # read from MySQL
+    edge = snap.max_id if snap is not None else 0
+    above = max(since_id or 0, edge)
+    result = []
+    if asc:
+        if snap is not None and (since_id or 0) < edge:
+            result = snap.page(
+                count, edge if max_id is None else min(max_id, edge),
+                since_id, asc)
+        if len(result) < count and (max_id is None or max_id > edge):
+            result += fetch_images(
+                c, count - len(result), max_id, above or since_id, asc,
+                columns)
+    else:
+        if max_id is None or max_id > edge:
+            result = fetch_images(
+                c, count, max_id, above or since_id, asc, columns)
+        if snap is not None and len(result) < count and \
+                (since_id or 0) < edge:
+            result += snap.page(
+                count - len(result),
+                edge if max_id is None else min(max_id, edge),
+                since_id, asc)
+    return result
+
+
+def fetch_images(c, count, max_id, since_id, asc, columns):
+    with span('build'):
+        range_query, params = build_range_query(max_id, since_id)
+        query = build_images_query(range_query, asc, columns=columns)
+    app.logger.debug('Query: %s', query)
+    c.execute(query, params + [count])
+    return list(c.fetchall())
+
+
+def search_images_by_relevance(plan, query_dic, cursor, count, max_id,
+                               since_id, mode, fields, fmt):
+    # max_id and since_id narrow down what is ranked; a cursor moves
+    # through the ranking
+    key = ('relevance', count_cache.normalize(query_dic), max_id, since_id)
+    with span('build'):
+        join, keyword_query, params = planner.build_query(plan)
+        range_query, range_params = build_range_query(max_id, since_id)
+        where = keyword_query + (
+            f' AND {range_query}' if range_query else '')
+    c = db(read=True, min_id=newest_id(max_id, since_id))
+    t_s = time.time()
+    ranking = window_id = None
+    if cursor is not None and cursor[3] is not None:
+        ranking = pagination.windows.get(cursor[3], key)
+        window_id = cursor[3]
+    if ranking is None:
+        ranking = rank(c, plan, key, join, where, params + range_params)
+        window_id = pagination.windows.put(ranking)
+    start, end = ranking.page(count, cursor and cursor[:3])
+    next_cursor, prev_cursor = ranking.cursors(start, end, window_id)
+    ids = ranking.ids[start:end]
+    result = []
+    if ids:
+        query = build_ids_query(len(ids), columns=select_columns(fields))
+        app.logger.debug('Query: %s', query)
+        c.execute(query, ids)
+        found = {info['id']: info for info in c.fetchall()}
+        result = [found[x] for x in ids if x in found]
+    count = whole_count(
+        c, head_id(c), query_dic, keyword_query, mode, join, params)
     t_e = time.time()
     return Json({
         'ok': True,
         'elapsed_time': t_e - t_s,
         'whole_count': count,
-        'data': [build_image_info(info) for info in result]
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+        'relevance': ranking.scores[start:end],
+        # whole_count counts matches no cursor reaches then
+        'truncated': ranking.truncated,
+        **render(result, fields, fmt)
+    })
+
+
+def rank(c, plan, key, join, where, params):
+    # the rows beyond RELEVANCE_LIMIT are the ones ranked lowest, or
+    # left out of the RELEVANCE_CANDIDATES rated highest by MySQL
+    bigrams = set()
+    for term in plan['and'] + plan['or']:
+        bigrams |= search_index.tokenize(term)
+    bigrams = sorted(bigrams)
+    query = build_relevance_query(where, join, len(bigrams))
+    app.logger.debug('Query: %s', query)
+    c.execute(query, [
+        *(like_pattern(f' {x} ') for x in bigrams),
+        max(1, len(bigrams)), RELEVANCE_MATCH_WEIGHT, ' '.join(bigrams),
+        *params, RELEVANCE_CANDIDATES, RELEVANCE_LIMIT + 1,
+    ])
+    rows = c.fetchall()
+    truncated = len(rows) > RELEVANCE_LIMIT
+    rows = rows[:RELEVANCE_LIMIT]
+    # rounded so that a score survives the trip through a cursor
+    return pagination.Ranking(
+        key, [round(float(row['score']), 6) for row in rows],
+        [row['id'] for row in rows], truncated)
+
+
+def render(result, fields, fmt):
+    # the keys of a response that carry the rows
+    with span('rows'):
+        if fmt == 'columns':
+            prefixes, data = build_columns(result, fields)
+            return {'prefixes': prefixes, 'data': data}
+        return {'data': [project_image_info(info, fields) for info in result]}
+
+
+def candidates(c, key, window_id, count, max_id, since_id, asc, join,
+               keyword_query, keyword_params):
+    # ids of the next page in scan order, and the window they came from.
+    # The next pages of a search are usually answered by the ids
+    # collected for the first one, without evaluating MATCH again.
+    if window_id is not None:
+        window = pagination.windows.get(window_id, key)
+        if window is not None:
+            page = window.page(count, max_id, since_id, asc)
+            if page is not None:
+                return page, window_id
+
+    with span('build'):
+        range_query, range_params = build_range_query(max_id, since_id)
+        where = keyword_query + (
+            f' AND {range_query}' if range_query else '')
+        query = build_window_query(where, asc, join=join)
+    app.logger.debug('Query: %s', query)
+    limit = max(pagination.WINDOW_SIZE, count)
+    c.execute(query, keyword_params + range_params + [limit])
+    fetched = [row['id'] for row in c.fetchall()]
+    window = pagination.build_window(
+        key, fetched, limit, max_id, since_id, asc)
+    window_id = None
+    if window is not None:
+        window_id = pagination.windows.put(window)
+    return fetched[:count], window_id
+
+
+def parse_cursor(max_id, since_id, _reversed):
+    # a cursor takes the place of max_id, since_id and reversed;
+    # returns (max_id, since_id, asc, reversed, window id)
+    token = request.args.get('cursor')
+    if not token:
+        return max_id, since_id, _reversed, _reversed, None
+    boundary, asc, _reversed, window_id = pagination.decode(token)
+    max_id, since_id = pagination.to_range(boundary, asc)
+    return max_id, since_id, asc, _reversed, window_id
+
+
+def newest_id(max_id, since_id):
+    # a replica serves the range only if it has every id up to here;
+    # otherwise the page would silently skip what it has not caught up on
+    bounds = [x for x in (max_id, since_id) if x is not None]
+    return max(bounds) if bounds else None
+
+
+def head_id(c):
+    c.execute('SELECT MAX(id) AS max_id FROM images')
+    return c.fetchone()['max_id'] or 0
+
+
+def whole_count(c, head_id, query_dic, keyword_query, mode, join='',
+                params=()):
+    snap = snapshot.get_snapshot() if keyword_query is None else None
+
+    def count_range(since_id, max_id):
+        counted = 0
+        if snap is not None:
+            # the snapshot counts its ids without MySQL
+            counted = snap.count(max_id, since_id)
+            if max_id is not None and max_id <= snap.max_id:
+                return counted
+            since_id = max(since_id or 0, snap.max_id)
+        with span('build'):
+            range_query, range_params = build_range_query(max_id, since_id)
+            query = build_count_query(keyword_query, range_query, join)
+        app.logger.debug('Query: %s', query)
+        c.execute(query, list(params) + range_params)
+        return counted + c.fetchone()['cnt']
+
+    def estimate():
+        c.execute(ESTIMATE_COUNT_QUERY)
+        return c.fetchone()['cnt']
+
+    # each target has a head of its own; a lagging replica must not make
+    # the others count everything again
+    return count_cache.cache.lookup(
+        (current_target(), count_cache.normalize(query_dic)), head_id,
+        count_range, mode,
+        estimate if keyword_query is None else None,
+    )
+
+
+def search_images_in_memory(query_dic, count, max_id, since_id, asc,
+                            _reversed, fields=None, fmt='rows'):
+    c = db(read=True, min_id=newest_id(max_id, since_id))
+    t_s = time.time()
+    index = search_index.get_index(c)
+    with span('index'):
+        ids = index.search(query_dic)
+        page = search_index.paginate(ids, count, max_id, since_id, asc)
+    result = []
+    if page:
+        query = build_ids_query(
+            len(page), _reversed, columns=select_columns(fields))
+        app.logger.debug('Query: %s', query)
+        c.execute(query, page)
+        result = c.fetchall()
+    next_cursor, prev_cursor = pagination.cursors(
+        page, count, asc, _reversed, since_id=since_id)
+    t_e = time.time()
+    return Json({
+        'ok': True,
+        'elapsed_time': t_e - t_s,
+        'whole_count': len(ids),
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+        **render(result, fields, fmt)
     })
 
 
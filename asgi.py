@@ -0,0 +1,196 @@
+import asyncio
+import contextlib
+import os
+import time
+import aiomysql
+from starlette.applications import Starlette
+from starlette.responses import Response, PlainTextResponse
+from starlette.routing import Route
+from dotenv import load_dotenv, find_dotenv
+# before the modules below read their settings
+load_dotenv(find_dotenv())
+from utils import (
+    dumps, build_image_info, build_range_query, parse_query_dic,
+    build_images_query, build_count_query,
+    ESTIMATE_COUNT_QUERY, parse_params
+)
+import count_cache
+import planner
+import term_stats
+
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 4))
+POOL_MAX_LIFETIME = int(os.environ.get('DB_POOL_MAX_LIFETIME', 3600))
+
+
+async def create_pool(testing=False):
+    return await aiomysql.create_pool(
+        minsize=1,
+        maxsize=POOL_SIZE,
+        pool_recycle=POOL_MAX_LIFETIME,
+        user=os.environ['DB_USER'],
+        password=os.environ['DB_PASSWD'],
+        host=os.environ['DB_HOST'],
+        port=int(os.environ['DB_PORT']),
+        db=os.environ['TEST_DB_NAME' if testing else 'DB_NAME'],
+        use_unicode=True,
+        charset='utf8mb4',
+        autocommit=True,
+    )
+
+
+def Json(obj, status_code=200):
+    return Response(
+        dumps(obj),
+        status_code=status_code,
+        media_type='application/json',
+        headers={
+            'Access-Control-Allow-Origin': '*',
+        },
+    )
+
+
+async def fetchall(query, args=None):
+    async with app.state.pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as c:
+            await c.execute(query, args)
+            return await c.fetchall()
+
+
+async def whole_count(query_dic, keyword_query, mode, join='', params=()):
+    async with app.state.pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as c:
+            await c.execute('SELECT MAX(id) AS max_id FROM images')
+            head_id = (await c.fetchone())['max_id'] or 0
+
+            async def count_range(since_id, max_id):
+                range_query, range_params = build_range_query(
+                    max_id, since_id)
+                await c.execute(
+                    build_count_query(keyword_query, range_query, join),
+                    list(params) + range_params)
+                return (await c.fetchone())['cnt']
+
+            key = count_cache.normalize(query_dic)
+            count, since_id = count_cache.cache.get(key, head_id, mode)
+            if count is not None:
+                if since_id is not None:
+                    count += await count_range(since_id, head_id)
+                    count_cache.cache.extend(key, count, head_id)
+                return count
+
+            if mode == 'estimate' and keyword_query is None:
+                await c.execute(ESTIMATE_COUNT_QUERY)
+                return (await c.fetchone())['cnt']
+
+            count = await count_range(None, head_id)
+            count_cache.cache.put(key, count, head_id, time.time())
+            return count
+
+
+async def list_images(query, params, query_dic, keyword_query, mode,
+                      join='', keyword_params=()):
+    t_s = time.time()
+    # the page and the whole count run on separate pooled connections
+    result, count = await asyncio.gather(
+        fetchall(query, params),
+        whole_count(query_dic, keyword_query, mode, join, keyword_params),
+    )
+    t_e = time.time()
+    return Json({
+        'ok': True,
+        'elapsed_time': t_e - t_s,
+        'whole_count': count,
+        'data': [build_image_info(info) for info in result]
+    })
+
+
+async def ping(request):
+    return PlainTextResponse('pong')
+
+
+async def get_image(request):
+    image_id = request.path_params['image_id']
+    query = build_images_query('i.id = %s', False)
+    result = await fetchall(query, (image_id, 1))
+    if not result:
+        return Json({'ok': False, 'message': 'image_not_found'}, 404)
+    return Json({'ok': True, 'data': build_image_info(result[0])})
+
+
+async def get_images(request):
+    try:
+        count, max_id, since_id = parse_params(request.query_params)
+    except ValueError as e:
+        return Json({'ok': False, 'message': str(e)}, 400)
+    _reversed = request.query_params.get('reversed', '0') == '1'
+    mode = request.query_params.get('whole_count', 'cached')
+    if mode not in count_cache.MODES:
+        return Json({
+            'ok': False,
+            'message': 'invalid whole_count parameter'
+        }, 400)
+
+    range_query, params = build_range_query(max_id, since_id)
+    query = build_images_query(range_query, _reversed)
+    return await list_images(query, params + [count], None, None, mode)
+
+
+async def search_images(request):
+    try:
+        count, max_id, since_id = parse_params(request.query_params)
+    except ValueError as e:
+        return Json({'ok': False, 'message': str(e)}, 400)
+    args = request.query_params
+    _reversed = args.get('reversed', '0') == '1'
+    mode = args.get('whole_count', 'cached')
+    if mode not in count_cache.MODES:
+        return Json({
+            'ok': False,
+            'message': 'invalid whole_count parameter'
+        }, 400)
+
+    query_dic = parse_query_dic(args)
+    if query_dic is None:
+        return Json({
+            'ok': False,
+            'message': 'you must specify a keyword'
+        }, 400)
+
+    plan = planner.plan(query_dic, term_stats.get_stats())
+    if plan['empty']:
+        return Json({
+            'ok': True,
+            'elapsed_time': 0.0,
+            'whole_count': 0,
+            'data': []
+        })
+
+    join, keyword_query, keyword_params = planner.build_query(plan)
+    range_query, range_params = build_range_query(max_id, since_id)
+    where = keyword_query + (f' AND {range_query}' if range_query else '')
+
+    query = build_images_query(where, _reversed, join=join)
+    return await list_images(
+        query, keyword_params + range_params + [count], query_dic,
+        keyword_query, mode, join, keyword_params)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # each ASGI worker process opens its own pool once its loop is running
+    app.state.pool = await create_pool(app.state.testing)
+    yield
+    app.state.pool.close()
+    await app.state.pool.wait_closed()
+
+
+app = Starlette(
+    routes=[
+        Route('/ping', ping),
+        Route('/image/{image_id:int}', get_image),
+        Route('/images', get_images),
+        Route('/images/search', search_images),
+    ],
+    lifespan=lifespan,
+)
+app.state.testing = False
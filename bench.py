@@ -0,0 +1,275 @@
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.error import HTTPError
+from urllib.parse import quote
+from urllib.request import urlopen
+import MySQLdb
+from dotenv import load_dotenv, find_dotenv
+# before the modules below read their settings
+load_dotenv(find_dotenv())
+from ngram import ngram
+
+SIZES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+
+NAMES = [
+    '仁奈', 'みりあ', '奈緒', '薫', '美玲', '杏', 'きらり', '凛', '卯月',
+    '未央', '幸子', '輝子', '小梅', '乃々', '蘭子', 'ありす', '文香',
+]
+WORDS = [
+    'かわいい', 'ちゃん', '笑顔', 'ライブ', '衣装', 'イラスト', '新作',
+    'R-18', 'lunatic', '@aoi', 'まとめ', 'コラ', 'ぷちデレラ', '♂',
+]
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS images (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        filename VARCHAR(255) NOT NULL,
+        created_at DATETIME NOT NULL
+    ) DEFAULT CHARSET=utf8mb4
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS image_info (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        image_id INT NOT NULL UNIQUE,
+        comment TEXT,
+        comment_ngram TEXT,
+        source VARCHAR(255),
+        FULLTEXT KEY (comment) WITH PARSER ngram,
+        FULLTEXT KEY (comment_ngram)
+    ) DEFAULT CHARSET=utf8mb4
+    ''',
+]
+
+SCENARIOS = [
+    ('images', '/images?count=200'),
+    ('images_max_id', '/images?count=200&max_id={mid}'),
+    ('images_reversed', '/images?count=200&since_id={mid}&reversed=1'),
+    ('image', '/image/{mid}'),
+    ('search_single', '/images/search?keyword=' + quote('奈緒')),
+    ('search_multi', '/images/search?keyword=' + quote('仁奈 みりあ')),
+    ('search_or', '/images/search?keyword=' + quote('仁奈 OR みりあ')),
+    ('search_ex', '/images/search?keyword=' + quote('奈緒 -R-18')),
+    ('search_char', '/images/search?keyword=' + quote('薫')),
+    ('search_otokonoko', '/images/search?keyword=' + quote('♂')),
+    ('search_relevance',
+     '/images/search?order=relevance&keyword=' + quote('奈緒')),
+]
+
+
+def connect_db(db_name):
+    return MySQLdb.connect(
+        user=os.environ['DB_USER'],
+        passwd=os.environ['DB_PASSWD'],
+        host=os.environ['DB_HOST'],
+        port=int(os.environ['DB_PORT']),
+        db=db_name,
+        use_unicode=True,
+        charset='utf8mb4',
+    )
+
+
+def make_comment(rng):
+    words = rng.sample(NAMES, rng.randint(1, 3))
+    words += rng.sample(WORDS, rng.randint(0, 3))
+    rng.shuffle(words)
+    comment = ' '.join(words)
+    if rng.random() < 0.1:
+        comment += f' https://example.com/{rng.randint(1, 10 ** 6)}'
+    return comment
+
+
+def seed(db_name, size, seed_value=0, batch_size=5000):
+    rng = random.Random(seed_value)
+    conn = connect_db(db_name)
+    c = conn.cursor()
+    for query in SCHEMA:
+        c.execute(query)
+    c.execute('SELECT COUNT(*) FROM images')
+    start = c.fetchone()[0]
+    created_at = datetime(2017, 1, 1) + timedelta(minutes=start)
+
+    for offset in range(start, size, batch_size):
+        n = min(batch_size, size - offset)
+        c.executemany(
+            'INSERT INTO images (filename, created_at) VALUES (%s, %s)',
+            [(f'{offset + i + 1}.jpg', created_at + timedelta(minutes=i))
+             for i in range(n)])
+        created_at += timedelta(minutes=n)
+        rows = []
+        for i in range(n):
+            # a few images have no image_info at all
+            if rng.random() < 0.05:
+                continue
+            comment = make_comment(rng)
+            rows.append((offset + i + 1, comment, ngram(comment),
+                         'https://example.com/source'))
+        c.executemany(
+            'INSERT INTO image_info (image_id, comment, comment_ngram, source) '
+            'VALUES (%s, %s, %s, %s)',
+            rows)
+        conn.commit()
+        print(f'{offset + n}/{size}', file=sys.stderr)
+    conn.close()
+
+
+def percentile(values, p):
+    # nearest-rank
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, math.ceil(p * len(values) / 100) - 1))
+    return values[k]
+
+
+def flask_client(db_name):
+    os.environ['DB_NAME'] = db_name
+    import api
+    client = api.app.test_client()
+
+    def get(path):
+        rv = client.get(path)
+        rv.get_data()
+        return rv.status_code
+    return get
+
+
+def http_client(base_url):
+    def get(path):
+        try:
+            with urlopen(base_url.rstrip('/') + path) as resp:
+                resp.read()
+                return resp.status
+        except HTTPError as e:
+            # counted as an error instead of ending the run
+            e.read()
+            return e.code
+    return get
+
+
+def cache_buster():
+    # paths with an argument no view reads, different for every request
+    # and every run, so that neither the response cache nor coalescing
+    # answers them
+    tag = os.urandom(4).hex()
+    counter = itertools.count()
+
+    def bust(path):
+        return f"{path}{'&' if '?' in path else '?'}_={tag}{next(counter)}"
+    return bust
+
+
+def run_scenario(get, path, requests, concurrency, warmup, cold=False):
+    bust = cache_buster() if cold else (lambda x: x)
+    for _ in range(warmup):
+        get(bust(path))
+
+    def timed(_):
+        url = bust(path)
+        t_s = time.perf_counter()
+        status = get(url)
+        return time.perf_counter() - t_s, status
+
+    t_s = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as executor:
+            results = list(executor.map(timed, range(requests)))
+    else:
+        results = [timed(i) for i in range(requests)]
+    elapsed = time.perf_counter() - t_s
+
+    latencies = [t for t, _ in results]
+    return {
+        'path': path,
+        'requests': requests,
+        'errors': sum(1 for _, status in results if status >= 400),
+        'throughput': requests / elapsed,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+    }
+
+
+def compare(results, baseline, threshold):
+    # names of scenarios whose p95 got worse by more than threshold
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base and result['p95'] > base['p95'] * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Seed a benchmark database or benchmark the API.')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('seed', help='fill a database with a synthetic corpus')
+    p.add_argument('--db', default=os.environ.get('BENCH_DB_NAME', 'sukui_bench'))
+    p.add_argument('--size', choices=SIZES, default='10k')
+    p.add_argument('--seed', type=int, default=0)
+
+    p = sub.add_parser('run', help='benchmark the routes')
+    p.add_argument('--db', default=os.environ.get('BENCH_DB_NAME', 'sukui_bench'))
+    p.add_argument('--url', help='benchmark a running server over HTTP '
+                   'instead of the Flask test client')
+    p.add_argument('--requests', type=int, default=200)
+    p.add_argument('--warmup', type=int, default=10)
+    p.add_argument('--concurrency', type=int, default=1)
+    p.add_argument('--cold', action='store_true',
+                   help='make every request miss the response cache and '
+                   'coalescing, so that the query path is measured')
+    p.add_argument('--only', nargs='*', help='scenario names to run')
+    p.add_argument('--output', default='bench_output.txt')
+    p.add_argument('--baseline', help='earlier --output file to compare with')
+    p.add_argument('--threshold', type=float, default=0.1,
+                   help='allowed p95 slowdown against the baseline')
+    args = parser.parse_args()
+
+    if args.command == 'seed':
+        seed(args.db, SIZES[args.size], args.seed)
+        return
+
+    get = http_client(args.url) if args.url else flask_client(args.db)
+    conn = connect_db(args.db)
+    c = conn.cursor()
+    c.execute('SELECT MAX(id) FROM images')
+    mid = (c.fetchone()[0] or 0) // 2
+    conn.close()
+
+    results = {}
+    for name, path in SCENARIOS:
+        if args.only and name not in args.only:
+            continue
+        result = run_scenario(
+            get, path.format(mid=mid), args.requests, args.concurrency,
+            args.warmup, args.cold)
+        results[name] = result
+        print(f"{name:18} {result['throughput']:9.1f} req/s  "
+              f"p50 {result['p50'] * 1000:8.2f} ms  "
+              f"p95 {result['p95'] * 1000:8.2f} ms  "
+              f"p99 {result['p99'] * 1000:8.2f} ms  "
+              f"errors {result['errors']}")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"p95 regressed by more than {args.threshold:.0%}: "
+                  f"{', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import os
+import errno
+import fcntl
+import hashlib
+import json
+import tempfile
+import threading
+import time
+from functools import wraps
+from flask import request, Response
+import count_cache
+from utils import parse_query_dic
+
+# a directory for lock files shared by the uWSGI workers, so that only
+# one of them runs a request the others are waiting for; empty to only
+# coalesce the threads of a worker, which with `threads = 1` in
+# uwsgi.ini never happens
+LOCK_DIR = os.environ.get(
+    'COALESCE_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'sukui-coalesce'))
+# how long a request waits for another one before running by itself
+TIMEOUT = float(os.environ.get('COALESCE_TIMEOUT', 10))
+POLL_INTERVAL = 0.005
+# lock files not used for this long are removed
+SWEEP_AGE = 60
+
+QUERY_ARGS = ('keyword', 'all', 'any', 'ex')
+
+
+def request_key():
+    # the same for requests that have to get the same response: keywords
+    # are compared like count_cache does, other parameters sorted
+    args = sorted(
+        (k, v) for k, v in request.args.items(True) if k not in QUERY_ARGS)
+    return json.dumps([
+        request.path, args,
+        count_cache.normalize(parse_query_dic(request.args)),
+    ], ensure_ascii=False)
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class Coalescer:
+    def __init__(self, lock_dir=LOCK_DIR, timeout=TIMEOUT):
+        self.lock_dir = lock_dir
+        self.timeout = timeout
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.swept_at = 0.0
+        self.made_dir = False
+
+    def run(self, key, func):
+        # returns (body, status, headers) of func, or of the call of func
+        # another request made for the same key while this one waited
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if not leader:
+            if flight.done.wait(self.timeout) and flight.result is not None:
+                return flight.result
+            return func()
+
+        try:
+            if self.lock_dir:
+                flight.result = self.run_shared(key, func)
+            else:
+                flight.result = func()
+            return flight.result
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def run_shared(self, key, func):
+        arrived_at = time.time()
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        path = os.path.join(self.lock_dir, f'{digest}.lock')
+        if not self.made_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            self.made_dir = True
+        self.sweep(arrived_at)
+        while True:
+            with open(path, 'a+b') as f:
+                if not self.acquire(f):
+                    return func()
+                try:
+                    if not same_file(path, f):
+                        # swept away before it was locked here
+                        continue
+                    # the request that held the lock leaves its response
+                    f.seek(0)
+                    result = load(f.read(), arrived_at)
+                    if result is not None:
+                        return result
+                    result = func()
+                    if result[1] == 200:
+                        f.truncate(0)
+                        f.write(dump(result))
+                        f.flush()
+                    return result
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def acquire(self, f):
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if time.time() >= deadline:
+                return False
+            time.sleep(POLL_INTERVAL)
+
+    def sweep(self, now):
+        if now - self.swept_at < SWEEP_AGE:
+            return
+        self.swept_at = now
+        try:
+            names = os.listdir(self.lock_dir)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith('.lock'):
+                continue
+            path = os.path.join(self.lock_dir, name)
+            try:
+                with open(path, 'rb') as f:
+                    if now - os.fstat(f.fileno()).st_mtime <= SWEEP_AGE:
+                        continue
+                    # a leader still running holds it; raises then
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def same_file(path, f):
+    try:
+        return os.stat(path).st_ino == os.fstat(f.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def dump(result):
+    body, status, headers = result
+    meta = {
+        't': time.time(), 'status': status, 'headers': headers,
+        'length': len(body),
+    }
+    return json.dumps(meta).encode() + b'\n' + body
+
+
+def load(data, arrived_at):
+    # a response finished before the request arrived may miss rows it
+    # has to see, so only a later one is used
+    try:
+        meta, body = data.split(b'\n', 1)
+        meta = json.loads(meta)
+    except ValueError:
+        return None
+    # cut short when the worker writing it died
+    if meta['t'] < arrived_at or len(body) != meta['length']:
+        return None
+    return body, meta['status'], [tuple(x) for x in meta['headers']]
+
+
+coalescer = Coalescer()
+
+
+def coalesce(func):
+    # identical requests running at the same time share one call of the
+    # view; goes inside cache_response, which only stores what the
+    # leading request marks cacheable
+    @wraps(func)
+    def inner(*args, **kwargs):
+        def call():
+            resp, status_code = func(*args, **kwargs)
+            return resp.get_data(), status_code, list(resp.headers.items())
+
+        body, status_code, headers = coalescer.run(request_key(), call)
+        return Response(body, headers=headers), status_code
+    return inner
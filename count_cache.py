@@ -0,0 +1,86 @@
+import os
+import time
+from collections import OrderedDict
+
+TTL = int(os.environ.get('COUNT_CACHE_TTL', 300))
+MAX_ENTRIES = int(os.environ.get('COUNT_CACHE_MAX_ENTRIES', 1024))
+
+# exact: always run COUNT(*)
+# cached: reuse a fresh entry, counting only rows newer than it
+# estimate: reuse any entry however stale, else ask for an estimate
+MODES = ('exact', 'cached', 'estimate')
+
+
+def normalize(dic):
+    if dic is None:
+        return ()
+    return tuple(
+        (k, tuple(sorted(set(x.lower() for x in dic.get(k, [])))))
+        for k in ('and', 'or', 'ex')
+    )
+
+
+class CountCache:
+    def __init__(self, ttl=TTL, max_entries=MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def put(self, key, count, head_id, cached_at):
+        self.entries[key] = (count, head_id, cached_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+
+    def get(self, key, head_id, mode='cached'):
+        # returns (count, since_id); when since_id is not None the rows with
+        # since_id < id <= head_id still have to be counted and added.
+        # (None, None) means nothing usable is cached.
+        entry = self.entries.get(key)
+        if entry is None:
+            return None, None
+        count, cached_head_id, cached_at = entry
+
+        if mode == 'estimate':
+            return count, None
+        if mode == 'exact' or time.time() - cached_at > self.ttl or \
+                cached_head_id > head_id:
+            return None, None
+
+        self.entries.move_to_end(key)
+        if cached_head_id == head_id:
+            return count, None
+        # images are append-only: only count what came after
+        return count, cached_head_id
+
+    def extend(self, key, count, head_id):
+        # keep the original timestamp so the TTL still forces a full recount
+        entry = self.entries.get(key)
+        cached_at = entry[2] if entry is not None else time.time()
+        self.put(key, count, head_id, cached_at)
+
+    def lookup(self, key, head_id, count_range, mode='cached', estimate=None):
+        # count_range(since_id, max_id) counts matching rows with
+        # since_id < id <= max_id, since_id=None meaning from the start
+        count, since_id = self.get(key, head_id, mode)
+        if count is not None:
+            if since_id is not None:
+                count += count_range(since_id, head_id)
+                self.extend(key, count, head_id)
+            return count
+
+        if mode == 'estimate' and estimate is not None:
+            return estimate()
+
+        count = count_range(None, head_id)
+        self.put(key, count, head_id, time.time())
+        return count
+
+
+cache = CountCache()
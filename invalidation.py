@@ -0,0 +1,97 @@
+import os
+import time
+
+# Writes bump a generation that every worker compares with the one it
+# has seen, dropping its own caches when it moved. The generation lives
+# in a uWSGI cache (the `responses` cache2 of uwsgi.ini by default), or
+# in a file whose contents change with every write. A generation starts
+# with the time of the write.
+
+GENERATION_KEY = '__data_generation__'
+UWSGI_CACHE = os.environ.get(
+    'INVALIDATION_UWSGI_CACHE',
+    os.environ.get('RESPONSE_CACHE_UWSGI', '') or 'responses')
+# used instead of the uWSGI cache when set, and outside uWSGI
+GENERATION_PATH = os.environ.get('INVALIDATION_PATH', '')
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+_seen = None
+_cache_ok = None
+
+
+def _cache():
+    # the uWSGI cache to keep the generation in, or None
+    global _cache_ok
+    if GENERATION_PATH or uwsgi is None or not UWSGI_CACHE:
+        return None
+    if _cache_ok is None:
+        try:
+            uwsgi.cache_exists(GENERATION_KEY, UWSGI_CACHE)
+            _cache_ok = True
+        except Exception:
+            # no cache of that name in uwsgi.ini
+            _cache_ok = False
+    return UWSGI_CACHE if _cache_ok else None
+
+
+def available():
+    # whether a write reaches every worker; a single process needs nothing
+    if GENERATION_PATH or _cache() is not None:
+        return True
+    return uwsgi is None or uwsgi.numproc <= 1
+
+
+def _read():
+    if GENERATION_PATH:
+        try:
+            with open(GENERATION_PATH, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+    return uwsgi.cache_get(GENERATION_KEY, UWSGI_CACHE)
+
+
+def bump():
+    global _seen
+    generation = f'{time.time():.6f} {os.urandom(8).hex()}'.encode()
+    if GENERATION_PATH:
+        tmp = f'{GENERATION_PATH}.{os.getpid()}'
+        with open(tmp, 'wb') as f:
+            f.write(generation)
+        os.replace(tmp, GENERATION_PATH)
+    elif _cache() is not None:
+        uwsgi.cache_update(GENERATION_KEY, generation, 0, UWSGI_CACHE)
+    _seen = generation
+
+
+def written_at():
+    # when the last write this worker knows of was made, by itself or by
+    # another worker as seen by changed(); 0 before any
+    try:
+        return float(_seen.split()[0])
+    except (AttributeError, IndexError, ValueError):
+        return 0.0
+
+
+def changed():
+    # True once for every write made by another worker since the last call
+    global _seen
+    if not GENERATION_PATH and _cache() is None:
+        return False
+    generation = _read()
+    if generation == _seen:
+        return False
+    _seen = generation
+    return True
+
+
+def moved():
+    # whether another worker wrote since the last changed(), which stays
+    # to be called; what a request read before that must not be cached
+    if not GENERATION_PATH and _cache() is None:
+        return False
+    return _read() != _seen
@@ -0,0 +1,142 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+import MySQLdb
+from flask import g, request, Response, has_request_context
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+@contextmanager
+def span(name):
+    if not has_request_context():
+        yield
+        return
+    t_s = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = g.setdefault('timings', {})
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - t_s
+
+
+class TimedDictCursor(MySQLdb.cursors.DictCursor):
+    # the result set is read from the server in execute()
+    def execute(self, query, args=None):
+        with span('db'):
+            return super().execute(query, args)
+
+    def executemany(self, query, args):
+        with span('db'):
+            return super().executemany(query, args)
+
+    def fetchone(self):
+        with span('fetch'):
+            return super().fetchone()
+
+    def fetchmany(self, size=None):
+        with span('fetch'):
+            return super().fetchmany(size)
+
+    def fetchall(self):
+        with span('fetch'):
+            return super().fetchall()
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for le, n in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += n
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+def worker_label():
+    # a scrape reaches one worker; the label keeps the series of each
+    # apart, so that they only ever go up and can be summed
+    worker = uwsgi.worker_id() if uwsgi is not None else os.getpid()
+    return f'worker="{worker}"'
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.spans = {}
+
+    def observe(self, route, total, timings):
+        with self.lock:
+            self.requests.setdefault(route, Histogram()).observe(total)
+            for name, value in timings.items():
+                self.spans.setdefault((route, name), Histogram()) \
+                    .observe(value)
+
+    def render(self):
+        worker = worker_label()
+        lines = [
+            '# TYPE sukui_request_duration_seconds histogram',
+        ]
+        with self.lock:
+            for route, h in sorted(self.requests.items()):
+                lines += h.render(
+                    'sukui_request_duration_seconds',
+                    f'{worker},route="{route}"')
+            lines.append('# TYPE sukui_span_duration_seconds histogram')
+            for (route, name), h in sorted(self.spans.items()):
+                lines += h.render(
+                    'sukui_span_duration_seconds',
+                    f'{worker},route="{route}",span="{name}"')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def server_timing(timings, total):
+    return ', '.join(
+        [f'{name};dur={value * 1000:.3f}' for name, value in timings.items()]
+        + [f'total;dur={total * 1000:.3f}']
+    )
+
+
+def init_app(app):
+    @app.before_request
+    def start_timer():
+        g.timings = {}
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_timings(response):
+        total = time.perf_counter() - g.request_started
+        timings = g.get('timings', {})
+        response.headers['Server-Timing'] = server_timing(timings, total)
+        if request.endpoint not in (None, 'metrics'):
+            registry.observe(request.endpoint, total, timings)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        # each uWSGI worker keeps its own numbers, labelled with it
+        return Response(registry.render(), mimetype='text/plain')
@@ -1,9 +1,22 @@
+import argparse
 import os
 import re
+import threading
+from functools import partial
+from multiprocessing import Pool
 import MySQLdb
 from unicodedata import normalize
 from dotenv import load_dotenv, find_dotenv
-load_dotenv(find_dotenv())
+if __name__ == '__main__':
+    # run as a script; imported, the API has loaded it
+    load_dotenv(find_dotenv())
+from term_stats import TermStats, STATS_PATH
+import related
+
+BATCH_SIZE = 1000
+WORKERS = int(os.environ.get('NGRAM_WORKERS', os.cpu_count() or 1))
+UNIGRAM_TABLE = os.environ.get('UNIGRAM_TABLE', '')
+UNIGRAM_PROGRESS_TABLE = f'{UNIGRAM_TABLE}_progress'
 
 
 def connect_db():
@@ -41,26 +54,333 @@ def ngram(text):
     return ' '.join([x + y for x, y in zip(without_space, without_space[1:])])
 
 
-def main():
-    c = db()
-    c.execute('BEGIN')
+def unigrams(text):
+    # matched with `ch = %s`, so the table collation decides about case
+    return {x for x in text if x not in ' \t\r\n'}
+
+
+def table_exists(c, name):
+    # SHOW TABLES LIKE would take the _ of a name for a wildcard
+    c.execute(
+        'SELECT 1 FROM information_schema.TABLES '
+        'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+        (name,))
+    return c.fetchone() is not None
+
+
+def create_unigram_table(c):
+    # the migration run by `ngram.py --create-unigram-table`; the fill
+    # progress starts at 0 even for a table an older run left behind
+    if not table_exists(c, UNIGRAM_TABLE):
+        c.execute(f'''
+        CREATE TABLE {UNIGRAM_TABLE} (
+            ch VARCHAR(1) NOT NULL,
+            image_id INT NOT NULL,
+            PRIMARY KEY (ch, image_id),
+            KEY (image_id)
+        ) DEFAULT CHARSET=utf8mb4
+        ''')
+    if not table_exists(c, UNIGRAM_PROGRESS_TABLE):
+        c.execute(f'''
+        CREATE TABLE {UNIGRAM_PROGRESS_TABLE} (
+            id TINYINT NOT NULL PRIMARY KEY,
+            filled_id INT NOT NULL
+        )
+        ''')
+        c.execute(
+            f'INSERT INTO {UNIGRAM_PROGRESS_TABLE} (id, filled_id) '
+            'VALUES (1, 0)')
+
+
+def read_unigram_progress(c):
+    # every image_info row up to the returned id has its unigrams; None
+    # until the migration ran
+    if not table_exists(c, UNIGRAM_PROGRESS_TABLE):
+        return None
+    c.execute(f'SELECT filled_id FROM {UNIGRAM_PROGRESS_TABLE}')
+    return c.fetchone()[0]
+
+
+def unigrams_filled(c):
+    # whether every image_info row has its unigrams, so that the table
+    # can be searched; None until the migration ran
+    filled_id = read_unigram_progress(c)
+    if filled_id is None:
+        return None
+    c.execute('SELECT MAX(id) FROM image_info')
+    return filled_id >= (c.fetchone()[0] or 0)
+
+
+def fill_unigrams(c, batch_size=BATCH_SIZE):
+    # fills the unigrams of the next image_info rows above the progress,
+    # however they were inserted; c is a DictCursor and the caller
+    # commits. Returns whether no rows are left, or None before the
+    # migration ran
+    if not table_exists(c, UNIGRAM_PROGRESS_TABLE):
+        return None
+    c.execute(f'SELECT filled_id FROM {UNIGRAM_PROGRESS_TABLE} FOR UPDATE')
+    row = c.fetchone()
+    if row is None:
+        return None
+    c.execute(
+        'SELECT id, image_id, comment FROM image_info WHERE id > %s '
+        'ORDER BY id LIMIT %s',
+        (row['filled_id'], batch_size))
+    rows = c.fetchall()
+    if rows:
+        update_unigrams(c, [
+            {'image_id': x['image_id'], 'comment': x['comment'] or ''}
+            for x in rows
+        ])
+        c.execute(
+            f'UPDATE {UNIGRAM_PROGRESS_TABLE} SET filled_id = %s',
+            (rows[-1]['id'],))
+    return len(rows) < batch_size
+
+
+def update_unigrams(c, rows):
+    image_ids = [row['image_id'] for row in rows]
+    c.execute(
+        f'DELETE FROM {UNIGRAM_TABLE} '
+        f"WHERE image_id IN ({', '.join(['%s'] * len(image_ids))})",
+        image_ids)
+    c.executemany(
+        f'INSERT IGNORE INTO {UNIGRAM_TABLE} (ch, image_id) VALUES (%s, %s)',
+        [(ch, row['image_id'])
+         for row in rows for ch in unigrams(row['comment'])])
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def write_checkpoint(path, last_id):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(str(last_id))
+    os.replace(tmp, path)
+
+
+def iter_batches(conn, since_id=0, changed_since=None, batch_size=BATCH_SIZE):
+    # stream rows with a server-side cursor instead of fetchall()
+    c = conn.cursor(MySQLdb.cursors.SSDictCursor)
+    query = ('SELECT ii.id, ii.image_id, ii.comment, ii.comment_ngram '
+             'FROM image_info ii')
+    conditions = ['ii.comment IS NOT NULL', 'ii.id > %s']
+    args = [since_id]
+    if changed_since is not None:
+        query += ' JOIN images i ON i.id = ii.image_id'
+        conditions.append('i.created_at >= %s')
+        args.append(changed_since)
+    query += f" WHERE {' AND '.join(conditions)} ORDER BY ii.id"
+    c.execute(query, args)
+    try:
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        c.close()
+
+
+def changed_rows(rows, force=False):
+    ret = []
+    for row in rows:
+        comment_ngram = ngram(row['comment'])
+        if force or row['comment_ngram'] != comment_ngram:
+            ret.append((comment_ngram, row['id']))
+    return ret
+
+
+def process_batch(rows, force=False, with_stats=False, unigrams_upto=None,
+                  with_signatures=False):
+    # runs in the worker processes; returns what the writer needs
+    params = changed_rows(rows, force)
+    targets = []
+    if unigrams_upto is not None:
+        # rows above it are left to fill_unigrams
+        changed = {i for _, i in params}
+        targets = [
+            row for row in rows
+            if row['id'] in changed and row['id'] <= unigrams_upto
+        ]
+    stats = None
+    if with_stats:
+        stats = TermStats()
+        for row in rows:
+            stats.add(row['image_id'], row['comment'])
+    signatures = []
+    if with_signatures:
+        # bigrams split like search_index.tokenize does
+        signatures = [
+            (row['image_id'], related.signature(
+                set(ngram(row['comment'].lower()).split())))
+            for row in rows
+        ]
+    return rows[-1]['id'], params, targets, stats, signatures
+
+
+def bounded(batches, slots, stop):
+    # the reader blocks here once every slot holds a batch that the
+    # writer has not committed yet
     try:
-        c.execute('SELECT id, comment FROM image_info '
-                  'WHERE comment IS NOT NULL')
-        for row in c.fetchall():
-            # comment_norm = normalize('NFKD', row['comment'])
-            comment_norm = row['comment']
-            c.execute('UPDATE image_info SET '
-                      'comment = %s, comment_ngram = %s '
-                      f'WHERE id = {row["id"]}',
-                      (comment_norm, ngram(comment_norm),))
-    except Exception:
+        for rows in batches:
+            slots.acquire()
+            if stop.is_set():
+                break
+            yield rows
+    finally:
+        batches.close()
+
+
+def reindex(since_id=0, changed_since=None, batch_size=BATCH_SIZE,
+            checkpoint=None, force=False, stats_path=None, workers=WORKERS,
+            related_path=None):
+    workers = max(1, workers)
+    # fork the workers before any connection is opened
+    pool = Pool(workers) if workers > 1 else None
+    # reading and writing need separate connections while the
+    # server-side cursor is open
+    reader = connect_db()
+    writer = connect_db()
+    c = writer.cursor()
+    updated = 0
+    # document frequencies are only complete when every row is read
+    stats = None
+    if stats_path and since_id == 0 and changed_since is None:
+        stats = TermStats()
+    # the related-images index likewise
+    signatures = None
+    if related_path and since_id == 0 and changed_since is None:
+        signatures = related.Builder()
+    # the unigrams of changed rows below the fill progress are rewritten
+    # here, the rest is filled afterwards
+    unigrams_upto = None
+    if UNIGRAM_TABLE:
+        unigrams_upto = read_unigram_progress(c)
+        if unigrams_upto is None:
+            print(f'{UNIGRAM_TABLE} is not filled: '
+                  'run ngram.py --create-unigram-table first')
+    process = partial(
+        process_batch, force=force, with_stats=stats is not None,
+        unigrams_upto=unigrams_upto,
+        with_signatures=signatures is not None)
+    slots = threading.Semaphore(2 * workers)
+    stop = threading.Event()
+    batches = bounded(
+        iter_batches(reader, since_id, changed_since, batch_size),
+        slots, stop)
+    try:
+        if pool is not None:
+            # imap keeps the batch order, so checkpoints stay monotonic
+            results = pool.imap(process, batches)
+        else:
+            results = map(process, batches)
+        for last_id, params, targets, batch_stats, batch_signatures \
+                in results:
+            if batch_stats is not None:
+                stats.merge(batch_stats)
+            for image_id, sig in batch_signatures:
+                signatures.add(image_id, sig)
+            if params:
+                c.executemany(
+                    'UPDATE image_info SET comment_ngram = %s WHERE id = %s',
+                    params)
+            if targets:
+                update_unigrams(c, targets)
+            writer.commit()
+            slots.release()
+            updated += len(params)
+            if checkpoint:
+                write_checkpoint(checkpoint, last_id)
+            print(f'{last_id}: {updated} rows updated')
+        if unigrams_upto is not None:
+            c = writer.cursor(MySQLdb.cursors.DictCursor)
+            while True:
+                done = fill_unigrams(c, batch_size)
+                writer.commit()
+                if done is not False:
+                    break
+                print(f'{UNIGRAM_TABLE}: {batch_size} rows filled')
+    except BaseException:
         print('ROLLBACK')
-        c.execute('ROLLBACK')
+        writer.rollback()
+        # let a reader blocked on a slot see the stop flag
+        stop.set()
+        for _ in range(2 * workers):
+            slots.release()
         raise
-    else:
-        print('COMMIT')
-        c.execute('COMMIT')
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        reader.close()
+        writer.close()
+    if stats is not None:
+        stats.save(stats_path)
+    if signatures is not None:
+        signatures.save(related_path)
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Fill image_info.comment_ngram in id-ordered batches.')
+    parser.add_argument('--since-id', type=int,
+                        help='only reindex image_info rows with a larger id')
+    parser.add_argument('--changed-since', metavar='DATETIME',
+                        help='only reindex images created at or after this')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--checkpoint', metavar='PATH',
+                        help='file recording the last committed id; '
+                        'a run resumes from it when --since-id is omitted')
+    parser.add_argument('--force', action='store_true',
+                        help='rewrite rows whose comment_ngram is up to date')
+    parser.add_argument('--stats', metavar='PATH', default=STATS_PATH,
+                        help='write term statistics for the query planner; '
+                        'only done on runs covering the whole table')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='processes computing comment_ngram; '
+                        '1 does everything in this process')
+    parser.add_argument('--related', metavar='PATH',
+                        default=related.INDEX_PATH,
+                        help='write the index behind /image/<id>/related; '
+                        'only done on runs covering the whole table')
+    parser.add_argument('--create-unigram-table', action='store_true',
+                        help='create UNIGRAM_TABLE and exit; the next run '
+                        'fills it from the first row')
+    args = parser.parse_args()
+
+    if args.create_unigram_table:
+        if not UNIGRAM_TABLE:
+            parser.error('UNIGRAM_TABLE is not set')
+        conn = connect_db()
+        try:
+            create_unigram_table(conn.cursor())
+            conn.commit()
+        finally:
+            conn.close()
+        return
+
+    since_id = args.since_id
+    if since_id is None and args.checkpoint:
+        since_id = read_checkpoint(args.checkpoint)
+
+    reindex(
+        since_id=since_id or 0,
+        changed_since=args.changed_since,
+        batch_size=args.batch_size,
+        checkpoint=args.checkpoint,
+        force=args.force,
+        stats_path=args.stats,
+        workers=args.workers,
+        related_path=args.related,
+    )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,219 @@
+import base64
+import binascii
+import json
+import os
+import secrets
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+WINDOW_SIZE = int(os.environ.get('PAGE_WINDOW_SIZE', 1000))
+WINDOW_TTL = int(os.environ.get('PAGE_WINDOW_TTL', 60))
+WINDOW_MAX_ENTRIES = int(os.environ.get('PAGE_WINDOW_MAX_ENTRIES', 256))
+
+# A cursor continues a listing from a boundary id, scanning either
+# upwards (asc: id > boundary) or downwards (id < boundary), while the
+# page is presented in the order the first request asked for.
+
+
+def encode(boundary, asc, _reversed, window=None):
+    dic = {'id': boundary, 'asc': int(asc), 'r': int(_reversed)}
+    if window is not None:
+        dic['w'] = window
+    raw = json.dumps(dic, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        dic = json.loads(raw)
+        boundary = int(dic['id'])
+        asc = bool(dic['asc'])
+        _reversed = bool(dic['r'])
+        window = dic.get('w')
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise ValueError('invalid cursor parameter')
+    if boundary < 0 or not (window is None or isinstance(window, str)):
+        raise ValueError('invalid cursor parameter')
+    return boundary, asc, _reversed, window
+
+
+def encode_ranked(score, boundary, backward, window=None):
+    # a cursor of order=relevance: the page before or after (score, id)
+    dic = {'s': score, 'id': boundary, 'b': int(backward)}
+    if window is not None:
+        dic['w'] = window
+    raw = json.dumps(dic, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode_ranked(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        dic = json.loads(raw)
+        score = float(dic['s'])
+        boundary = int(dic['id'])
+        backward = bool(dic['b'])
+        window = dic.get('w')
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise ValueError('invalid cursor parameter')
+    if not (window is None or isinstance(window, str)):
+        raise ValueError('invalid cursor parameter')
+    return score, boundary, backward, window
+
+
+def to_range(boundary, asc):
+    # (max_id, since_id) as understood by build_range_query
+    if asc:
+        return None, boundary
+    return boundary - 1, None
+
+
+def cursors(ids, count, asc, _reversed, window=None, since_id=None,
+            exhausted=None):
+    # ids are the page in scan order; returns (next_cursor, prev_cursor)
+    # where next continues in the presentation order. exhausted tells
+    # whether the scan ran out of rows, which by default is assumed when
+    # the page has fewer than count ids.
+    if exhausted is None:
+        exhausted = len(ids) < count
+    if ids:
+        older = encode(min(ids), False, _reversed, window)
+        if not asc and exhausted:
+            older = None
+        newer = encode(max(ids), True, _reversed, window)
+    else:
+        older = None
+        # an empty page going up can be polled again for newer rows
+        newer = encode(since_id or 0, True, _reversed, window) \
+            if asc else None
+    if _reversed:
+        return newer, older
+    return older, newer
+
+
+class Window:
+    # every matching id with lo < id <= hi, ascending
+    def __init__(self, key, ids, lo, hi):
+        self.key = key
+        self.ids = ids
+        self.lo = lo
+        self.hi = hi
+
+    def page(self, count, max_id, since_id, asc):
+        # ids of the page in scan order, or None if the window cannot
+        # tell the answer
+        ids = self.ids
+        if asc:
+            if since_id is None or not self.lo <= since_id < self.hi:
+                return None
+            top = self.hi if max_id is None else min(self.hi, max_id)
+            i = bisect_right(ids, since_id)
+            ret = list(ids[i:min(bisect_right(ids, top), i + count)])
+            if len(ret) < count and (max_id is None or max_id > self.hi):
+                return None
+            return ret
+
+        if max_id is None or not self.lo < max_id <= self.hi:
+            return None
+        bottom = self.lo if since_id is None else max(self.lo, since_id)
+        j = bisect_right(ids, max_id)
+        ret = list(reversed(ids[max(bisect_right(ids, bottom), j - count):j]))
+        if len(ret) < count and self.lo > (since_id or 0):
+            return None
+        return ret
+
+
+def build_window(key, fetched, limit, max_id, since_id, asc):
+    # fetched: the first `limit` matching ids of the range in scan order
+    complete = len(fetched) < limit
+    if asc:
+        lo = since_id or 0
+        if complete and max_id is not None:
+            hi = max_id
+        elif fetched:
+            hi = fetched[-1]
+        else:
+            return None
+        ids = array('I', fetched)
+    else:
+        if max_id is not None:
+            hi = max_id
+        elif fetched:
+            hi = fetched[0]
+        else:
+            return None
+        lo = (since_id or 0) if complete else fetched[-1] - 1
+        ids = array('I', reversed(fetched))
+    return Window(key, ids, lo, hi)
+
+
+class Ranking:
+    # the best matches of a search, best first: by score, then newest
+    def __init__(self, key, scores, ids, truncated=False):
+        self.key = key
+        # whether matches ranked lower were left out
+        self.truncated = truncated
+        order = sorted(range(len(ids)), key=lambda i: (-scores[i], -ids[i]))
+        self.scores = [scores[i] for i in order]
+        self.ids = [ids[i] for i in order]
+        self.keys = [(-scores[i], -ids[i]) for i in order]
+
+    def page(self, count, cursor=None):
+        # (start, end) of the page after, or with backward before, the
+        # (score, id) of a cursor; works for a ranking made again since
+        if cursor is None:
+            return 0, min(count, len(self.ids))
+        score, boundary, backward = cursor
+        if backward:
+            end = bisect_left(self.keys, (-score, -boundary))
+            return max(0, end - count), end
+        start = bisect_right(self.keys, (-score, -boundary))
+        return start, min(start + count, len(self.ids))
+
+    def cursors(self, start, end, window=None):
+        # (next_cursor, prev_cursor) of the page ids[start:end]
+        next_cursor = prev_cursor = None
+        if start < end < len(self.ids):
+            next_cursor = encode_ranked(
+                self.scores[end - 1], self.ids[end - 1], False, window)
+        if 0 < start < end:
+            prev_cursor = encode_ranked(
+                self.scores[start], self.ids[start], True, window)
+        return next_cursor, prev_cursor
+
+
+class WindowCache:
+    def __init__(self, ttl=WINDOW_TTL, max_entries=WINDOW_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def put(self, window):
+        window_id = secrets.token_urlsafe(6)
+        self.entries[window_id] = (window, time.time())
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return window_id
+
+    def get(self, window_id, key):
+        # windows live in one worker; another worker just misses
+        entry = self.entries.get(window_id)
+        if entry is None:
+            return None
+        window, cached_at = entry
+        if time.time() - cached_at > self.ttl:
+            del self.entries[window_id]
+            return None
+        if window.key != key:
+            return None
+        self.entries.move_to_end(window_id)
+        return window
+
+    def invalidate(self):
+        self.entries.clear()
+
+
+windows = WindowCache()
@@ -0,0 +1,110 @@
+import utils
+from utils import build_search_query_from_dic, build_match_unit
+
+
+def contains(text, term):
+    return term.lower() in text.lower()
+
+
+def unique(terms):
+    ret = []
+    seen = set()
+    for term in terms:
+        if term.lower() not in seen:
+            seen.add(term.lower())
+            ret.append(term)
+    return ret
+
+
+def like_only(term):
+    # build_match_unit cannot use an index for these
+    return len(term) <= 1 and '♂' in term and not utils.use_unigrams()
+
+
+def plan(dic, stats=None):
+    and_terms = unique(dic.get('and', []))
+    or_terms = unique(dic.get('or', []))
+    ex_terms = unique(dic.get('ex', []))
+    ret = {
+        'and': [], 'or': [], 'ex': [],
+        'prefilter': None,
+        'empty': False,
+    }
+
+    # "奈緒" is implied by "奈緒ちゃん", and excluding "奈" excludes "奈緒"
+    and_terms = [
+        t for i, t in enumerate(and_terms)
+        if not any(j != i and contains(u, t) for j, u in enumerate(and_terms))
+    ]
+    ex_terms = [
+        u for i, u in enumerate(ex_terms)
+        if not any(j != i and contains(u, t) for j, t in enumerate(ex_terms))
+    ]
+    if any(contains(u, t) for u in and_terms for t in ex_terms):
+        ret['empty'] = True
+        return ret
+
+    if or_terms:
+        or_terms = [
+            o for o in or_terms
+            if not any(contains(o, t) for t in ex_terms)
+        ]
+        if not or_terms:
+            ret['empty'] = True
+            return ret
+        # "仁奈 OR 仁奈ちゃん" is just "仁奈"
+        or_terms = [
+            u for i, u in enumerate(or_terms)
+            if not any(
+                j != i and contains(u, t) for j, t in enumerate(or_terms))
+        ]
+        if any(contains(u, o) for u in and_terms for o in or_terms):
+            or_terms = []
+
+    if stats is not None:
+        # rarest AND term first; the most common OR term first so that
+        # the OR group is settled as early as possible
+        and_terms.sort(key=stats.estimate)
+        or_terms.sort(key=stats.estimate, reverse=True)
+
+        # estimates only order the terms: fold() is not the collation,
+        # so one of 0 does not mean the term has no hits
+
+        if and_terms and not like_only(and_terms[0]):
+            ret['prefilter'] = and_terms[0]
+
+    ret['and'] = and_terms
+    ret['or'] = or_terms
+    ret['ex'] = ex_terms
+    return ret
+
+
+def needs_verification(plan):
+    # whether build_query(plan, exact=False) can return false positives
+    return any(
+        utils.match_kind(t) == 'phrase' for t in plan['and'] + plan['or'])
+
+
+def verify(plan, comment):
+    # the LIKE checks left out by build_query(plan, exact=False);
+    # exclusions are always done in SQL
+    comment = comment or ''
+    return all(contains(comment, a) for a in plan['and']) and \
+        (not plan['or'] or any(contains(comment, o) for o in plan['or']))
+
+
+def build_query(plan, exact=True):
+    # returns (join, where, params), params in the order they appear
+    where, params = build_search_query_from_dic(plan, exact)
+
+    join = ''
+    if plan['prefilter'] is not None:
+        unit, unit_params = build_match_unit(plan['prefilter'], exact=exact)
+        join = f'''
+    JOIN (
+        SELECT ii.image_id FROM image_info ii
+        WHERE {unit}
+    ) AS prefilter
+    ON prefilter.image_id = i.id'''
+        params = unit_params + params
+    return join, where, params
@@ -0,0 +1,121 @@
+import os
+import time
+import threading
+from collections import deque
+import MySQLdb
+
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 4))
+# connections opened right after a worker is forked
+POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+POOL_MAX_LIFETIME = int(os.environ.get('DB_POOL_MAX_LIFETIME', 3600))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, connect, max_size=POOL_SIZE,
+                 max_lifetime=POOL_MAX_LIFETIME, timeout=POOL_TIMEOUT):
+        self.connect = connect
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self.idle = deque()
+        self.created_at = {}
+        self.size = 0
+        self.cond = threading.Condition()
+
+    def _open(self):
+        conn = self.connect()
+        self.created_at[id(conn)] = time.time()
+        return conn
+
+    def discard(self, conn):
+        self.created_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    def _expired(self, conn):
+        created_at = self.created_at.get(id(conn), 0)
+        return time.time() - created_at > self.max_lifetime
+
+    def checkout(self):
+        deadline = time.time() + self.timeout
+        while True:
+            with self.cond:
+                if self.idle:
+                    conn = self.idle.pop()
+                elif self.size < self.max_size:
+                    self.size += 1
+                    conn = None
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeout('no database connection available')
+                    self.cond.wait(remaining)
+                    continue
+
+            if conn is None:
+                try:
+                    return self._open()
+                except Exception:
+                    with self.cond:
+                        self.size -= 1
+                        self.cond.notify()
+                    raise
+
+            if self._expired(conn):
+                self.discard(conn)
+                continue
+            try:
+                conn.ping()
+            except MySQLdb.Error:
+                self.discard(conn)
+                continue
+            return conn
+
+    def checkin(self, conn):
+        try:
+            # end the transaction so the next request sees fresh data
+            conn.rollback()
+        except MySQLdb.Error:
+            self.discard(conn)
+            return
+        if self._expired(conn):
+            self.discard(conn)
+            return
+        with self.cond:
+            self.idle.append(conn)
+            self.cond.notify()
+
+    def fill(self, n=POOL_MIN_SIZE):
+        # open up to n idle connections ahead of the first request
+        while True:
+            with self.cond:
+                if self.size >= min(n, self.max_size):
+                    return
+                self.size += 1
+            try:
+                conn = self._open()
+            except Exception:
+                with self.cond:
+                    self.size -= 1
+                    self.cond.notify()
+                raise
+            with self.cond:
+                self.idle.append(conn)
+                self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            idle, self.idle = self.idle, deque()
+        for conn in idle:
+            self.discard(conn)
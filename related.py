@@ -0,0 +1,174 @@
+import os
+import mmap
+import struct
+import time
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from functools import lru_cache
+from hashlib import shake_128
+from operator import eq
+
+# written by `ngram.py --related`, memory-mapped by the API workers
+INDEX_PATH = os.environ.get('RELATED_INDEX_PATH', '')
+CHECK_INTERVAL = int(os.environ.get('RELATED_INDEX_CHECK_INTERVAL', 60))
+HASHES = 32
+BANDS = 16
+# ids taken from one bucket; a crowded bucket gives its newest images
+BUCKET_LIMIT = int(os.environ.get('RELATED_BUCKET_LIMIT', 200))
+# candidates sharing the most buckets whose whole signatures are compared
+RERANK = int(os.environ.get('RELATED_RERANK', 200))
+
+# Every comment gets a MinHash signature of its bigrams: the share of
+# equal positions in two signatures estimates the Jaccard index of the
+# bigram sets. Signatures are cut into bands, and images whose band
+# hashes to the same key are candidates (LSH).
+#
+# file layout, native byte order:
+#   header      magic, hashes, bands, n
+#   ids         n x uint32, ascending
+#   signatures  n x hashes x uint32, in the order of ids
+#   (padding to 8 bytes)
+#   buckets     bands x n x uint64, sorted; key << 32 | position in ids
+
+MAGIC = b'SKRL'
+HEADER = struct.Struct('<4sIII')
+
+
+@lru_cache(maxsize=1 << 16)
+def _hashes(bigram, hashes):
+    return array('I', shake_128(bigram.encode()).digest(4 * hashes))
+
+
+def signature(bigrams, hashes=HASHES):
+    # bigrams as split by ngram.ngram; None when there are none
+    values = [_hashes(x, hashes) for x in bigrams]
+    if not values:
+        return None
+    if len(values) == 1:
+        return array('I', values[0])
+    return array('I', map(min, *values))
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def band_key(sig, band, rows):
+    return zlib.crc32(sig[band * rows:(band + 1) * rows].tobytes())
+
+
+class Builder:
+    def __init__(self, hashes=HASHES, bands=BANDS):
+        self.hashes = hashes
+        self.bands = bands
+        self.ids = array('I')
+        self.signatures = array('I')
+
+    def add(self, image_id, sig):
+        if sig is None:
+            return
+        self.ids.append(image_id)
+        self.signatures.extend(sig)
+
+    def save(self, path):
+        hashes, rows = self.hashes, self.hashes // self.bands
+        n = len(self.ids)
+        order = sorted(range(n), key=self.ids.__getitem__)
+        ids = array('I', (self.ids[i] for i in order))
+        signatures = array('I')
+        for i in order:
+            signatures.extend(self.signatures[i * hashes:(i + 1) * hashes])
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, hashes, self.bands, n))
+            ids.tofile(f)
+            signatures.tofile(f)
+            f.write(b'\0' * (-f.tell() % 8))
+            for band in range(self.bands):
+                array('Q', sorted(
+                    band_key(signatures[pos * hashes:(pos + 1) * hashes],
+                             band, rows) << 32 | pos
+                    for pos in range(n)
+                )).tofile(f)
+        os.replace(tmp, path)
+
+
+class RelatedIndex:
+    def __init__(self, buf):
+        magic, hashes, bands, n = HEADER.unpack_from(buf)
+        ids_at = HEADER.size
+        signatures_at = ids_at + 4 * n
+        buckets_at = signatures_at + 4 * n * hashes
+        buckets_at += -buckets_at % 8
+        if magic != MAGIC or hashes % bands or \
+                len(buf) != buckets_at + 8 * n * bands:
+            raise ValueError('broken related index')
+        view = memoryview(buf)
+        self.hashes = hashes
+        self.bands = bands
+        self.rows = hashes // bands
+        self.ids = view[ids_at:signatures_at].cast('I')
+        self.signatures = view[signatures_at:signatures_at + 4 * n * hashes] \
+            .cast('I')
+        self.buckets = [
+            view[buckets_at + 8 * n * b:buckets_at + 8 * n * (b + 1)]
+            .cast('Q')
+            for b in range(bands)
+        ]
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def related(self, sig, count, exclude=None):
+        # [(image_id, similarity)], most similar first
+        if sig is None or len(sig) != self.hashes:
+            return []
+        hits = Counter()
+        for band, bucket in enumerate(self.buckets):
+            key = band_key(sig, band, self.rows) << 32
+            lo = bisect_left(bucket, key)
+            hi = bisect_left(bucket, key + (1 << 32), lo)
+            hits.update(x & 0xffffffff
+                        for x in bucket[max(lo, hi - BUCKET_LIMIT):hi])
+
+        hashes = self.hashes
+        ranked = []
+        for pos, _ in hits.most_common(RERANK + 1):
+            image_id = self.ids[pos]
+            if image_id == exclude:
+                continue
+            other = self.signatures[pos * hashes:(pos + 1) * hashes]
+            ranked.append((sum(map(eq, sig, other)) / hashes, image_id))
+        ranked.sort(reverse=True)
+        return [(image_id, score) for score, image_id in ranked[:count]]
+
+
+_index = None
+_mtime = None
+_checked_at = 0.0
+
+
+def get_index():
+    global _index, _mtime, _checked_at
+    if not INDEX_PATH:
+        return None
+    now = time.time()
+    if now - _checked_at < CHECK_INTERVAL:
+        return _index
+    _checked_at = now
+    try:
+        mtime = os.stat(INDEX_PATH).st_mtime
+        if mtime != _mtime:
+            # the old mapping stays valid for requests still using it
+            _index = RelatedIndex.open(INDEX_PATH)
+            _mtime = mtime
+    except (OSError, ValueError, struct.error):
+        _index = None
+        _mtime = None
+    return _index
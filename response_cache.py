@@ -0,0 +1,158 @@
+import os
+import hashlib
+import math
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+from flask import request, Response, g
+import invalidation
+
+MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# for browsers and proxies; 0 sends no-cache, so that they revalidate
+# with the ETag and see an edit right away
+MAX_AGE = int(os.environ.get('RESPONSE_CACHE_MAX_AGE', 0))
+# how long the server keeps a response, whose whole_count and
+# elapsed_time are as old as it
+TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 60))
+# name of a uWSGI cache (cache2 in uwsgi.ini) shared by all workers
+UWSGI_CACHE = os.environ.get('RESPONSE_CACHE_UWSGI', '')
+
+GENERATION_KEY = '__generation__'
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+
+class UwsgiStore:
+    def __init__(self, name):
+        self.name = name
+
+    def get(self, key):
+        value = uwsgi.cache_get(key, self.name)
+        if value is None:
+            return None
+        meta, body = value.split(b'\n', 1)
+        etag, expires_at = meta.decode().split(' ')
+        return etag, body, float(expires_at)
+
+    def put(self, key, etag, body, expires_at):
+        uwsgi.cache_update(
+            key, f'{etag} {expires_at}'.encode() + b'\n' + body,
+            max(1, math.ceil(expires_at - time.time())), self.name)
+
+    def generation(self):
+        return uwsgi.cache_get(GENERATION_KEY, self.name)
+
+    def invalidate(self):
+        generation = os.urandom(8).hex().encode()
+        uwsgi.cache_clear(self.name)
+        uwsgi.cache_update(GENERATION_KEY, generation, 0, self.name)
+
+
+class ResponseCache:
+    # entries are (etag, body, expires_at); get and put return (etag, body)
+    def __init__(self, max_bytes=MAX_BYTES, shared=None, ttl=TTL):
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = None
+
+    def _sync(self):
+        # another worker may have invalidated the shared store
+        if self.shared is None:
+            return
+        generation = self.shared.generation()
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+    def _store(self, key, entry):
+        size = len(entry[1])
+        if size > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old[1])
+        self.entries[key] = entry
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, body, _) = self.entries.popitem(last=False)
+            self.size -= len(body)
+
+    def get(self, key):
+        self._sync()
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[2] > now:
+                self.entries.move_to_end(key)
+                return entry[:2]
+            del self.entries[key]
+            self.size -= len(entry[1])
+        if self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None and entry[2] > now:
+                self._store(key, entry)
+                return entry[:2]
+        return None
+
+    def put(self, key, body):
+        entry = (hashlib.sha1(body).hexdigest(), body, time.time() + self.ttl)
+        self._store(key, entry)
+        if self.shared is not None:
+            self.shared.put(key, *entry)
+        return entry[:2]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def invalidate(self):
+        self.clear()
+        if self.shared is not None:
+            self.shared.invalidate()
+            self.generation = self.shared.generation()
+
+
+cache = ResponseCache(
+    shared=UwsgiStore(UWSGI_CACHE) if UWSGI_CACHE and uwsgi else None)
+
+
+def request_key():
+    return request.path + '?' + urlencode(sorted(request.args.items(True)))
+
+
+def cache_response(func):
+    # views mark immutable responses with `g.cacheable = True`
+    @wraps(func)
+    def inner(*args, **kwargs):
+        key = request_key()
+        entry = cache.get(key)
+        if entry is None:
+            g.cacheable = False
+            resp, status_code = func(*args, **kwargs)
+            # an edit elsewhere while this ran may leave it out of date
+            if status_code != 200 or not g.cacheable or \
+                    invalidation.moved():
+                return resp, status_code
+            entry = cache.put(key, resp.get_data())
+
+        etag, body = entry
+        resp = Response(
+            body,
+            mimetype='application/json',
+            headers={
+                'Access-Control-Allow-Origin': '*',
+                'Cache-Control':
+                    f'public, max-age={MAX_AGE}' if MAX_AGE
+                    else 'public, no-cache',
+            },
+        )
+        resp.set_etag(etag)
+        return resp.make_conditional(request)
+    return inner
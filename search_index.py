@@ -0,0 +1,196 @@
+import os
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+import ngram
+
+REFRESH_INTERVAL = int(os.environ.get('SEARCH_INDEX_REFRESH_INTERVAL', 60))
+
+EMPTY = array('I')
+WHITESPACE = set(' \t\r\n')
+
+
+def tokenize(text):
+    # same bigram splitting as ngram.ngram, which fills comment_ngram
+    return set(ngram.ngram(text.lower()).split())
+
+
+def bigrams(text):
+    # unlike comment_ngram the index keeps URLs, since `LIKE '%term%'`
+    # finds a term inside one
+    chars = [x for x in text if x not in WHITESPACE]
+    return {x + y for x, y in zip(chars, chars[1:])}
+
+
+def keys(comment):
+    # single characters are keyed by themselves
+    return bigrams(comment) | (set(comment) - WHITESPACE)
+
+
+def remove(ids, x):
+    i = bisect_left(ids, x)
+    if i < len(ids) and ids[i] == x:
+        del ids[i]
+
+
+def intersect(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    ret = array('I')
+    j = 0
+    for x in a:
+        j = bisect_left(b, x, j)
+        if j == len(b):
+            break
+        if b[j] == x:
+            ret.append(x)
+    return ret
+
+
+def union(a, b):
+    ret = array('I')
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] < b[j]:
+            ret.append(a[i])
+            i += 1
+        elif a[i] > b[j]:
+            ret.append(b[j])
+            j += 1
+        else:
+            ret.append(a[i])
+            i += 1
+            j += 1
+    ret.extend(a[i:])
+    ret.extend(b[j:])
+    return ret
+
+
+def difference(a, b):
+    ret = array('I')
+    j = 0
+    for x in a:
+        j = bisect_left(b, x, j)
+        if j == len(b) or b[j] != x:
+            ret.append(x)
+    return ret
+
+
+def paginate(ids, count, max_id=None, since_id=None, _reversed=False):
+    lo = 0 if since_id is None else bisect_right(ids, since_id)
+    hi = len(ids) if max_id is None else bisect_right(ids, max_id)
+    if _reversed:
+        return list(ids[lo:min(hi, lo + count)])
+    return list(reversed(ids[max(lo, hi - count):hi]))
+
+
+class InvertedIndex:
+    def __init__(self):
+        self.postings = {}
+        self.comments = {}
+        self.ids = array('I')
+        self.max_id = 0
+        self.built_at = 0.0
+
+    def add(self, image_id, comment):
+        # image ids must be added in ascending order to keep postings sorted
+        comment = comment.lower()
+        self.comments[image_id] = comment
+        self.ids.append(image_id)
+        for key in keys(comment):
+            self.postings.setdefault(key, array('I')).append(image_id)
+        self.max_id = image_id
+
+    def update(self, image_id, comment):
+        # rows above max_id are left to the next load(), which would skip
+        # anything below an id added out of turn
+        if image_id > self.max_id:
+            return
+        old = self.comments.pop(image_id, None)
+        if old is not None:
+            for key in keys(old):
+                remove(self.postings[key], image_id)
+            remove(self.ids, image_id)
+        if comment is not None:
+            comment = comment.lower()
+            self.comments[image_id] = comment
+            insort(self.ids, image_id)
+            for key in keys(comment):
+                insort(self.postings.setdefault(key, array('I')), image_id)
+
+    def load(self, cursor):
+        cursor.execute(
+            'SELECT image_id, comment FROM image_info '
+            'WHERE image_id > %s AND comment IS NOT NULL '
+            'ORDER BY image_id',
+            (self.max_id,)
+        )
+        for row in cursor.fetchall():
+            self.add(row['image_id'], row['comment'])
+        self.built_at = time.time()
+
+    def match(self, term):
+        term = term.lower()
+        keys = bigrams(term) if len(term) > 1 else {term}
+        if keys:
+            postings = sorted(
+                (self.postings.get(k, EMPTY) for k in keys), key=len)
+            candidates = postings[0]
+            for p in postings[1:]:
+                if not candidates:
+                    break
+                candidates = intersect(candidates, p)
+        else:
+            candidates = self.ids
+
+        # bigrams are only a prefilter; verify like `LIKE '%term%'` does
+        comments = self.comments
+        return array('I', (i for i in candidates if term in comments[i]))
+
+    def search(self, dic):
+        ret = None
+
+        for a in dic.get('and', []):
+            ids = self.match(a)
+            ret = ids if ret is None else intersect(ret, ids)
+            if not ret:
+                return EMPTY
+
+        if dic.get('or'):
+            any_ids = array('I')
+            for o in dic['or']:
+                any_ids = union(any_ids, self.match(o))
+            ret = any_ids if ret is None else intersect(ret, any_ids)
+
+        if ret is None:
+            ret = self.ids
+
+        for ex in dic.get('ex', []):
+            if not ret:
+                break
+            ret = difference(ret, self.match(ex))
+
+        return ret
+
+
+_index = None
+
+
+def reset():
+    # rebuilt from scratch by the next get_index
+    global _index
+    _index = None
+
+
+def update(image_id, comment):
+    if _index is not None:
+        _index.update(image_id, comment)
+
+
+def get_index(cursor):
+    global _index
+    if _index is None:
+        _index = InvertedIndex()
+    if time.time() - _index.built_at > REFRESH_INTERVAL:
+        _index.load(cursor)
+    return _index
@@ -0,0 +1,401 @@
+import argparse
+import fcntl
+import mmap
+import os
+import struct
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import islice
+import MySQLdb
+from dotenv import load_dotenv, find_dotenv
+if __name__ == '__main__':
+    # run as a script; imported, the API has loaded it
+    load_dotenv(find_dotenv())
+from utils import build_images_query
+
+# written by `snapshot.py export|append`, memory-mapped by the API workers
+PATH = os.environ.get('SNAPSHOT_PATH', '')
+CHECK_INTERVAL = int(os.environ.get('SNAPSHOT_CHECK_INTERVAL', 60))
+SEGMENT_SIZE = int(os.environ.get('SNAPSHOT_SEGMENT_SIZE', 100000))
+
+# Images and their info as of some id, so that /images and /image/<id>
+# only ask MySQL about the rows above it. A full export writes a new
+# file; an append adds the rows created since as one more segment.
+#
+# file layout, native byte order:
+#   header    magic, version, token (new for every export)
+#   segments  ascending ids, each:
+#     header      magic, n, size in bytes including this header
+#     ids         n x uint32
+#     info ids    n x uint32, 0 without image_info
+#     created_at  n x int64, microseconds since 1970-01-01
+#     offsets     filename, comment, source: (n + 1) x uint64 each
+#     nulls       n x uint8, bit i set when string i is NULL
+#     blobs       filename, comment, source, utf-8
+#     (padding to 8 bytes)
+#
+# An append that died halfway leaves a segment shorter than its size,
+# which readers ignore and the next append cuts off.
+#
+# Rows do change when PATCH /image/<id> edits them. The edit marks the
+# file on disk stale (its token and a nonce, in PATH.stale) until the
+# next export that no edit ran during.
+
+MAGIC = b'SKSN'
+VERSION = 1
+HEADER = struct.Struct('<4sI8s')
+SEGMENT_MAGIC = b'SKSG'
+SEGMENT_HEADER = struct.Struct('<4sIQ')
+STRINGS = ('filename', 'comment', 'source')
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def connect_db():
+    return MySQLdb.connect(
+        user=os.environ['DB_USER'],
+        passwd=os.environ['DB_PASSWD'],
+        host=os.environ['DB_HOST'],
+        port=int(os.environ['DB_PORT']),
+        db=os.environ['DB_NAME'],
+        use_unicode=True,
+        charset='utf8mb4',
+    )
+
+
+def pack_segment(rows):
+    n = len(rows)
+    nulls = bytearray(n)
+    offsets = []
+    blobs = []
+    for bit, key in enumerate(STRINGS):
+        blob = bytearray()
+        offset = array('Q', [0])
+        for i, row in enumerate(rows):
+            if row[key] is None:
+                nulls[i] |= 1 << bit
+            else:
+                blob += row[key].encode()
+            offset.append(len(blob))
+        offsets.append(offset)
+        blobs.append(blob)
+    body = b''.join([
+        array('I', (row['id'] for row in rows)).tobytes(),
+        array('I', (row['image_info_id'] or 0 for row in rows)).tobytes(),
+        array('q', (
+            (row['created_at'] - EPOCH) // MICROSECOND for row in rows
+        )).tobytes(),
+        *(x.tobytes() for x in offsets),
+        bytes(nulls),
+        *blobs,
+    ])
+    body += b'\0' * (-len(body) % 8)
+    return SEGMENT_HEADER.pack(
+        SEGMENT_MAGIC, n, SEGMENT_HEADER.size + len(body)) + body
+
+
+class Segment:
+    def __init__(self, view, n):
+        def take(size, fmt):
+            nonlocal at
+            ret = view[at:at + size].cast(fmt)
+            at += size
+            return ret
+
+        at = 0
+        self.ids = take(4 * n, 'I')
+        self.info_ids = take(4 * n, 'I')
+        self.created_at = take(8 * n, 'q')
+        self.offsets = [take(8 * (n + 1), 'Q') for _ in STRINGS]
+        self.nulls = take(n, 'B')
+        self.blobs = [take(x[-1], 'B') for x in self.offsets]
+        if at > len(view):
+            raise ValueError('broken snapshot segment')
+
+    def string(self, k, i):
+        if self.nulls[i] >> k & 1:
+            return None
+        offsets = self.offsets[k]
+        return str(self.blobs[k][offsets[i]:offsets[i + 1]], 'utf-8')
+
+    def row(self, i):
+        # the same keys as a row of build_images_query
+        return {
+            'id': self.ids[i],
+            'filename': self.string(0, i),
+            'created_at': EPOCH + self.created_at[i] * MICROSECOND,
+            'image_info_id': self.info_ids[i] or None,
+            'comment': self.string(1, i),
+            'source': self.string(2, i),
+        }
+
+
+class Snapshot:
+    def __init__(self, buf):
+        magic, version, self.token = HEADER.unpack_from(buf)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a snapshot')
+        view = memoryview(buf)
+        self.segments = []
+        # the number of rows before each segment
+        self.starts = [0]
+        at = HEADER.size
+        while at + SEGMENT_HEADER.size <= len(buf):
+            magic, n, size = SEGMENT_HEADER.unpack_from(buf, at)
+            if magic != SEGMENT_MAGIC or at + size > len(buf):
+                break
+            self.segments.append(
+                Segment(view[at + SEGMENT_HEADER.size:at + size], n))
+            self.starts.append(self.starts[-1] + n)
+            at += size
+        # what the file is good for; an append continues from here
+        self.size = at
+        self.bounds = [x.ids[-1] for x in self.segments]
+        self.max_id = self.bounds[-1] if self.bounds else 0
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def get(self, image_id):
+        s = bisect_left(self.bounds, image_id)
+        if s == len(self.segments):
+            return None
+        segment = self.segments[s]
+        i = bisect_left(segment.ids, image_id)
+        if segment.ids[i] != image_id:
+            return None
+        return segment.row(i)
+
+    def rank(self, image_id):
+        # the number of rows with id <= image_id
+        s = bisect_left(self.bounds, image_id)
+        if s == len(self.segments):
+            return self.starts[-1]
+        return self.starts[s] + bisect_right(self.segments[s].ids, image_id)
+
+    def count(self, max_id=None, since_id=None):
+        hi = self.starts[-1] if max_id is None else self.rank(max_id)
+        return max(0, hi - self.rank(since_id or 0))
+
+    def scan(self, max_id, since_id, asc):
+        # (segment, index) of the rows in range, in scan order
+        segments = self.segments
+        if asc:
+            since_id = since_id or 0
+            s = bisect_right(self.bounds, since_id)
+            if s < len(segments):
+                i = bisect_right(segments[s].ids, since_id)
+            for segment in segments[s:]:
+                ids = segment.ids
+                for i in range(i, len(ids)):
+                    if max_id is not None and ids[i] > max_id:
+                        return
+                    yield segment, i
+                i = 0
+        else:
+            s = len(segments) - 1
+            j = None
+            if max_id is not None:
+                s = bisect_left(self.bounds, max_id)
+                if s == len(segments):
+                    s -= 1
+                else:
+                    j = bisect_right(segments[s].ids, max_id)
+            for segment in segments[s::-1] if s >= 0 else ():
+                ids = segment.ids
+                for i in reversed(range(len(ids) if j is None else j)):
+                    if since_id is not None and ids[i] <= since_id:
+                        return
+                    yield segment, i
+                j = None
+
+    def page(self, count, max_id=None, since_id=None, asc=False):
+        return [
+            segment.row(i)
+            for segment, i in islice(self.scan(max_id, since_id, asc), count)
+        ]
+
+
+def write(path, segments):
+    # segments: lists of rows from build_images_query, ascending ids
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, os.urandom(8)))
+        for rows in segments:
+            if rows:
+                f.write(pack_segment(rows))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def append(path, segments):
+    # adds the rows with ids above the snapshot; returns how many
+    appended = 0
+    with open(path, 'r+b') as f:
+        # one appender at a time
+        fcntl.flock(f, fcntl.LOCK_EX)
+        snapshot = Snapshot(
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        f.truncate(snapshot.size)
+        f.seek(snapshot.size)
+        for rows in segments:
+            rows = [row for row in rows if row['id'] > snapshot.max_id]
+            if rows:
+                f.write(pack_segment(rows))
+                appended += len(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    return appended
+
+
+def stale_path(path):
+    return f'{path}.stale'
+
+
+@contextmanager
+def stale_lock(path):
+    # edits and exports agree on the marker under this lock
+    with open(f'{stale_path(path)}.lock', 'ab') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def read_marker(path):
+    try:
+        with open(stale_path(path), 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def mark_stale(path):
+    # under stale_lock; names the file on disk, which may be newer than
+    # the one a worker has mapped
+    try:
+        with open(path, 'rb') as f:
+            _, _, token = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return
+    tmp = f'{stale_path(path)}.{os.getpid()}'
+    with open(tmp, 'wb') as f:
+        f.write(token + os.urandom(8))
+    os.replace(tmp, stale_path(path))
+
+
+def iter_rows(conn, since_id=0, batch_size=SEGMENT_SIZE):
+    c = conn.cursor(MySQLdb.cursors.SSDictCursor)
+    c.execute(build_images_query('i.id > %s', True, limit=False), (since_id,))
+    try:
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        c.close()
+
+
+def export(path=PATH, segment_size=SEGMENT_SIZE):
+    # an edit made while the rows are read may be missing from them, so
+    # the new file stays stale when the marker changed in the meantime
+    marker = read_marker(path)
+    conn = connect_db()
+    try:
+        write(path, iter_rows(conn, 0, segment_size))
+    finally:
+        conn.close()
+    with stale_lock(path):
+        if read_marker(path) != marker:
+            mark_stale(path)
+        elif marker is not None:
+            os.remove(stale_path(path))
+
+
+def append_tail(path=PATH):
+    if not os.path.exists(path):
+        export(path)
+        return None
+    conn = connect_db()
+    try:
+        since_id = Snapshot.open(path).max_id
+        # segments only grow in number; export again now and then
+        return append(path, iter_rows(conn, since_id))
+    finally:
+        conn.close()
+
+
+_snapshot = None
+_version = None
+_checked_at = 0.0
+
+
+def get_snapshot():
+    global _snapshot, _version, _checked_at
+    if not PATH:
+        return None
+    now = time.time()
+    if now - _checked_at >= CHECK_INTERVAL:
+        _checked_at = now
+        try:
+            st = os.stat(PATH)
+            if (st.st_ino, st.st_size, st.st_mtime) != _version:
+                # the old mapping stays valid for requests still using it
+                _snapshot = Snapshot.open(PATH)
+                _version = (st.st_ino, st.st_size, st.st_mtime)
+        except (OSError, ValueError, struct.error):
+            _snapshot = None
+            _version = None
+        if _snapshot is not None and _snapshot.token == read_stale():
+            _snapshot = None
+            _version = None
+    return _snapshot
+
+
+def read_stale():
+    # the token of the stale file
+    marker = read_marker(PATH)
+    return marker[:8] if marker is not None else None
+
+
+def invalidate():
+    # the snapshot has rows that changed; not used until exported again
+    if PATH:
+        with stale_lock(PATH):
+            mark_stale(PATH)
+    refresh()
+
+
+def refresh():
+    # look at the files again on the next get_snapshot
+    global _checked_at
+    _checked_at = 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Write the image catalog snapshot read by the API.')
+    parser.add_argument('command', choices=('export', 'append'),
+                        help='export writes every row to a new file; '
+                        'append adds the rows created since')
+    parser.add_argument('--path', default=PATH, required=not PATH)
+    parser.add_argument('--segment-size', type=int, default=SEGMENT_SIZE)
+    args = parser.parse_args()
+
+    t_s = time.time()
+    if args.command == 'export':
+        export(args.path, args.segment_size)
+    else:
+        appended = append_tail(args.path)
+        if appended is not None:
+            print(f'{appended} rows appended')
+    print(f'done in {time.time() - t_s:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import os
+import json
+import time
+import unicodedata
+
+# written by `ngram.py --stats`, read by the API workers
+STATS_PATH = os.environ.get('TERM_STATS_PATH', '')
+CHECK_INTERVAL = int(os.environ.get('TERM_STATS_CHECK_INTERVAL', 60))
+
+
+def fold(text):
+    # close to, but not the same as, the utf8mb4_general_ci comparisons
+    # done by LIKE (which takes ß for s, for one), so estimates are rough
+    return ''.join(
+        x for x in unicodedata.normalize('NFKD', text.lower())
+        if not unicodedata.combining(x)
+    )
+
+
+def terms(text):
+    # every unigram and bigram of text, URLs included
+    chars = [x for x in fold(text) if x not in ' \t\r\n']
+    return set(chars) | {x + y for x, y in zip(chars, chars[1:])}
+
+
+class TermStats:
+    def __init__(self, df=None, documents=0, max_image_id=0):
+        self.df = df if df is not None else {}
+        self.documents = documents
+        self.max_image_id = max_image_id
+
+    def add(self, image_id, comment):
+        for term in terms(comment):
+            self.df[term] = self.df.get(term, 0) + 1
+        self.documents += 1
+        self.max_image_id = max(self.max_image_id, image_id)
+
+    def merge(self, other):
+        for term, n in other.df.items():
+            self.df[term] = self.df.get(term, 0) + n
+        self.documents += other.documents
+        self.max_image_id = max(self.max_image_id, other.max_image_id)
+
+    def estimate(self, term):
+        # about how many comments contain term
+        keys = terms(term)
+        if len(keys) > 1:
+            keys = {x for x in keys if len(x) == 2}
+        if not keys:
+            return self.documents
+        return min(self.df.get(x, 0) for x in keys)
+
+    def save(self, path):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({
+                'documents': self.documents,
+                'max_image_id': self.max_image_id,
+                'df': self.df,
+            }, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data['df'], data['documents'], data['max_image_id'])
+
+
+_stats = None
+_mtime = None
+_checked_at = 0.0
+
+
+def get_stats():
+    global _stats, _mtime, _checked_at
+    if not STATS_PATH:
+        return None
+    now = time.time()
+    if now - _checked_at < CHECK_INTERVAL:
+        return _stats
+    _checked_at = now
+    try:
+        mtime = os.stat(STATS_PATH).st_mtime
+        if mtime != _mtime:
+            _stats = TermStats.load(STATS_PATH)
+            _mtime = mtime
+    except (OSError, ValueError, KeyError):
+        _stats = None
+        _mtime = None
+    return _stats
@@ -1,5 +1,6 @@
 import unittest
 import json
+from unittest import mock
 from urllib.parse import quote
 import helper
 import api
@@ -28,6 +29,96 @@ class AppTest(unittest.TestCase):
         resp_data = json.loads(rv.data)
         self.assertFalse(resp_data['ok'])
 
+    def keep_image_info(self, image_id):
+        # PATCH writes to the database the other tests read, so the row
+        # is put back as it was, comment_ngram and unigrams included
+        conn = api.connect_db()
+        c = conn.cursor(api.MySQLdb.cursors.DictCursor)
+        c.execute(
+            'SELECT * FROM image_info WHERE image_id = %s', (image_id,))
+        row = c.fetchone()
+
+        def restore():
+            try:
+                c.execute(
+                    'DELETE FROM image_info WHERE image_id = %s', (image_id,))
+                if row is not None:
+                    c.execute(
+                        f"INSERT INTO image_info ({', '.join(row)}) "
+                        f"VALUES ({', '.join(['%s'] * len(row))})",
+                        list(row.values()))
+                if api.ngram.UNIGRAM_TABLE:
+                    api.ngram.update_unigrams(c, [{
+                        'image_id': image_id,
+                        'comment': (row or {}).get('comment') or '',
+                    }])
+                conn.commit()
+            finally:
+                conn.close()
+            api.drop_caches()
+            api.response_cache.cache.invalidate()
+            api.search_index.reset()
+        self.addCleanup(restore)
+
+    def test_update_image(self):
+        self.keep_image_info(20000)
+        api.WRITE_API_TOKEN = 'test'
+        self.addCleanup(setattr, api, 'WRITE_API_TOKEN', '')
+        headers = {'Authorization': 'Bearer test'}
+        rv = self.app.patch(
+            '/image/20000', json={'comment': 'ぷちデレラ編集済み'},
+            headers=headers)
+        resp_data = json.loads(rv.data)
+        self.assertTrue(resp_data['ok'])
+        self.assertEqual('ぷちデレラ編集済み', resp_data['data']['comment'])
+
+        rv = self.app.get(
+            f'/images/search?keyword={quote("デレラ編集")}')
+        resp_data = json.loads(rv.data)
+        self.assertEqual(
+            [20000], [data['id'] for data in resp_data['data']])
+
+    def test_update_image_source_only(self):
+        self.keep_image_info(20000)
+        api.WRITE_API_TOKEN = 'test'
+        self.addCleanup(setattr, api, 'WRITE_API_TOKEN', '')
+        with mock.patch.object(api.invalidation, 'bump') as bump:
+            rv = self.app.patch(
+                '/image/20000', json={'source': 'https://example.com/x'},
+                headers={'Authorization': 'Bearer test'})
+        resp_data = json.loads(rv.data)
+        self.assertEqual('https://example.com/x', resp_data['data']['source'])
+        # the other workers must not keep serving the old source
+        bump.assert_called_once_with()
+
+    def test_update_image_error_unauthorized(self):
+        api.WRITE_API_TOKEN = 'test'
+        try:
+            rv = self.app.patch('/image/20000', json={'comment': 'x'})
+        finally:
+            api.WRITE_API_TOKEN = ''
+        self.assertEqual(401, rv.status_code)
+
+    def test_get_images_batch(self):
+        rv = self.app.get('/images/batch?ids=20000,0,20001')
+        resp_data = json.loads(rv.data)
+        self.assertTrue(resp_data['ok'])
+        self.assertEqual(20000, resp_data['data'][0]['id'])
+        self.assertIsNone(resp_data['data'][1])
+        self.assertEqual(20001, resp_data['data'][2]['id'])
+        self.assertEqual([0], resp_data['not_found'])
+
+    def test_get_images_batch_error_too_many_ids(self):
+        ids = ','.join(str(i) for i in range(1, 302))
+        rv = self.app.get(f'/images/batch?ids={ids}')
+        resp_data = json.loads(rv.data)
+        self.assertFalse(resp_data['ok'])
+
+    def test_get_images_batch_error_invalid(self):
+        rv = self.app.get('/images/batch?ids=hoge')
+        resp_data = json.loads(rv.data)
+        self.assertFalse(resp_data['ok'])
+
     def test_get_images_default(self):
         rv = self.app.get('/images')
         resp_data = json.loads(rv.data)
@@ -81,6 +172,69 @@ class AppTest(unittest.TestCase):
                 40000
             )
 
+    def test_get_images_cursor(self):
+        rv = self.app.get('/images?count=5')
+        first = json.loads(rv.data)
+        rv = self.app.get(f"/images?count=5&cursor={first['next_cursor']}")
+        second = json.loads(rv.data)
+        self.assertTrue(second['ok'])
+        self.assertEqual(5, len(second['data']))
+        self.assertLess(second['data'][0]['id'], first['data'][-1]['id'])
+
+        rv = self.app.get(f"/images?count=5&cursor={second['prev_cursor']}")
+        resp_data = json.loads(rv.data)
+        self.assertEqual(first['data'], resp_data['data'])
+
+    def test_get_images_fields(self):
+        rv = self.app.get('/images?count=5&fields=id,thumbnail_url')
+        resp_data = json.loads(rv.data)
+        self.assertTrue(resp_data['ok'])
+        for data in resp_data['data']:
+            self.assertEqual({'id', 'urls'}, set(data))
+            self.assertEqual({'thumbnail_url'}, set(data['urls']))
+
+    def test_get_images_format_columns(self):
+        rv = self.app.get('/images?count=5')
+        rows = json.loads(rv.data)['data']
+        rv = self.app.get('/images?count=5&format=columns')
+        resp_data = json.loads(rv.data)
+        self.assertEqual([x['id'] for x in rows], resp_data['data']['id'])
+        self.assertEqual(
+            [x['urls']['thumbnail_url'] for x in rows],
+            [resp_data['prefixes']['thumbnail_url'] + filename
+             for filename in resp_data['data']['filename']])
+
+    def test_get_images_error_fields_invalid(self):
+        rv = self.app.get('/images?fields=id,password')
+        resp_data = json.loads(rv.data)
+        self.assertFalse(resp_data['ok'])
+
+    def test_get_images_error_cursor_invalid(self):
+        rv = self.app.get('/images?cursor=invalid')
+        resp_data = json.loads(rv.data)
+        self.assertFalse(resp_data['ok'])
+
+    def test_export_images(self):
+        rv = self.app.get(
+            f'/images/export?keyword={quote("奈緒")}&since_id=40000')
+        self.assertEqual('application/x-ndjson', rv.mimetype)
+        ids = []
+        for line in rv.data.decode('utf-8').splitlines():
+            data = json.loads(line)
+            self.assertIn(
+                "奈緒",
+                data['comment']
+            )
+            ids.append(data['id'])
+        self.assertGreater(len(ids), 0)
+        self.assertGreater(ids[0], 40000)
+        self.assertEqual(sorted(ids), ids)
+
+    def test_export_images_error_since_id_invalid(self):
+        rv = self.app.get('/images/export?since_id=hoge')
+        resp_data = json.loads(rv.data)
+        self.assertFalse(resp_data['ok'])
+
     def test_search_images_without_keyword(self):
         rv = self.app.get('/images/search')
         resp_data = json.loads(rv.data)
@@ -253,6 +407,47 @@ class AppTest(unittest.TestCase):
                 40000
             )
 
+    def test_search_images_cursor(self):
+        rv = self.app.get(f'/images/search?keyword={quote("奈緒")}&count=5')
+        first = json.loads(rv.data)
+        rv = self.app.get(
+            f'/images/search?keyword={quote("奈緒")}&count=5'
+            f"&cursor={first['next_cursor']}")
+        second = json.loads(rv.data)
+        self.assertTrue(second['ok'])
+        for data in second['data']:
+            self.assertIn("奈緒", data['comment'])
+            self.assertLess(data['id'], first['data'][-1]['id'])
+
+        rv = self.app.get(
+            f'/images/search?keyword={quote("奈緒")}&count=5'
+            f"&cursor={second['prev_cursor']}")
+        resp_data = json.loads(rv.data)
+        self.assertEqual(first['data'], resp_data['data'])
+
+    def test_search_images_relevance(self):
+        url = f'/images/search?keyword={quote("奈緒")}&order=relevance&count=5'
+        first = json.loads(self.app.get(url).data)
+        self.assertTrue(first['ok'])
+        self.assertEqual(len(first['data']), len(first['relevance']))
+        self.assertFalse(first['truncated'])
+        self.assertEqual(
+            first['relevance'], sorted(first['relevance'], reverse=True))
+        second = json.loads(self.app.get(
+            f"{url}&cursor={first['next_cursor']}").data)
+        for data, score in zip(second['data'], second['relevance']):
+            self.assertIn("奈緒", data['comment'])
+            self.assertLessEqual(score, first['relevance'][-1])
+        resp_data = json.loads(self.app.get(
+            f"{url}&cursor={second['prev_cursor']}").data)
+        self.assertEqual(first['data'], resp_data['data'])
+
+    def test_search_images_error_order_invalid(self):
+        rv = self.app.get(
+            f'/images/search?keyword={quote("奈緒")}&order=random')
+        resp_data = json.loads(rv.data)
+        self.assertFalse(resp_data['ok'])
+
     def test_search_images_error_count_larger_than_200(self):
         rv = self.app.get(
             '/images/search?keyword={quote("奈緒")}&count=201')
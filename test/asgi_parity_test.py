@@ -0,0 +1,51 @@
+import unittest
+import json
+from urllib.parse import quote
+from starlette.testclient import TestClient
+import helper
+import api
+import asgi
+
+# what asgi.py serves; it has no cursors, fields, format or order, so
+# only the keys both servers send are compared
+URLS = [
+    '/image/1',
+    '/image/0',
+    '/images?count=20&whole_count=exact',
+    '/images?count=20&max_id=100&whole_count=exact',
+    '/images?count=20&since_id=100&reversed=1&whole_count=exact',
+    f'/images/search?keyword={quote("奈緒")}&count=50&whole_count=exact',
+    f'/images/search?keyword={quote("仁奈 OR みりあ")}&count=50'
+    '&whole_count=exact',
+    f'/images/search?keyword={quote("奈緒 -R-18")}&count=50&reversed=1'
+    '&since_id=0&whole_count=exact',
+    '/images?count=0',
+    '/images/search?count=10',
+]
+KEYS = ('ok', 'message', 'whole_count', 'data')
+
+
+class AsgiParityTest(unittest.TestCase):
+    def setUp(self):
+        api.app.testing = True
+        self.app = api.app.test_client()
+        asgi.app.state.testing = True
+        self.addCleanup(setattr, asgi.app.state, 'testing', False)
+        # entering the client runs the lifespan, which opens the pool
+        self.client = TestClient(asgi.app).__enter__()
+        self.addCleanup(self.client.__exit__, None, None, None)
+
+    def test_parity(self):
+        for url in URLS:
+            with self.subTest(url=url):
+                rv = self.app.get(url)
+                resp = self.client.get(url)
+                self.assertEqual(rv.status_code, resp.status_code)
+                expected = json.loads(rv.data)
+                actual = resp.json()
+                for key in KEYS:
+                    self.assertEqual(expected.get(key), actual.get(key))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import random
+from io import BytesIO
+from unittest import mock
+from urllib.error import HTTPError
+import helper
+import bench
+
+
+class BenchTest(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        random.shuffle(values)
+        self.assertEqual(50, bench.percentile(values, 50))
+        self.assertEqual(95, bench.percentile(values, 95))
+        self.assertEqual(99, bench.percentile(values, 99))
+        self.assertEqual(7, bench.percentile([7], 99))
+        self.assertEqual(3, bench.percentile([5, 1, 4, 2, 3], 50))
+        self.assertEqual(5, bench.percentile([5, 1, 4, 2, 3], 95))
+
+    def test_compare(self):
+        baseline = {'images': {'p95': 0.010}, 'image': {'p95': 0.002}}
+        results = {
+            'images': {'p95': 0.0105},
+            'image': {'p95': 0.003},
+            'search_single': {'p95': 1.0},
+        }
+        self.assertEqual(['image'], bench.compare(results, baseline, 0.1))
+
+    def test_http_client_error(self):
+        def urlopen(url):
+            raise HTTPError(url, 503, 'Service Unavailable', {}, BytesIO())
+
+        with mock.patch.object(bench, 'urlopen', urlopen):
+            self.assertEqual(503, bench.http_client('http://x/')('/images'))
+
+    def test_cold(self):
+        paths = []
+
+        def get(path):
+            paths.append(path)
+            return 200
+
+        result = bench.run_scenario(get, '/image/1', 5, 1, 2, cold=True)
+        self.assertEqual(0, result['errors'])
+        self.assertEqual(7, len(set(paths)))
+        self.assertTrue(paths[0].startswith('/image/1?_='))
+        bench.run_scenario(get, '/images?count=1', 1, 1, 0, cold=True)
+        self.assertTrue(paths[-1].startswith('/images?count=1&_='))
+
+    def test_make_comment_is_reproducible(self):
+        a = [bench.make_comment(random.Random(1)) for _ in range(3)]
+        b = [bench.make_comment(random.Random(1)) for _ in range(3)]
+        self.assertEqual(a, b)
+
+
+if __name__ == '__main__':
+    unittest.main()
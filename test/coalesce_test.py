@@ -0,0 +1,141 @@
+import fcntl
+import os
+import tempfile
+import threading
+import time
+import unittest
+import helper
+from flask import Flask
+import coalesce
+from coalesce import Coalescer
+
+
+class CoalescerTest(unittest.TestCase):
+    def test_single_flight(self):
+        coalescer = Coalescer(lock_dir='')
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def func():
+            calls.append(1)
+            started.set()
+            release.wait(1)
+            return b'body', 200, [('Content-Type', 'application/json')]
+
+        results = []
+
+        def request():
+            results.append(coalescer.run('k', func))
+
+        leader = threading.Thread(target=request)
+        leader.start()
+        started.wait(1)
+        followers = [threading.Thread(target=request) for _ in range(3)]
+        for t in followers:
+            t.start()
+        time.sleep(0.05)
+        release.set()
+        for t in [leader] + followers:
+            t.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual(4, len(results))
+        self.assertEqual({b'body'}, {body for body, _, _ in results})
+        self.assertEqual({}, coalescer.flights)
+
+        # nothing is kept once the flight is over
+        coalescer.run('k', func)
+        self.assertEqual(2, len(calls))
+
+    def test_leader_error(self):
+        coalescer = Coalescer(lock_dir='')
+        with self.assertRaises(RuntimeError):
+            coalescer.run('k', lambda: (_ for _ in ()).throw(RuntimeError))
+        self.assertEqual({}, coalescer.flights)
+
+    def test_shared(self):
+        with tempfile.TemporaryDirectory() as d:
+            # two workers
+            a, b = Coalescer(lock_dir=d), Coalescer(lock_dir=d)
+            calls = []
+            started = threading.Event()
+            release = threading.Event()
+
+            def func():
+                calls.append(1)
+                started.set()
+                release.wait(1)
+                return b'body', 200, [('X', 'y')]
+
+            results = []
+            leader = threading.Thread(
+                target=lambda: results.append(a.run('k', func)))
+            leader.start()
+            started.wait(1)
+            follower = threading.Thread(
+                target=lambda: results.append(b.run('k', func)))
+            follower.start()
+            time.sleep(0.05)
+            release.set()
+            leader.join()
+            follower.join()
+            self.assertEqual(1, len(calls))
+            self.assertEqual([(b'body', 200, [('X', 'y')])] * 2, results)
+
+            # a response finished earlier is not used
+            b.run('k', func)
+            self.assertEqual(2, len(calls))
+
+    def test_shared_timeout(self):
+        with tempfile.TemporaryDirectory() as d:
+            a = Coalescer(lock_dir=d, timeout=0.01)
+            b = Coalescer(lock_dir=d, timeout=0.01)
+            result = (b'body', 200, [])
+            self.assertEqual(
+                result, a.run('k', lambda: b.run('k', lambda: result)))
+
+    def test_sweep(self):
+        with tempfile.TemporaryDirectory() as d:
+            coalescer = Coalescer(lock_dir=d)
+            old = time.time() - 2 * coalesce.SWEEP_AGE
+            paths = [os.path.join(d, f'{x}.lock') for x in 'ab']
+            for path in paths:
+                with open(path, 'wb'):
+                    pass
+                os.utime(path, (old, old))
+            with open(paths[0], 'rb') as f:
+                # held by a leader that is still running
+                fcntl.flock(f, fcntl.LOCK_EX)
+                coalescer.sweep(time.time())
+            self.assertEqual(['a.lock'], os.listdir(d))
+
+    def test_load(self):
+        result = (b'{"ok": true}\n', 200, [('X', 'y')])
+        data = coalesce.dump(result)
+        self.assertEqual(result, coalesce.load(data, time.time() - 1))
+        self.assertIsNone(coalesce.load(data, time.time() + 1))
+        self.assertIsNone(coalesce.load(data[:-1], time.time() - 1))
+        self.assertIsNone(coalesce.load(b'', time.time() - 1))
+
+
+class RequestKeyTest(unittest.TestCase):
+    def key(self, url):
+        app = Flask(__name__)
+        with app.test_request_context(url):
+            return coalesce.request_key()
+
+    def test_request_key(self):
+        self.assertEqual(
+            self.key('/images/search?keyword=a+b&count=5&since_id=1'),
+            self.key('/images/search?since_id=1&count=5&keyword=B+a'))
+        self.assertNotEqual(
+            self.key('/images/search?keyword=a'),
+            self.key('/images/search?keyword=a+-b'))
+        self.assertNotEqual(
+            self.key('/images?since_id=1'), self.key('/images?since_id=2'))
+        self.assertNotEqual(
+            self.key('/images?count=1'), self.key('/images/search?count=1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
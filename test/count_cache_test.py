@@ -0,0 +1,58 @@
+import unittest
+import helper
+import count_cache
+
+
+class CountCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = count_cache.CountCache(ttl=60)
+        self.calls = []
+
+    def count_range(self, since_id, max_id):
+        self.calls.append((since_id, max_id))
+        return max_id - (since_id or 0)
+
+    def test_normalize(self):
+        self.assertEqual(
+            count_cache.normalize({'and': ['b', 'A', 'a'], 'or': [], 'ex': []}),
+            count_cache.normalize({'and': ['a', 'b']}),
+        )
+
+    def test_cached(self):
+        self.assertEqual(100, self.cache.lookup((), 100, self.count_range))
+        self.assertEqual(100, self.cache.lookup((), 100, self.count_range))
+        self.assertEqual([(None, 100)], self.calls)
+
+    def test_counts_only_new_rows(self):
+        self.cache.lookup((), 100, self.count_range)
+        self.assertEqual(110, self.cache.lookup((), 110, self.count_range))
+        self.assertEqual([(None, 100), (100, 110)], self.calls)
+
+    def test_recounts_when_head_moves_back(self):
+        self.cache.lookup((), 100, self.count_range)
+        self.assertEqual(90, self.cache.lookup((), 90, self.count_range))
+        self.assertEqual([(None, 100), (None, 90)], self.calls)
+
+    def test_expired(self):
+        self.cache.ttl = -1
+        self.cache.lookup((), 100, self.count_range)
+        self.cache.lookup((), 100, self.count_range)
+        self.assertEqual([(None, 100), (None, 100)], self.calls)
+
+    def test_exact(self):
+        self.cache.lookup((), 100, self.count_range)
+        self.cache.lookup((), 100, self.count_range, 'exact')
+        self.assertEqual([(None, 100), (None, 100)], self.calls)
+
+    def test_estimate(self):
+        self.assertEqual(
+            42, self.cache.lookup((), 100, self.count_range, 'estimate',
+                                  lambda: 42))
+        self.cache.lookup((), 100, self.count_range)
+        self.assertEqual(
+            100, self.cache.lookup((), 200, self.count_range, 'estimate'))
+        self.assertEqual([(None, 100)], self.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
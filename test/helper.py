@@ -1,3 +1,6 @@
 import sys
 import os.path
 sys.path.append(os.path.curdir)
+from dotenv import load_dotenv, find_dotenv
+# the modules under test only read os.environ
+load_dotenv(find_dotenv(usecwd=True))
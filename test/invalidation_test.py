@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import helper
+import invalidation
+
+
+class FakeUwsgi:
+    def __init__(self, caches=('responses',), numproc=4):
+        self.store = {}
+        self.caches = caches
+        self.numproc = numproc
+
+    def cache_exists(self, key, name):
+        if name not in self.caches:
+            raise ValueError(f'unable to find cache {name}')
+        return (name, key) in self.store
+
+    def cache_get(self, key, name):
+        return self.store.get((name, key))
+
+    def cache_update(self, key, value, expires, name):
+        self.store[(name, key)] = value
+
+
+class InvalidationTest(unittest.TestCase):
+    def patch(self, uwsgi=None, path=''):
+        patches = [
+            mock.patch.object(invalidation, 'uwsgi', uwsgi),
+            mock.patch.object(invalidation, 'GENERATION_PATH', path),
+            mock.patch.object(invalidation, '_seen', None),
+            mock.patch.object(invalidation, '_cache_ok', None),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_single_process(self):
+        self.patch()
+        invalidation.bump()
+        self.assertFalse(invalidation.changed())
+        self.assertTrue(invalidation.available())
+
+    def test_changed(self):
+        uwsgi = FakeUwsgi()
+        self.patch(uwsgi)
+        self.assertTrue(invalidation.available())
+        self.assertFalse(invalidation.changed())
+        invalidation.bump()
+        # the writer has already dropped its own caches
+        self.assertFalse(invalidation.changed())
+        # another worker writes
+        uwsgi.cache_update(
+            invalidation.GENERATION_KEY, b'other', 0,
+            invalidation.UWSGI_CACHE)
+        self.assertTrue(invalidation.moved())
+        self.assertTrue(invalidation.changed())
+        self.assertFalse(invalidation.moved())
+        self.assertFalse(invalidation.changed())
+
+    def test_written_at(self):
+        uwsgi = FakeUwsgi()
+        self.patch(uwsgi)
+        self.assertEqual(0.0, invalidation.written_at())
+        with mock.patch('time.time', return_value=1000.5):
+            invalidation.bump()
+        self.assertEqual(1000.5, invalidation.written_at())
+        uwsgi.cache_update(
+            invalidation.GENERATION_KEY, b'2000.25 other', 0,
+            invalidation.UWSGI_CACHE)
+        self.assertTrue(invalidation.changed())
+        self.assertEqual(2000.25, invalidation.written_at())
+
+    def test_without_cache(self):
+        self.patch(FakeUwsgi(caches=()))
+        self.assertFalse(invalidation.available())
+        self.patch(FakeUwsgi(caches=(), numproc=1))
+        self.assertTrue(invalidation.available())
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'generation')
+            self.patch(FakeUwsgi(caches=()), path)
+            self.assertTrue(invalidation.available())
+            self.assertFalse(invalidation.changed())
+            invalidation.bump()
+            self.assertFalse(invalidation.changed())
+            with open(path, 'wb') as f:
+                f.write(b'other')
+            self.assertTrue(invalidation.changed())
+            self.assertFalse(invalidation.changed())
+
+
+if __name__ == '__main__':
+    unittest.main()
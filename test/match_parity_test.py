@@ -0,0 +1,67 @@
+import unittest
+import json
+from urllib.parse import quote
+import helper
+import api
+import pagination
+import utils
+
+# searches whose results must not depend on MATCH_MODE
+KEYWORDS = [
+    '奈緒',
+    '仁奈ちゃん',
+    'みりあ 仁奈',
+    '仁奈 OR みりあ',
+    '奈緒 -R-18',
+    '薫',
+    '♂',
+    'lunatic',
+    '@aoi',
+    'R-18',
+    'の',
+]
+
+
+class MatchParityTest(unittest.TestCase):
+    def setUp(self):
+        api.app.testing = True
+        self.app = api.app.test_client()
+        self.match_mode = utils.MATCH_MODE
+
+    def tearDown(self):
+        utils.MATCH_MODE = self.match_mode
+        pagination.windows.invalidate()
+
+    def search(self, mode, keyword, **params):
+        utils.MATCH_MODE = mode
+        pagination.windows.invalidate()
+        query = ''.join(f'&{k}={v}' for k, v in params.items())
+        rv = self.app.get(
+            f'/images/search?keyword={quote(keyword)}&count=200'
+            f'&whole_count=exact{query}')
+        resp_data = json.loads(rv.data)
+        self.assertTrue(resp_data['ok'])
+        return (
+            [data['id'] for data in resp_data['data']],
+            resp_data['whole_count'],
+        )
+
+    def test_parity(self):
+        for keyword in KEYWORDS:
+            with self.subTest(keyword=keyword):
+                self.assertEqual(
+                    self.search('natural', keyword),
+                    self.search('ngram', keyword),
+                )
+
+    def test_parity_reversed(self):
+        for keyword in KEYWORDS:
+            with self.subTest(keyword=keyword):
+                self.assertEqual(
+                    self.search('natural', keyword, reversed=1, since_id=0),
+                    self.search('ngram', keyword, reversed=1, since_id=0),
+                )
+
+
+if __name__ == '__main__':
+    unittest.main()
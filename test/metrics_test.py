@@ -0,0 +1,60 @@
+import os
+import unittest
+from flask import Flask, Response
+import helper
+import metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        app = Flask(__name__)
+        metrics.init_app(app)
+        metrics.registry = metrics.Registry()
+
+        @app.route('/hello')
+        def hello():
+            with metrics.span('db'):
+                pass
+            return Response('hello')
+
+        self.app = app.test_client()
+
+    def test_histogram(self):
+        h = metrics.Histogram(buckets=(0.1, 1.0))
+        h.observe(0.05)
+        h.observe(0.5)
+        h.observe(5)
+        self.assertEqual([1, 1, 1], h.counts)
+        self.assertEqual(
+            'x_bucket{a="b",le="1.0"} 2',
+            h.render('x', 'a="b"')[1]
+        )
+
+    def test_server_timing(self):
+        rv = self.app.get('/hello')
+        names = [
+            x.split(';')[0]
+            for x in rv.headers['Server-Timing'].split(', ')
+        ]
+        self.assertEqual(['db', 'total'], names)
+
+    def test_metrics(self):
+        self.app.get('/hello')
+        rv = self.app.get('/metrics')
+        body = rv.data.decode('utf-8')
+        worker = f'worker="{os.getpid()}"'
+        self.assertIn(
+            f'sukui_request_duration_seconds_count{{{worker},route="hello"}} 1',
+            body)
+        self.assertIn(
+            'sukui_span_duration_seconds_count'
+            f'{{{worker},route="hello",span="db"}} 1',
+            body)
+
+    def test_span_outside_request(self):
+        with metrics.span('db'):
+            pass
+
+
+if __name__ == '__main__':
+    unittest.main()
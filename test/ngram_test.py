@@ -0,0 +1,149 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import helper
+import ngram
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def execute(self, query, args=None):
+        if query.startswith('SELECT'):
+            self.rows = [r for r in self.conn.rows if r['id'] > args[0]]
+
+    def executemany(self, query, args):
+        self.conn.updates.extend(args)
+
+    def fetchmany(self, size):
+        ret, self.rows = self.rows[:size], self.rows[size:]
+        return ret
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.rows = rows
+        self.updates = []
+        self.commits = 0
+
+    def cursor(self, cursorclass=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class NgramTest(unittest.TestCase):
+    def test_ngram(self):
+        self.assertEqual(
+            'しょ ょう うさ さち',
+            ngram.ngram('しょう さち')
+        )
+
+    def test_ngram_without_url(self):
+        self.assertEqual(
+            '美玲',
+            ngram.ngram('美玲 https://example.com/a')
+        )
+
+    def test_unigrams(self):
+        self.assertEqual({'薫', '♂', 'a'}, ngram.unigrams('薫 ♂\ta'))
+
+    def test_changed_rows(self):
+        rows = [
+            {'id': 1, 'comment': '美玲', 'comment_ngram': '美玲'},
+            {'id': 2, 'comment': '奈緒', 'comment_ngram': None},
+        ]
+        self.assertEqual([('奈緒', 2)], ngram.changed_rows(rows))
+        self.assertEqual(
+            [('美玲', 1), ('奈緒', 2)],
+            ngram.changed_rows(rows, force=True)
+        )
+
+    def test_process_batch(self):
+        rows = [
+            {'id': 3, 'image_id': 5, 'comment': '美玲', 'comment_ngram': None},
+            {'id': 4, 'image_id': 6, 'comment': '奈緒', 'comment_ngram': '奈緒'},
+        ]
+        last_id, params, targets, stats, signatures = ngram.process_batch(
+            rows, with_stats=True, with_signatures=True)
+        self.assertEqual(4, last_id)
+        self.assertEqual([('美玲', 3)], params)
+        self.assertEqual(2, stats.documents)
+        self.assertEqual(6, stats.max_image_id)
+        self.assertEqual([5, 6], [image_id for image_id, _ in signatures])
+
+    def test_process_batch_unigrams_upto(self):
+        rows = [
+            {'id': 3, 'image_id': 5, 'comment': '美玲', 'comment_ngram': None},
+            {'id': 4, 'image_id': 6, 'comment': '奈緒', 'comment_ngram': None},
+            {'id': 5, 'image_id': 7, 'comment': '薫', 'comment_ngram': '薫'},
+        ]
+        _, _, targets, _, _ = ngram.process_batch(rows)
+        self.assertEqual([], targets)
+        # rows above the fill progress are left to fill_unigrams
+        _, _, targets, _, _ = ngram.process_batch(rows, unigrams_upto=3)
+        self.assertEqual([3], [row['id'] for row in targets])
+
+    def test_unigrams_filled(self):
+        c = mock.Mock()
+        with mock.patch.object(ngram, 'read_unigram_progress',
+                               return_value=4):
+            for max_id, expected in ((4, True), (5, False), (None, True)):
+                c.fetchone.return_value = (max_id,)
+                self.assertEqual(expected, ngram.unigrams_filled(c))
+        with mock.patch.object(ngram, 'read_unigram_progress',
+                               return_value=None):
+            self.assertIsNone(ngram.unigrams_filled(c))
+
+    def test_reindex_workers(self):
+        rows = [
+            {'id': i, 'image_id': i, 'comment': f'仁奈{i}', 'comment_ngram': None}
+            for i in range(1, 26)
+        ]
+        for workers in (1, 3):
+            conns = [FakeConnection(rows), FakeConnection(rows)]
+            with mock.patch.object(ngram, 'connect_db', lambda: conns.pop(0)):
+                writer = conns[1]
+                updated = ngram.reindex(batch_size=4, workers=workers)
+            self.assertEqual(25, updated)
+            self.assertEqual(7, writer.commits)
+            self.assertEqual(
+                [(ngram.ngram(r['comment']), r['id']) for r in rows],
+                writer.updates)
+
+    def test_reindex_related(self):
+        rows = [
+            {'id': i, 'image_id': i, 'comment': f'仁奈{i}', 'comment_ngram': None}
+            for i in range(1, 11)
+        ]
+        conns = [FakeConnection(rows), FakeConnection(rows)]
+        with tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(ngram, 'connect_db', lambda: conns.pop(0)):
+            path = os.path.join(d, 'related')
+            ngram.reindex(batch_size=4, workers=2, related_path=path)
+            index = ngram.related.RelatedIndex.open(path)
+            self.assertEqual(list(range(1, 11)), list(index.ids))
+
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'checkpoint')
+            self.assertIsNone(ngram.read_checkpoint(path))
+            ngram.write_checkpoint(path, 42)
+            self.assertEqual(42, ngram.read_checkpoint(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
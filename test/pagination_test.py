@@ -0,0 +1,162 @@
+import time
+import unittest
+from array import array
+import helper
+import pagination
+from pagination import Window, WindowCache, Ranking
+
+
+class CursorTest(unittest.TestCase):
+    def test_encode_decode(self):
+        token = pagination.encode(42, True, False, 'abc')
+        self.assertEqual((42, True, False, 'abc'), pagination.decode(token))
+        token = pagination.encode(7, False, True)
+        self.assertEqual((7, False, True, None), pagination.decode(token))
+
+    def test_decode_invalid(self):
+        for token in ('', 'xyz', pagination.encode(-1, True, False)):
+            with self.assertRaises(ValueError):
+                pagination.decode(token)
+
+    def test_to_range(self):
+        self.assertEqual((None, 10), pagination.to_range(10, True))
+        self.assertEqual((9, None), pagination.to_range(10, False))
+
+    def test_cursors(self):
+        # newest first: next goes down from the last id, prev up from the first
+        next_cursor, prev_cursor = pagination.cursors(
+            [30, 20, 10], 3, False, False)
+        self.assertEqual((10, False, False, None),
+                         pagination.decode(next_cursor))
+        self.assertEqual((30, True, False, None),
+                         pagination.decode(prev_cursor))
+
+        # the bottom was reached
+        next_cursor, _ = pagination.cursors([30, 20], 3, False, False)
+        self.assertIsNone(next_cursor)
+
+        # oldest first: next goes up
+        next_cursor, prev_cursor = pagination.cursors(
+            [10, 20, 30], 3, True, True, 'w')
+        self.assertEqual((30, True, True, 'w'),
+                         pagination.decode(next_cursor))
+        self.assertEqual((10, False, True, 'w'),
+                         pagination.decode(prev_cursor))
+
+        # an empty page going up can be polled
+        next_cursor, prev_cursor = pagination.cursors(
+            [], 3, True, True, since_id=30)
+        self.assertEqual((30, True, True, None),
+                         pagination.decode(next_cursor))
+        self.assertIsNone(prev_cursor)
+
+
+class WindowTest(unittest.TestCase):
+    def setUp(self):
+        # every match in (5, 100]
+        self.window = Window('k', array('I', [10, 20, 30, 40, 50]), 5, 100)
+
+    def test_page_desc(self):
+        self.assertEqual([40, 30], self.window.page(2, 45, None, False))
+        self.assertEqual([50, 40], self.window.page(2, 100, None, False))
+        # above the window
+        self.assertIsNone(self.window.page(2, 101, None, False))
+        # ids below 5 are unknown
+        self.assertIsNone(self.window.page(2, 15, None, False))
+        self.assertEqual([10], self.window.page(2, 15, 5, False))
+
+    def test_page_desc_complete(self):
+        window = Window('k', array('I', [10, 20]), 0, 100)
+        self.assertEqual([10], window.page(2, 15, None, False))
+        self.assertEqual([], window.page(2, 5, None, False))
+
+    def test_page_asc(self):
+        self.assertEqual([20, 30], self.window.page(2, None, 10, True))
+        self.assertEqual([30], self.window.page(2, 35, 20, True))
+        # ids above 100 are unknown
+        self.assertIsNone(self.window.page(2, None, 40, True))
+        self.assertIsNone(self.window.page(2, None, 100, True))
+
+    def test_build_window_desc(self):
+        window = pagination.build_window('k', [50, 40, 30], 3, None, None, False)
+        self.assertEqual([30, 40, 50], list(window.ids))
+        self.assertEqual((29, 50), (window.lo, window.hi))
+
+        window = pagination.build_window('k', [50, 40], 3, 60, None, False)
+        self.assertEqual((0, 60), (window.lo, window.hi))
+
+        self.assertIsNone(
+            pagination.build_window('k', [], 3, None, None, False))
+
+    def test_build_window_asc(self):
+        window = pagination.build_window('k', [10, 20, 30], 3, None, 5, True)
+        self.assertEqual([10, 20, 30], list(window.ids))
+        self.assertEqual((5, 30), (window.lo, window.hi))
+
+        window = pagination.build_window('k', [10], 3, 60, 5, True)
+        self.assertEqual((5, 60), (window.lo, window.hi))
+
+
+class RankingTest(unittest.TestCase):
+    def setUp(self):
+        self.ranking = Ranking(
+            'k', [0.5, 1.2, 0.5, 1.2, 0.1], [1, 2, 3, 4, 5])
+
+    def test_order(self):
+        self.assertEqual([4, 2, 3, 1, 5], self.ranking.ids)
+        self.assertEqual([1.2, 1.2, 0.5, 0.5, 0.1], self.ranking.scores)
+
+    def test_encode_decode(self):
+        token = pagination.encode_ranked(0.5, 3, True, 'w')
+        self.assertEqual((0.5, 3, True, 'w'), pagination.decode_ranked(token))
+        with self.assertRaises(ValueError):
+            pagination.decode_ranked(pagination.encode(3, True, False))
+
+    def test_page(self):
+        ranking = self.ranking
+        self.assertEqual((0, 2), ranking.page(2))
+        self.assertEqual((2, 4), ranking.page(2, (1.2, 2, False)))
+        self.assertEqual((4, 5), ranking.page(2, (0.5, 1, False)))
+        self.assertEqual((0, 2), ranking.page(2, (0.5, 3, True)))
+        # a cursor of an earlier ranking still lands in place
+        self.assertEqual((2, 4), ranking.page(2, (0.7, 9, False)))
+
+    def test_cursors(self):
+        ranking = self.ranking
+        next_cursor, prev_cursor = ranking.cursors(0, 2)
+        self.assertIsNone(prev_cursor)
+        self.assertEqual(
+            (1.2, 2, False, None), pagination.decode_ranked(next_cursor))
+        next_cursor, prev_cursor = ranking.cursors(4, 5, 'w')
+        self.assertIsNone(next_cursor)
+        self.assertEqual(
+            (0.1, 5, True, 'w'), pagination.decode_ranked(prev_cursor))
+        self.assertEqual((None, None), ranking.cursors(5, 5))
+
+
+class WindowCacheTest(unittest.TestCase):
+    def test_get(self):
+        cache = WindowCache(ttl=60, max_entries=2)
+        window = Window('k', array('I'), 0, 10)
+        window_id = cache.put(window)
+        self.assertIs(window, cache.get(window_id, 'k'))
+        # a cursor passed along with another keyword
+        self.assertIsNone(cache.get(window_id, 'other'))
+        self.assertIsNone(cache.get('missing', 'k'))
+
+    def test_ttl(self):
+        cache = WindowCache(ttl=60)
+        window_id = cache.put(Window('k', array('I'), 0, 10))
+        cache.entries[window_id] = (
+            cache.entries[window_id][0], time.time() - 61)
+        self.assertIsNone(cache.get(window_id, 'k'))
+
+    def test_max_entries(self):
+        cache = WindowCache(ttl=60, max_entries=2)
+        ids = [cache.put(Window('k', array('I'), 0, 10)) for _ in range(3)]
+        self.assertIsNone(cache.get(ids[0], 'k'))
+        self.assertIsNotNone(cache.get(ids[2], 'k'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import tempfile
+import unittest
+import helper
+import planner
+import utils
+from term_stats import TermStats
+
+
+def build_stats(comments):
+    stats = TermStats()
+    for image_id, comment in enumerate(comments, 1):
+        stats.add(image_id, comment)
+    return stats
+
+
+class TermStatsTest(unittest.TestCase):
+    def test_estimate(self):
+        stats = build_stats(['仁奈ちゃん', '仁奈 みりあ', 'みりあ', 'Café'])
+        self.assertEqual(2, stats.estimate('仁奈'))
+        self.assertEqual(1, stats.estimate('仁奈ちゃん'))
+        self.assertEqual(2, stats.estimate('り'))
+        self.assertEqual(0, stats.estimate('奈緒'))
+        self.assertEqual(1, stats.estimate('CAFE'))
+
+    def test_merge(self):
+        stats = build_stats(['仁奈ちゃん', 'みりあ'])
+        other = TermStats()
+        other.add(5, '仁奈')
+        stats.merge(other)
+        self.assertEqual(3, stats.documents)
+        self.assertEqual(5, stats.max_image_id)
+        self.assertEqual(2, stats.estimate('仁奈'))
+
+    def test_save_load(self):
+        stats = build_stats(['仁奈ちゃん'])
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'stats.json')
+            stats.save(path)
+            loaded = TermStats.load(path)
+        self.assertEqual(stats.df, loaded.df)
+        self.assertEqual(1, loaded.max_image_id)
+
+
+class PlannerTest(unittest.TestCase):
+    def setUp(self):
+        self.stats = build_stats(
+            ['仁奈ちゃん', '仁奈 みりあ', 'みりあ', 'みりあ 薫', '♂'])
+
+    def test_drop_redundant_and(self):
+        plan = planner.plan({'and': ['仁奈', '仁奈ちゃん', '仁奈']})
+        self.assertEqual(['仁奈ちゃん'], plan['and'])
+
+    def test_drop_redundant_or(self):
+        plan = planner.plan({'or': ['仁奈ちゃん', '仁奈', 'みりあ']})
+        self.assertEqual(['仁奈', 'みりあ'], plan['or'])
+
+    def test_or_implied_by_and(self):
+        plan = planner.plan({'and': ['仁奈ちゃん'], 'or': ['仁奈', 'みりあ']})
+        self.assertEqual([], plan['or'])
+
+    def test_drop_redundant_ex(self):
+        plan = planner.plan({'and': ['薫'], 'ex': ['仁奈', '仁']})
+        self.assertEqual(['仁'], plan['ex'])
+
+    def test_ex_contradicts_and(self):
+        plan = planner.plan({'and': ['仁奈ちゃん'], 'ex': ['ちゃ']})
+        self.assertTrue(plan['empty'])
+
+    def test_or_excluded(self):
+        plan = planner.plan({'or': ['仁奈', 'みりあ'], 'ex': ['り']})
+        self.assertEqual(['仁奈'], plan['or'])
+        plan = planner.plan({'or': ['仁奈', 'みりあ'], 'ex': ['り', '奈']})
+        self.assertTrue(plan['empty'])
+
+    def test_rarest_first(self):
+        plan = planner.plan({'and': ['みりあ', '仁奈']}, self.stats)
+        self.assertEqual(['仁奈', 'みりあ'], plan['and'])
+        self.assertEqual('仁奈', plan['prefilter'])
+
+    def test_no_prefilter_for_like_only(self):
+        plan = planner.plan({'and': ['♂', 'みりあ']}, self.stats)
+        self.assertEqual('♂', plan['and'][0])
+        self.assertIsNone(plan['prefilter'])
+
+    def test_zero_hits(self):
+        # an estimate of 0 may be wrong, so no rows are ruled out by it
+        plan = planner.plan({'and': ['みりあ', '奈緒']}, self.stats)
+        join, where, params = planner.build_query(plan)
+        self.assertNotIn('i.id >', where)
+        self.assertEqual(['奈緒', '%奈緒%'], params[:2])
+        self.assertIn('AS prefilter', join)
+
+    def test_verify(self):
+        plan = planner.plan({'and': ['仁奈'], 'or': ['みりあ', '薫']})
+        self.assertTrue(planner.verify(plan, '仁奈ちゃんと薫'))
+        self.assertFalse(planner.verify(plan, '仁 奈ちゃんと薫'))
+        self.assertFalse(planner.verify(plan, '仁奈ちゃん'))
+        self.assertFalse(planner.verify(plan, None))
+
+    def test_needs_verification(self):
+        plan = planner.plan({'and': ['仁奈'], 'ex': ['r-18']})
+        match_mode = utils.MATCH_MODE
+        try:
+            utils.MATCH_MODE = 'natural'
+            self.assertFalse(planner.needs_verification(plan))
+            utils.MATCH_MODE = 'ngram'
+            self.assertTrue(planner.needs_verification(plan))
+            join, where, params = planner.build_query(plan, exact=False)
+        finally:
+            utils.MATCH_MODE = match_mode
+        self.assertEqual(['"仁奈"', '%r-18%'], params)
+
+    def test_without_stats(self):
+        plan = planner.plan({'and': ['みりあ', '仁奈']})
+        self.assertEqual(['みりあ', '仁奈'], plan['and'])
+        self.assertIsNone(plan['prefilter'])
+        where, params = planner.build_search_query_from_dic(plan)
+        self.assertEqual(('', where, params), planner.build_query(plan))
+
+
+if __name__ == '__main__':
+    unittest.main()
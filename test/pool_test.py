@@ -0,0 +1,66 @@
+import unittest
+import helper
+import MySQLdb
+import pool
+
+
+class FakeConnection:
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+
+    def ping(self):
+        if not self.alive:
+            raise MySQLdb.OperationalError(2006, 'MySQL server has gone away')
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = pool.ConnectionPool(FakeConnection, max_size=2, timeout=0)
+
+    def test_reuse(self):
+        conn = self.pool.checkout()
+        self.pool.checkin(conn)
+        self.assertIs(conn, self.pool.checkout())
+
+    def test_bounded(self):
+        self.pool.checkout()
+        self.pool.checkout()
+        with self.assertRaises(pool.PoolTimeout):
+            self.pool.checkout()
+
+    def test_ping_on_checkout(self):
+        conn = self.pool.checkout()
+        self.pool.checkin(conn)
+        conn.alive = False
+        new_conn = self.pool.checkout()
+        self.assertIsNot(conn, new_conn)
+        self.assertTrue(conn.closed)
+
+    def test_fill(self):
+        self.pool.fill(5)
+        self.assertEqual(2, self.pool.size)
+        self.assertEqual(2, len(self.pool.idle))
+        # checking out does not open another connection
+        self.pool.checkout()
+        self.assertEqual(2, self.pool.size)
+        self.assertEqual(1, len(self.pool.idle))
+        self.pool.fill(1)
+        self.assertEqual(2, self.pool.size)
+
+    def test_max_lifetime(self):
+        self.pool.max_lifetime = -1
+        conn = self.pool.checkout()
+        self.pool.checkin(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(0, self.pool.size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+import helper
+import related
+import search_index
+
+
+def signature(comment):
+    return related.signature(search_index.tokenize(comment))
+
+
+class RelatedTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'related')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def build(self, comments):
+        builder = related.Builder()
+        for image_id, comment in comments.items():
+            builder.add(image_id, signature(comment))
+        builder.save(self.path)
+        return related.RelatedIndex.open(self.path)
+
+    def test_signature(self):
+        self.assertIsNone(signature('薫'))
+        self.assertEqual(signature('美玲ちゃん'), signature('美玲ちゃん'))
+        self.assertEqual(related.HASHES, len(signature('美玲')))
+
+    def test_similarity(self):
+        a = signature('今日も元気な仁奈ちゃんです')
+        b = signature('今日も元気な仁奈ちゃんでした')
+        c = signature('うさちゃんロボ')
+        same = sum(x == y for x, y in zip(a, b))
+        other = sum(x == y for x, y in zip(a, c))
+        self.assertGreater(same, other)
+
+    def test_jaccard(self):
+        self.assertEqual(0.5, related.jaccard({'ab', 'bc'}, {'ab'}))
+        self.assertEqual(0.0, related.jaccard(set(), {'ab'}))
+
+    def test_related(self):
+        index = self.build({
+            # added out of order
+            4: '今日も元気な仁奈ちゃんでした',
+            1: '今日も元気な仁奈ちゃんです',
+            2: 'うさちゃんロボ',
+            3: '今日も元気な仁奈ちゃんです',
+            5: '薫',
+        })
+        self.assertEqual([1, 2, 3, 4], list(index.ids))
+        ranked = index.related(
+            signature('今日も元気な仁奈ちゃんです'), 10, exclude=1)
+        self.assertEqual([3, 4], [image_id for image_id, _ in ranked])
+        self.assertEqual(1.0, ranked[0][1])
+        self.assertLess(ranked[1][1], 1.0)
+        self.assertEqual([], index.related(None, 10))
+
+    def test_empty(self):
+        index = self.build({})
+        self.assertEqual([], index.related(signature('美玲'), 10))
+
+    def test_broken(self):
+        self.build({1: '美玲'})
+        with open(self.path, 'ab') as f:
+            f.write(b'\0')
+        with self.assertRaises(ValueError):
+            related.RelatedIndex.open(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import unittest
+import helper
+import os
+from unittest import mock
+import api
+import count_cache
+import pool
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, params=None):
+        self.conn.queries.append(query)
+
+    def fetchone(self):
+        return {'max_id': self.conn.head, 'cnt': self.conn.head}
+
+
+class FakeConnection:
+    def __init__(self, head):
+        self.head = head
+        self.queries = []
+
+    def ping(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def cursor(self, cursorclass=None):
+        return FakeCursor(self)
+
+
+class ReplicaRoutingTest(unittest.TestCase):
+    def setUp(self):
+        self.conns = {
+            api.PRIMARY: FakeConnection(100),
+            'replica1': FakeConnection(90),
+            'replica2:3307': FakeConnection(80),
+        }
+        self.orig = api.DB_REPLICAS, api._pools, api._pools_pid
+        api.DB_REPLICAS = ['replica1', 'replica2:3307']
+        api._pools = {
+            target: pool.ConnectionPool(lambda conn=conn: conn)
+            for target, conn in self.conns.items()
+        }
+        api._pools_pid = os.getpid()
+        api._replica_heads.clear()
+        self.count_cache = count_cache.CountCache()
+
+    def tearDown(self):
+        api.DB_REPLICAS, api._pools, api._pools_pid = self.orig
+        api._replica_heads.clear()
+
+    def target(self, **kwargs):
+        with api.app.test_request_context():
+            c = api.db(**kwargs)
+            # the same request stays on the same connection
+            self.assertIs(api.db(**kwargs).conn, c.conn)
+            return next(
+                target for target, conn in self.conns.items()
+                if conn is c.conn)
+
+    def test_writes_go_to_primary(self):
+        self.assertEqual(self.target(), api.PRIMARY)
+
+    def test_reads_rotate(self):
+        targets = {self.target(read=True) for _ in range(4)}
+        self.assertEqual(targets, {'replica1', 'replica2:3307'})
+
+    def test_lagging_replica(self):
+        targets = [self.target(read=True, min_id=85) for _ in range(4)]
+        self.assertEqual(sorted(set(targets)), [api.PRIMARY, 'replica1'])
+        # replica1 is not asked again for ids it is known to have
+        queries = len(self.conns['replica1'].queries)
+        self.target(read=True, min_id=85)
+        self.target(read=True, min_id=85)
+        self.assertEqual(len(self.conns['replica1'].queries), queries)
+
+    def test_recent_write(self):
+        with mock.patch.object(api.invalidation, 'written_at',
+                               return_value=api.time.time()):
+            self.assertEqual(self.target(read=True), api.PRIMARY)
+        with mock.patch.object(api.invalidation, 'written_at',
+                               return_value=api.time.time() - 60):
+            self.assertNotEqual(self.target(read=True), api.PRIMARY)
+
+    def test_count_cache_per_target(self):
+        # a lagging replica and the primary take turns
+        for target in ['replica1', api.PRIMARY] * 3:
+            conn = self.conns[target]
+            with api.app.test_request_context(), \
+                    mock.patch.object(api.count_cache, 'cache',
+                                      self.count_cache):
+                api.g.replica = None
+                if target != api.PRIMARY:
+                    api.g.replica = (target, conn)
+                self.assertEqual(conn.head, api.whole_count(
+                    conn.cursor(), conn.head, {'and': ['a']}, 'TRUE',
+                    'cached'))
+                api.g.replica = None
+        # each counted once
+        for target in ('replica1', api.PRIMARY):
+            self.assertEqual(1, len(self.conns[target].queries))
+
+    def test_no_replicas(self):
+        api.DB_REPLICAS = []
+        self.assertEqual(self.target(read=True, min_id=1), api.PRIMARY)
+
+    def test_newest_id(self):
+        self.assertIsNone(api.newest_id(None, None))
+        self.assertEqual(api.newest_id(10, None), 10)
+        self.assertEqual(api.newest_id(None, 20), 20)
+        self.assertEqual(api.newest_id(10, 5), 10)
+
+    def test_preload_without_db(self):
+        def connect_db(target=api.PRIMARY):
+            raise api.MySQLdb.OperationalError(2003, 'down')
+
+        with mock.patch.object(api, 'SEARCH_BACKEND', 'memory'), \
+                mock.patch.object(api, 'connect_db', connect_db), \
+                self.assertLogs(api.app.logger, 'ERROR'):
+            api.preload()
+
+    def test_connect_target(self):
+        calls = []
+        env = {
+            'DB_USER': 'u', 'DB_PASSWD': 'p', 'DB_HOST': 'primary',
+            'DB_PORT': '3306', 'DB_NAME': 'sukui', 'TEST_DB_NAME': 'test',
+        }
+        with mock.patch.dict(os.environ, env), \
+                mock.patch.object(api.MySQLdb, 'connect',
+                                  lambda **kwargs: calls.append(kwargs)):
+            api.connect_db('replica2:3307')
+            api.connect_db('replica1')
+        self.assertEqual(calls[0]['host'], 'replica2')
+        self.assertEqual(calls[0]['port'], 3307)
+        self.assertEqual(calls[1]['host'], 'replica1')
+        self.assertEqual(calls[1]['port'], 3306)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+import helper
+import response_cache
+
+
+class FakeStore:
+    def __init__(self):
+        self.entries = {}
+        self.gen = b'0'
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, etag, body, expires_at):
+        self.entries[key] = (etag, body, expires_at)
+
+    def generation(self):
+        return self.gen
+
+    def invalidate(self):
+        self.entries.clear()
+        self.gen = str(int(self.gen) + 1).encode()
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def test_get_put(self):
+        cache = response_cache.ResponseCache(max_bytes=100)
+        self.assertIsNone(cache.get('/image/1?'))
+        etag, body = cache.put('/image/1?', b'{}')
+        self.assertEqual((etag, body), cache.get('/image/1?'))
+
+    def test_byte_cap(self):
+        cache = response_cache.ResponseCache(max_bytes=10)
+        cache.put('a', b'x' * 6)
+        cache.put('b', b'x' * 6)
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('b'))
+        self.assertEqual(6, cache.size)
+
+    def test_ttl(self):
+        store = FakeStore()
+        cache = response_cache.ResponseCache(shared=store, ttl=-1)
+        cache.put('a', b'{}')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, cache.size)
+
+    def test_invalidate(self):
+        cache = response_cache.ResponseCache()
+        cache.put('a', b'{}')
+        cache.invalidate()
+        self.assertIsNone(cache.get('a'))
+
+    def test_shared(self):
+        store = FakeStore()
+        worker1 = response_cache.ResponseCache(shared=store)
+        worker2 = response_cache.ResponseCache(shared=store)
+        entry = worker1.put('a', b'{}')
+        self.assertEqual(entry, worker2.get('a'))
+
+        worker1.invalidate()
+        self.assertIsNone(worker2.get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
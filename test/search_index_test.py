@@ -0,0 +1,99 @@
+import unittest
+from array import array
+import helper
+import search_index
+
+
+def build_index(rows):
+    index = search_index.InvertedIndex()
+    for image_id, comment in rows:
+        index.add(image_id, comment)
+    return index
+
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = build_index([
+            (1, '仁奈ちゃん'),
+            (2, '仁奈 みりあ'),
+            (3, 'みりあ R-18'),
+            (4, '奈緒 ♂'),
+            (5, '緒奈 仁'),
+        ])
+
+    def test_intersect(self):
+        self.assertEqual(
+            array('I', [2, 5]),
+            search_index.intersect(array('I', [1, 2, 5]), array('I', [2, 3, 5]))
+        )
+
+    def test_union(self):
+        self.assertEqual(
+            array('I', [1, 2, 3, 5]),
+            search_index.union(array('I', [1, 2, 5]), array('I', [2, 3]))
+        )
+
+    def test_difference(self):
+        self.assertEqual(
+            array('I', [1]),
+            search_index.difference(array('I', [1, 2, 5]), array('I', [2, 5]))
+        )
+
+    def test_search_and(self):
+        self.assertEqual(
+            [2],
+            list(self.index.search({'and': ['仁奈', 'みりあ']}))
+        )
+
+    def test_search_verifies_bigram_candidates(self):
+        self.assertEqual([4], list(self.index.search({'and': ['奈緒']})))
+
+    def test_update(self):
+        self.index.update(3, 'みりあ 奈緒')
+        self.assertEqual([3, 4], list(self.index.search({'and': ['奈緒']})))
+        self.assertEqual([], list(self.index.search({'and': ['r-18']})))
+        self.index.update(1, None)
+        self.assertEqual([2], list(self.index.search({'and': ['仁奈']})))
+        self.index.update(1, '仁奈')
+        self.assertEqual([1, 2], list(self.index.search({'and': ['仁奈']})))
+        # left to the next load
+        self.index.update(6, '仁奈')
+        self.assertEqual(5, self.index.max_id)
+
+    def test_search_or(self):
+        self.assertEqual(
+            [1, 2, 3],
+            list(self.index.search({'or': ['仁奈', 'みりあ']}))
+        )
+
+    def test_search_ex(self):
+        self.assertEqual(
+            [1],
+            list(self.index.search({'and': ['仁奈'], 'ex': ['みりあ']}))
+        )
+
+    def test_search_case_insensitive(self):
+        self.assertEqual([3], list(self.index.search({'and': ['r-18']})))
+
+    def test_search_length_1(self):
+        self.assertEqual([4], list(self.index.search({'and': ['♂']})))
+        self.assertEqual([1, 2, 5], list(self.index.search({'and': ['仁']})))
+        self.assertEqual([], list(self.index.search({'and': ['x']})))
+
+    def test_search_url(self):
+        self.index.add(6, 'see https://example.com/page')
+        for term in ('example', 'com/pa', 'https://example.com'):
+            with self.subTest(term=term):
+                self.assertEqual(
+                    [6], list(self.index.search({'and': [term]})))
+
+    def test_paginate(self):
+        ids = array('I', range(1, 11))
+        self.assertEqual([10, 9, 8], search_index.paginate(ids, 3))
+        self.assertEqual([5, 4], search_index.paginate(ids, 2, max_id=5))
+        self.assertEqual(
+            [8, 9], search_index.paginate(ids, 2, since_id=7, _reversed=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
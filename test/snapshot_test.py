@@ -0,0 +1,121 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+import helper
+import snapshot
+
+
+def row(i):
+    has_info = i % 3 != 0
+    return {
+        'id': i,
+        'filename': f'{i}.png',
+        'created_at': datetime(2020, 1, 1, 0, 0, i % 60, 123),
+        'image_info_id': i + 1000 if has_info else None,
+        'comment': f'仁奈{i}' if has_info else None,
+        'source': 'https://example.com' if i % 2 and has_info else None,
+    }
+
+
+IDS = [i for i in range(1, 40) if i % 7]
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'snapshot')
+        rows = [row(i) for i in IDS]
+        # several segments
+        snapshot.write(self.path, [rows[:10], [], rows[10:20], rows[20:30]])
+        self.snapshot = snapshot.Snapshot.open(self.path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_get(self):
+        self.assertEqual(3, len(self.snapshot.segments))
+        for i in IDS[:30]:
+            self.assertEqual(row(i), self.snapshot.get(i))
+        self.assertIsNone(self.snapshot.get(7))
+        self.assertIsNone(self.snapshot.get(0))
+        self.assertIsNone(self.snapshot.get(IDS[30]))
+        self.assertEqual(IDS[29], self.snapshot.max_id)
+
+    def test_page(self):
+        ids = IDS[:30]
+        for max_id in (None, 0, 1, 7, 13, 14, 20, 100):
+            for since_id in (None, 0, 1, 7, 12, 30, 100):
+                in_range = [
+                    i for i in ids
+                    if (max_id is None or i <= max_id)
+                    and (since_id is None or i > since_id)
+                ]
+                for count in (1, 5, 40):
+                    self.assertEqual(
+                        in_range[:count],
+                        [x['id'] for x in self.snapshot.page(
+                            count, max_id, since_id, True)])
+                    self.assertEqual(
+                        in_range[::-1][:count],
+                        [x['id'] for x in self.snapshot.page(
+                            count, max_id, since_id, False)])
+                self.assertEqual(
+                    len(in_range), self.snapshot.count(max_id, since_id))
+
+    def test_append(self):
+        # a segment cut short by a failed append
+        with open(self.path, 'ab') as f:
+            f.write(snapshot.pack_segment([row(IDS[30])])[:-8])
+        self.assertEqual(IDS[29], snapshot.Snapshot.open(self.path).max_id)
+
+        rows = [row(i) for i in IDS]
+        appended = snapshot.append(self.path, [rows[25:32], rows[32:]])
+        self.assertEqual(len(IDS) - 30, appended)
+        appended = snapshot.Snapshot.open(self.path)
+        self.assertEqual(IDS, [x['id'] for x in appended.page(100, asc=True)])
+        self.assertEqual(appended.size, os.path.getsize(self.path))
+        self.assertEqual(self.snapshot.token, appended.token)
+
+    def test_stale(self):
+        with mock.patch.object(snapshot, 'PATH', self.path):
+            snapshot.refresh()
+            current = snapshot.get_snapshot()
+            self.assertEqual(self.snapshot.token, current.token)
+            snapshot.invalidate()
+            self.assertIsNone(snapshot.get_snapshot())
+            # only a new export is trusted again
+            snapshot.append(self.path, [[row(IDS[30])]])
+            snapshot.refresh()
+            self.assertIsNone(snapshot.get_snapshot())
+            snapshot.write(self.path, [[row(1)]])
+            snapshot.refresh()
+            self.assertEqual(1, snapshot.get_snapshot().max_id)
+        snapshot.refresh()
+
+    def test_export_during_edit(self):
+        def iter_rows(conn, since_id, batch_size):
+            yield [row(i) for i in IDS[:5]]
+            if edit:
+                # a PATCH of a row already read
+                snapshot.invalidate()
+            yield [row(i) for i in IDS[5:]]
+
+        with mock.patch.object(snapshot, 'PATH', self.path), \
+                mock.patch.object(snapshot, 'connect_db', mock.Mock()), \
+                mock.patch.object(snapshot, 'iter_rows', iter_rows):
+            snapshot.invalidate()
+            for edit in (True, False):
+                snapshot.export(self.path)
+                snapshot.refresh()
+                if edit:
+                    self.assertIsNone(snapshot.get_snapshot())
+                else:
+                    self.assertEqual(
+                        IDS[-1], snapshot.get_snapshot().max_id)
+        snapshot.refresh()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,35 @@
 import unittest
 import json
+from datetime import datetime
 from urllib.parse import quote
 import helper
 import utils
 
 
+def stdlib_dumps(obj):
+    return json.dumps(obj, default=utils.serialize)
+
+
+ROWS = [
+    {
+        'id': 1,
+        'filename': 'a.png',
+        'created_at': datetime(2017, 4, 1, 12, 34, 56),
+        'image_info_id': None,
+        'comment': None,
+        'source': None,
+    },
+    {
+        'id': 2,
+        'filename': 'b/c.png',
+        'created_at': datetime(2017, 4, 1, 12, 34, 56, 789),
+        'image_info_id': 10,
+        'comment': '奈緒 "♂" \\ \t\x7f\u2028😀',
+        'source': 'https://example.com/?a=1&b=2',
+    },
+]
+
+
 class UtilsTest(unittest.TestCase):
     def test_ngram(self):
         self.assertEqual(
@@ -24,6 +49,169 @@ class UtilsTest(unittest.TestCase):
             utils.ngram('薫')
         )
 
+    def test_build_match_unit_with_unigram_table(self):
+        unigram_table = utils.UNIGRAM_TABLE
+        utils.UNIGRAM_TABLE = 'image_unigram'
+        try:
+            # not searched before the API found it filled
+            self.assertEqual('like', utils.match_kind('♂'))
+            utils.unigram_ready = True
+            unit, params = utils.build_match_unit('♂')
+        finally:
+            utils.UNIGRAM_TABLE = unigram_table
+            utils.unigram_ready = False
+        self.assertEqual(
+            'ii.image_id IN (SELECT image_id FROM image_unigram '
+            'WHERE ch = %s) AND ii.comment LIKE %s',
+            unit
+        )
+        self.assertEqual(['♂', '%♂%'], params)
+
+    def test_build_match_unit_with_ngram_mode(self):
+        match_mode = utils.MATCH_MODE
+        utils.MATCH_MODE = 'ngram'
+        try:
+            unit, params = utils.build_match_unit('仁奈ちゃん')
+            loose, loose_params = utils.build_match_unit(
+                '仁奈ちゃん', exact=False)
+            # the parser would split these at the symbols
+            kinds = [utils.match_kind(x) for x in ('r-18', '@aoi', '薫')]
+        finally:
+            utils.MATCH_MODE = match_mode
+        self.assertEqual(
+            'MATCH (ii.comment_ngram) AGAINST (%s IN BOOLEAN MODE) '
+            'AND ii.comment LIKE %s',
+            unit
+        )
+        self.assertEqual(['"仁奈 奈ち ちゃ ゃん"', '%仁奈ちゃん%'], params)
+        self.assertEqual(
+            'MATCH (ii.comment_ngram) AGAINST (%s IN BOOLEAN MODE)', loose)
+        self.assertEqual(['"仁奈 奈ち ちゃ ゃん"'], loose_params)
+        self.assertEqual(['word', 'word', 'prefix'], kinds)
+
+    def test_parse_projection(self):
+        self.assertEqual((None, 'rows'), utils.parse_projection({}))
+        self.assertEqual(
+            (frozenset({'id', 'thumbnail_url'}), 'columns'),
+            utils.parse_projection(
+                {'fields': 'thumbnail_url', 'format': 'columns'})
+        )
+        with self.assertRaises(ValueError):
+            utils.parse_projection({'fields': 'id,password'})
+        with self.assertRaises(ValueError):
+            utils.parse_projection({'format': 'xml'})
+
+    def test_select_columns(self):
+        self.assertEqual(utils.COLUMNS, utils.select_columns(None))
+        self.assertEqual(
+            ('i.id AS id', 'i.filename AS filename'),
+            utils.select_columns(frozenset({'id', 'thumbnail_url'}))
+        )
+        query = utils.build_images_query(
+            'i.id <= %s', False,
+            columns=utils.select_columns(frozenset({'id'})))
+        self.assertNotIn('image_info', query)
+
+    def test_project_image_info(self):
+        for row in ROWS:
+            self.assertEqual(
+                utils.build_image_info(row),
+                utils.project_image_info(row, frozenset(utils.FIELDS))
+            )
+        self.assertEqual(
+            {'id': 2, 'urls': {
+                'thumbnail_url': utils.THUMBNAIL_URL_PREFIX + 'b/c.png'}},
+            utils.project_image_info(
+                ROWS[1], frozenset({'id', 'thumbnail_url'}))
+        )
+
+    def test_build_columns(self):
+        prefixes, data = utils.build_columns(
+            ROWS, frozenset({'id', 'original_url', 'comment'}))
+        self.assertEqual({'original_url': utils.IMAGE_URL_PREFIX}, prefixes)
+        self.assertEqual({
+            'id': [1, 2],
+            'filename': ['a.png', 'b/c.png'],
+            'comment': [None, ROWS[1]['comment']],
+        }, data)
+
+    def test_like_pattern(self):
+        self.assertEqual('%r-18%', utils.like_pattern('r-18'))
+        self.assertEqual('%100\\%\\_\\\\%', utils.like_pattern('100%_\\'))
+
+    def test_build_search_query_from_dic(self):
+        query, params = utils.build_search_query_from_dic({
+            'and': ['仁奈', '薫'],
+            'or': ['みりあ', '♂'],
+            'ex': ['r-18'],
+        })
+        self.assertEqual(query.count('%s'), len(params))
+        self.assertEqual(
+            ['仁奈', '%仁奈%', utils.ngram('薫'), 'みりあ', '%みりあ%',
+             '%♂%', '%r-18%'],
+            params
+        )
+        # same shape, same text
+        other, _ = utils.build_search_query_from_dic({
+            'and': ['奈緒', '杏'],
+            'or': ['きらり', '♂'],
+            'ex': ['r-15'],
+        })
+        self.assertIs(query, other)
+
+    def test_build_range_query(self):
+        self.assertEqual(('', []), utils.build_range_query(None, None))
+        self.assertEqual(
+            ('i.id > %s AND i.id <= %s', [1, 2]),
+            utils.build_range_query(2, 1)
+        )
+
+    def test_build_relevance_query(self):
+        query = utils.build_relevance_query('ii.comment LIKE %s', bigrams=2)
+        # the LIKEs of the coverage only see the rows MySQL rated highest
+        outer, _, inner = query.partition('FROM (')
+        self.assertEqual(2, outer.count('LIKE %s'))
+        self.assertEqual(1, inner.count('LIKE %s'))
+        # the bigrams, where, the rows to score and the limit
+        self.assertEqual(4, inner.count('%s'))
+
+    def test_dumps_image_info(self):
+        obj = {
+            'ok': True,
+            'elapsed_time': 2.86102294921875e-05,
+            'whole_count': 2,
+            'data': [utils.build_image_info(row) for row in ROWS],
+        }
+        self.assertEqual(stdlib_dumps(obj), utils.dumps(obj))
+
+    def test_dumps_same_as_before(self):
+        # created_at used to reach json.dumps as a datetime
+        for row in ROWS:
+            info = utils.build_image_info(row)
+            raw = dict(info, created_at=row['created_at'])
+            self.assertEqual(
+                stdlib_dumps({'ok': True, 'data': raw}),
+                utils.dumps({'ok': True, 'data': info})
+            )
+
+    def test_dumps_batch(self):
+        obj = {
+            'ok': True,
+            'data': [utils.build_image_info(ROWS[1]), None],
+            'not_found': [3],
+        }
+        self.assertEqual(stdlib_dumps(obj), utils.dumps(obj))
+
+    def test_dumps_without_data(self):
+        obj = {'ok': False, 'message': 'image_not_found'}
+        self.assertEqual(stdlib_dumps(obj), utils.dumps(obj))
+
+    @unittest.skipIf(utils.fast_dumps is None, 'ujson is not installed')
+    def test_fast_dumps(self):
+        data = [utils.build_image_info(row) for row in ROWS]
+        data.append({'s': ''.join(map(chr, range(0xd800))), 'n': [2 ** 40]})
+        self.assertEqual(json.dumps(data), utils.fast_dumps(data))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,25 +1,76 @@
 import json
 import os
-import MySQLdb
-from functools import wraps
+from functools import wraps, lru_cache
 from datetime import datetime
-from flask import request, Response, g
-from dotenv import load_dotenv, find_dotenv
-load_dotenv(find_dotenv())
+from flask import request, Response
+from metrics import span
 
 IMAGE_ENDPOINT = os.environ['IMAGE_ENDPOINT']
 THUMBNAIL_ENDPOINT = os.environ['THUMBNAIL_ENDPOINT']
+IMAGE_URL_PREFIX = f'{IMAGE_ENDPOINT}/'
+THUMBNAIL_URL_PREFIX = f'{THUMBNAIL_ENDPOINT}/'
+
+# 'auto' uses ujson for response data when it is installed, 'stdlib' never
+JSON_ENCODER = os.environ.get('JSON_ENCODER', 'auto')
+# side table of (character, image_id) created by
+# `ngram.py --create-unigram-table`, empty to disable
+UNIGRAM_TABLE = os.environ.get('UNIGRAM_TABLE', '')
+# set by the API once the table is filled up to the newest rows
+unigram_ready = False
+# 'natural' matches keywords against comment, 'ngram' against the bigrams
+# in comment_ngram and leaves the LIKE check of a page to Python
+MATCH_MODE = os.environ.get('MATCH_MODE', 'natural')
+
+
+def serialize(obj):
+    # enable to serialize datetime object
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(
+        f"Object of type '{type(obj).__name__}' is not JSON serializable")
+
+
+_encoder = json.JSONEncoder(default=serialize)
+
+fast_dumps = None
+if JSON_ENCODER != 'stdlib':
+    try:
+        import ujson
+    except ImportError:
+        pass
+    else:
+        def fast_dumps(obj):
+            # same bytes as json.dumps, which also escapes DEL
+            return ujson.dumps(
+                obj,
+                ensure_ascii=True,
+                escape_forward_slashes=False,
+                separators=(', ', ': '),
+            ).replace('\x7f', '\\u007f')
+
+_DATA = '\x00data\x00'
+_DATA_JSON = json.dumps(_DATA)
+
+
+def dumps(obj):
+    # ujson writes floats differently from json (1e-5 vs 1e-05), so it only
+    # encodes the float-free 'data' and the envelope goes through json
+    data = obj.get('data') if isinstance(obj, dict) else None
+    if fast_dumps is None or not isinstance(data, (list, dict)):
+        return _encoder.encode(obj)
+    try:
+        encoded = fast_dumps(data)
+    except (TypeError, OverflowError):
+        return _encoder.encode(obj)
+    head, tail = _encoder.encode(dict(obj, data=_DATA)).split(_DATA_JSON)
+    return head + encoded + tail
 
 
 def Json(obj, status_code=200):
-    def serialize(obj):
-        # enable to serialize datetime object
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        raise TypeError(
-            f"Object of type '{type(obj).name}' is not JSON serializable")
+    with span('serialize'):
+        body = dumps(obj)
     return Response(
-        json.dumps(obj, default=serialize),
+        body,
         mimetype='application/json',
         headers={
             'Access-Control-Allow-Origin': '*',
@@ -27,95 +78,371 @@ def Json(obj, status_code=200):
     ), status_code
 
 
+FIELDS = (
+    'id', 'filename', 'created_at', 'comment',
+    'original_url', 'thumbnail_url', 'source',
+)
+COLUMNS = (
+    'i.id AS id',
+    'i.filename AS filename',
+    'i.created_at AS created_at',
+    'ii.id AS image_info_id',
+    'ii.comment AS comment',
+    'ii.source AS source',
+)
+FIELD_COLUMNS = {
+    'id': ('i.id AS id',),
+    'filename': ('i.filename AS filename',),
+    'created_at': ('i.created_at AS created_at',),
+    'comment': ('ii.id AS image_info_id', 'ii.comment AS comment'),
+    'original_url': ('i.filename AS filename',),
+    'thumbnail_url': ('i.filename AS filename',),
+    'source': ('ii.id AS image_info_id', 'ii.source AS source'),
+}
+FORMATS = ('rows', 'columns')
+
+
+def parse_projection(args):
+    # returns (fields, format); fields is None when every field is wanted
+    fmt = args.get('format', 'rows')
+    if fmt not in FORMATS:
+        raise ValueError('invalid format parameter')
+    value = args.get('fields', '')
+    if not value:
+        return None, fmt
+    fields = frozenset(x for x in value.split(',') if x)
+    unknown = fields.difference(FIELDS)
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(sorted(unknown))}")
+    # the id is needed to page on
+    return fields | {'id'}, fmt
+
+
+@lru_cache(maxsize=None)
+def select_columns(fields):
+    if fields is None:
+        return COLUMNS
+    wanted = {c for f in fields for c in FIELD_COLUMNS[f]}
+    return tuple(c for c in COLUMNS if c in wanted)
+
+
+def project_image_info(dic, fields):
+    # build_image_info with only the given fields
+    if fields is None:
+        return build_image_info(dic)
+    ret = {'id': dic['id']}
+    if 'filename' in fields:
+        ret['filename'] = dic['filename']
+    if 'created_at' in fields:
+        created_at = dic['created_at']
+        if isinstance(created_at, datetime):
+            created_at = created_at.isoformat()
+        ret['created_at'] = created_at
+    has_info = dic.get('image_info_id') is not None
+    if 'comment' in fields and has_info:
+        ret['comment'] = dic['comment']
+    urls = {}
+    if 'original_url' in fields:
+        urls['original_url'] = IMAGE_URL_PREFIX + dic['filename']
+    if 'thumbnail_url' in fields:
+        urls['thumbnail_url'] = THUMBNAIL_URL_PREFIX + dic['filename']
+    if 'source' in fields and has_info:
+        urls['source'] = dic['source']
+    if urls:
+        ret['urls'] = urls
+    return ret
+
+
+def build_columns(rows, fields):
+    # format=columns: one array per field, URLs as a prefix plus filename;
+    # returns (prefixes, data)
+    if fields is None:
+        fields = frozenset(FIELDS)
+    data = {'id': [row['id'] for row in rows]}
+    if fields & {'filename', 'original_url', 'thumbnail_url'}:
+        data['filename'] = [row['filename'] for row in rows]
+    if 'created_at' in fields:
+        data['created_at'] = [
+            x.isoformat() if isinstance(x, datetime) else x
+            for x in (row['created_at'] for row in rows)
+        ]
+    if 'comment' in fields:
+        data['comment'] = [row['comment'] for row in rows]
+    if 'source' in fields:
+        data['source'] = [row['source'] for row in rows]
+    prefixes = {}
+    if 'original_url' in fields:
+        prefixes['original_url'] = IMAGE_URL_PREFIX
+    if 'thumbnail_url' in fields:
+        prefixes['thumbnail_url'] = THUMBNAIL_URL_PREFIX
+    return prefixes, data
+
+
 def build_image_info(dic):
+    filename = dic['filename']
+    created_at = dic['created_at']
+    # format here so rows never need the json default hook
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat()
+
     if dic['image_info_id'] is None:
         return {
             'id': dic['id'],
-            'filename': dic['filename'],
-            'created_at': dic['created_at'],
+            'filename': filename,
+            'created_at': created_at,
             'urls': {
-                'original_url': f"{IMAGE_ENDPOINT}/{dic['filename']}",
-                'thumbnail_url': f"{THUMBNAIL_ENDPOINT}/{dic['filename']}",
+                'original_url': IMAGE_URL_PREFIX + filename,
+                'thumbnail_url': THUMBNAIL_URL_PREFIX + filename,
             },
         }
     else:
         return {
             'id': dic['id'],
-            'filename': dic['filename'],
-            'created_at': dic['created_at'],
+            'filename': filename,
+            'created_at': created_at,
             'comment': dic['comment'],
             'urls': {
-                'original_url': f"{IMAGE_ENDPOINT}/{dic['filename']}",
-                'thumbnail_url': f"{THUMBNAIL_ENDPOINT}/{dic['filename']}",
+                'original_url': IMAGE_URL_PREFIX + filename,
+                'thumbnail_url': THUMBNAIL_URL_PREFIX + filename,
                 'source': dic['source'],
             },
         }
 
 
+# Every builder below returns SQL text that depends only on the shape of
+# the query, with values bound as parameters, so the text is cached.
+# mysqlclient and aiomysql have no server-side prepared statements; they
+# substitute the parameters client-side.
+
 def build_range_query(max_id, since_id):
     if max_id is None:
         if since_id is None:
-            return ''
+            return '', []
         else:
-            return f'i.id > {since_id}'
+            return 'i.id > %s', [since_id]
     else:
         if since_id is None:
-            return f'i.id <= {max_id}'
+            return 'i.id <= %s', [max_id]
         else:
-            return f'i.id > {since_id} AND i.id <= {max_id}'
+            return 'i.id > %s AND i.id <= %s', [since_id, max_id]
+
+
+SELECT_SEPARATOR = '\n      , '
+
+
+def build_from(columns, where='', join=''):
+    # image_info is only joined when something refers to it
+    if join or 'ii.' in where or any(c.startswith('ii.') for c in columns):
+        return f'''FROM images i
+    LEFT JOIN image_info ii
+    ON i.id = ii.image_id{join}'''
+    return 'FROM images i'
+
+
+@lru_cache(maxsize=1024)
+def build_images_query(where, _reversed, limit=True, join='',
+                       columns=COLUMNS):
+    return f'''
+    SELECT
+        {SELECT_SEPARATOR.join(columns)}
+    {build_from(columns, where, join)}
+    {('WHERE ' + where) if where else ''}
+    ORDER BY id {'ASC' if _reversed else 'DESC'} {'LIMIT %s' if limit else ''}
+    '''
+
+
+@lru_cache(maxsize=1024)
+def build_window_query(where, _reversed, join=''):
+    # only the ids, for a window of candidates larger than one page
+    return f'''
+    SELECT
+        i.id AS id
+    FROM images i
+    LEFT JOIN image_info ii
+    ON i.id = ii.image_id{join}
+    {('WHERE ' + where) if where else ''}
+    ORDER BY id {'ASC' if _reversed else 'DESC'} LIMIT %s
+    '''
+
+
+@lru_cache(maxsize=1024)
+def build_relevance_query(where, join='', bigrams=0):
+    # the best ids for order=relevance by their score: the share of the
+    # keyword bigrams in comment_ngram plus the weighted relevance MySQL
+    # gives the comment for them. Only the rows MySQL rates highest get
+    # the share, which takes a LIKE per bigram. The parameters are a
+    # LIKE pattern for each bigram, the number of bigrams, the weight,
+    # the bigrams, those of where, how many rows to score and the limit
+    coverage = ' + '.join(
+        ["(CONCAT(' ', COALESCE(r.comment_ngram, ''), ' ') LIKE %s)"]
+        * bigrams) or '0'
+    return f'''
+    SELECT
+        r.id AS id
+      , ROUND(({coverage}) / %s + %s * r.relevance, 6) AS score
+    FROM (
+        SELECT
+            i.id AS id
+          , ii.comment_ngram AS comment_ngram
+          , MATCH (ii.comment_ngram)
+                AGAINST (%s IN NATURAL LANGUAGE MODE) AS relevance
+        FROM images i
+        LEFT JOIN image_info ii
+        ON i.id = ii.image_id{join}
+        WHERE {where}
+        ORDER BY relevance DESC, id DESC LIMIT %s
+    ) r
+    ORDER BY score DESC, id DESC LIMIT %s
+    '''
+
+
+@lru_cache(maxsize=1024)
+def build_ids_query(n, _reversed=False, columns=COLUMNS):
+    return f'''
+    SELECT
+        {SELECT_SEPARATOR.join(columns)}
+    {build_from(columns)}
+    WHERE i.id IN ({', '.join(['%s'] * n)})
+    ORDER BY id {'ASC' if _reversed else 'DESC'}
+    '''
+
+
+ESTIMATE_COUNT_QUERY = (
+    'SELECT TABLE_ROWS AS cnt FROM information_schema.TABLES '
+    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'images'"
+)
+
+
+@lru_cache(maxsize=1024)
+def build_count_query(keyword_query, range_query, join=''):
+    if keyword_query is None:
+        return f'''
+        SELECT
+            COUNT(*) AS cnt
+        FROM images i
+        WHERE {range_query}
+        '''
+    return f'''
+    SELECT
+        COUNT(*) AS cnt
+    FROM images i
+    LEFT JOIN image_info ii
+    ON
+        i.id = ii.image_id{join}
+    WHERE
+        {keyword_query}
+    AND {range_query}
+    '''
+
+
+def like_pattern(query):
+    # match the keyword literally, backslash first
+    for x in ('\\', '%', '_'):
+        query = query.replace(x, '\\' + x)
+    return f'%{query}%'
+
+
+def use_unigrams():
+    return bool(UNIGRAM_TABLE) and unigram_ready
+
+
+def match_kind(query):
+    # the fulltext parser of comment_ngram splits on symbols, so only
+    # words made of letters and digits can be looked up as a phrase
+    if len(query) > 1 and MATCH_MODE == 'ngram' and \
+            all(x.isalnum() for x in query):
+        return 'phrase'
+    elif len(query) > 1:
+        return 'word'
+    elif use_unigrams():
+        return 'unigram'
+    elif '♂' in query:
+        return 'like'
+    else:
+        return 'prefix'
 
 
-def build_match_unit(query, ex=False):
+@lru_cache(maxsize=None)
+def build_match_template(kind, ex=False, exact=True):
+    # exact=False drops the LIKE of a phrase; the caller has to check
+    # the rows with planner.verify instead
     if ex:
-        return f"ii.comment NOT LIKE '%%{query}%%'"
+        return 'ii.comment NOT LIKE %s'
 
-    if len(query) > 1:
+    if kind == 'phrase':
         return (
-            f"MATCH (ii.comment) AGAINST "
-            f"('{MySQLdb.escape_string(query).decode('utf-8')}' IN NATURAL LANGUAGE MODE) "
-            f"AND ii.comment LIKE '%%{MySQLdb.escape_string(query).decode('utf-8')}%%'"
+            'MATCH (ii.comment_ngram) AGAINST (%s IN BOOLEAN MODE)'
+            + (' AND ii.comment LIKE %s' if exact else '')
         )
-    elif '♂' in query:
-        # FIXME: want to search with ♂ alone using fulltext index
+    elif kind == 'word':
         return (
-            f"ii.comment LIKE '%%{MySQLdb.escape_string(query).decode('utf-8')}%%'"
+            'MATCH (ii.comment) AGAINST (%s IN NATURAL LANGUAGE MODE) '
+            'AND ii.comment LIKE %s'
         )
-    else:
+    elif kind == 'unigram':
+        # the LIKE only re-checks the rows found in the unigram table
         return (
-            f"MATCH (ii.comment) AGAINST "
-            f"('{MySQLdb.escape_string(ngram(query)).decode('utf-8')}' IN BOOLEAN MODE) "
+            f'ii.image_id IN (SELECT image_id FROM {UNIGRAM_TABLE} '
+            'WHERE ch = %s) AND ii.comment LIKE %s'
         )
+    elif kind == 'like':
+        # FIXME: want to search with ♂ alone using fulltext index
+        return 'ii.comment LIKE %s'
+    else:
+        return 'MATCH (ii.comment) AGAINST (%s IN BOOLEAN MODE)'
+
+
+def build_match_params(query, ex=False, exact=True):
+    kind = match_kind(query)
+    if ex or kind == 'like':
+        return [like_pattern(query)]
+    elif kind == 'prefix':
+        return [ngram(query)]
+    elif kind == 'phrase':
+        phrase = '"' + ' '.join(
+            [x + y for x, y in zip(query, query[1:])]) + '"'
+        return [phrase, like_pattern(query)] if exact else [phrase]
+    else:
+        return [query, like_pattern(query)]
+
 
+def build_match_unit(query, ex=False, exact=True):
+    return (
+        build_match_template(match_kind(query), ex, exact),
+        build_match_params(query, ex, exact),
+    )
 
-def build_search_query_from_dic(dic):
+
+@lru_cache(maxsize=1024)
+def build_search_template(and_kinds, or_kinds, ex_count, exact=True):
     ret = 'TRUE '
     xs = []
 
-    if dic.get('and'):
+    if and_kinds:
         ret += 'AND '
 
-        for a in dic['and']:
-            xs.append(build_match_unit(a))
+        for kind in and_kinds:
+            xs.append(build_match_template(kind, exact=exact))
 
         ret += ' AND '.join(xs)
 
     xs.clear()
 
-    if dic.get('or'):
+    if or_kinds:
         ret += ' AND ('
 
-        for o in dic['or']:
-            xs.append('(' + build_match_unit(o) + ')')
+        for kind in or_kinds:
+            xs.append('(' + build_match_template(kind, exact=exact) + ')')
 
         ret += ' OR '.join(xs) + ')'
 
     xs.clear()
 
-    if dic.get('ex'):
+    if ex_count:
         ret += ' AND '
 
-        for ex in dic['ex']:
-            xs.append(build_match_unit(ex, True))
+        for _ in range(ex_count):
+            xs.append(build_match_template(None, True))
 
         ret += ' AND '.join(xs)
 
@@ -124,6 +451,26 @@ def build_search_query_from_dic(dic):
     return ret
 
 
+def build_search_query_from_dic(dic, exact=True):
+    and_terms = dic.get('and') or []
+    or_terms = dic.get('or') or []
+    ex_terms = dic.get('ex') or []
+    query = build_search_template(
+        tuple(match_kind(a) for a in and_terms),
+        tuple(match_kind(o) for o in or_terms),
+        len(ex_terms),
+        exact,
+    )
+    params = []
+    for a in and_terms:
+        params += build_match_params(a, exact=exact)
+    for o in or_terms:
+        params += build_match_params(o, exact=exact)
+    for ex in ex_terms:
+        params += build_match_params(ex, True)
+    return query, params
+
+
 def build_keyword_query_dic(keyword):
     ret = []
     keywords = keyword.split()
@@ -147,6 +494,22 @@ def build_keyword_query_dic(keyword):
     return query_dic
 
 
+def parse_query_dic(args):
+    keyword = args.get("keyword", "").strip()
+    and_keyword = args.get("all", "").strip()
+    or_keyword = args.get("any", "").strip()
+    not_keyword = args.get("ex", "").strip()
+    if keyword:
+        return build_keyword_query_dic(keyword)
+    elif and_keyword or or_keyword or not_keyword:
+        return {
+            "and": and_keyword.split(),
+            "or": or_keyword.split(),
+            "ex": not_keyword.split(),
+        }
+    return None
+
+
 def build_keyword_query(keyword):
     query_dic = build_keyword_query_dic(keyword)
     return build_search_query_from_dic(query_dic)
@@ -164,32 +527,39 @@ def ngram(text):
 # decorators
 
 
+def parse_params(args):
+    try:
+        count = int(args.get('count', 20))
+    except Exception:
+        raise ValueError('invalid count parameter')
+
+    if not 0 < count <= 200:
+        raise ValueError('count must be between 1 and 200')
+
+    try:
+        max_id = int(args.get('max_id'))
+    except Exception:
+        max_id = None
+
+    try:
+        since_id = int(args.get('since_id'))
+    except Exception:
+        since_id = None
+
+    return count, max_id, since_id
+
+
 def set_params(func):
     @wraps(func)
     def inner(*args, **kwargs):
         try:
-            count = int(request.args.get('count', 20))
-        except Exception:
-            return Json({
-                'ok': False,
-                'message': 'invalid count parameter'
-            }, 400)
-
-        if not 0 < count <= 200:
+            with span('params'):
+                count, max_id, since_id = parse_params(request.args)
+        except ValueError as e:
             return Json({
                 'ok': False,
-                'message': 'count must be between 1 and 200'
+                'message': str(e)
             }, 400)
 
-        try:
-            max_id = int(request.args.get('max_id'))
-        except Exception:
-            max_id = None
-
-        try:
-            since_id = int(request.args.get('since_id'))
-        except Exception:
-            since_id = None
-
         return func(count, max_id, since_id, *args, **kwargs)
     return inner